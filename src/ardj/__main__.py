@@ -3,9 +3,14 @@ The main command line entry module.
 """
 
 import sys
+import ardj.computed
 import ardj.console
 import ardj.database
+import ardj.maintenance
+import ardj.picker
+import ardj.profiler
 import ardj.server
+import ardj.simulator
 import ardj.scrobbler
 import ardj.tracks
 
@@ -14,14 +19,28 @@ def main(prog, command=None, *argv):
         ardj.console.run_cli([])
     elif command == "db-init":
         ardj.database.cmd_init()
+    elif command == "db-explain":
+        ardj.database.cmd_explain(*argv)
+    elif command == "db-profile":
+        ardj.profiler.cmd_profile(*argv)
     elif command == "jabber":
         ardj.jabber.cmd_run_bot()
+    elif command == "maintenance":
+        ardj.maintenance.cmd_maintenance(*argv)
     elif command == "next-track":
         ardj.tracks.cmd_next()
+    elif command == "next-track-server":
+        ardj.picker.cmd_serve()
     elif command == "scrobbler":
         ardj.scrobbler.cmd_start()
     elif command == "serve":
         ardj.server.cmd_serve()
+    elif command == "update-labels":
+        ardj.computed.cmd_update_labels(*argv)
+    elif command == "simulate":
+        ardj.simulator.cmd_simulate(*argv)
+    elif command == "simulate-contention":
+        ardj.simulator.cmd_contention(*argv)
     elif command == "scan":
         ardj.tracks.cmd_scan()
     else:
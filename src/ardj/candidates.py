@@ -0,0 +1,443 @@
+# encoding=utf-8
+
+"""In-memory index of playable tracks.
+
+Picking a track used to mean building a fresh SQL query with one subquery per
+label on every track change.  This module keeps the columns the picker needs
+(weight, artist, count, last_played, file presence) and the label set of every
+track that wasn't deleted in memory, so that playlist filtering becomes a few
+set operations.
+
+The index is built once per process and then kept up to date using the
+track_changes table, which is filled by triggers whenever tracks or labels are
+modified -- by this process or by any other one (the web server, the jabber
+bot, cron jobs).
+
+Usage:
+
+>>> from ardj import candidates
+>>> rows = candidates.get_index().find(["music", "-jingle"])
+"""
+
+import bisect
+import logging
+import time
+
+import ardj.database
+import ardj.labelsets
+import ardj.sampler
+import ardj.settings
+
+
+# Tracks are reloaded in chunks of this size, to keep statements short.
+REFRESH_CHUNK = 500
+
+# How many per-playlist samplers to keep.
+MAX_SAMPLERS = 32
+
+
+class CandidateTrack(object):
+    """Picker related properties of a single track."""
+    __slots__ = ("id", "weight", "artist", "count", "last_played", "has_file",
+                 "labels", "artist_key")
+
+    def __init__(self, row):
+        (self.id, self.weight, self.artist, self.count, self.last_played,
+         self.has_file) = row
+        self.labels = set()
+        self.artist_key = self.artist.lower() if self.artist else None
+
+    def as_row(self):
+        """Returns the track in the (id, weight, artist, count, last_played)
+        form used by get_random_row()."""
+        return (self.id, self.weight, self.artist, self.count,
+                self.last_played)
+
+
+class CandidateFilter(object):
+    """Playlist conditions that don't change from pick to pick.
+
+    Labels are a label expression, see ardj.labelsets."""
+
+    def __init__(self, labels, repeat=None, weight_range=None):
+        self.expr = ardj.labelsets.compile(labels)
+        self.repeat = repeat
+        self.weight_range = weight_range
+        self.key = (tuple(labels), repeat, weight_range)
+
+    def match(self, track):
+        """Checks whether the track passes all conditions."""
+        if not track.has_file or track.artist is None:
+            return False
+        if self.repeat and (track.count is None or track.count >= self.repeat):
+            return False
+        if self.weight_range is not None and not (self.weight_range[0] <= track.weight <= self.weight_range[1]):
+            return False
+        return self.expr.match(track.labels)
+
+
+class RecentArtists(object):
+    """Artists of the last few played tracks (the dupes setting), most recent
+    first, the same as ORDER BY last_played DESC LIMIT dupes.
+
+    The plays are read from the database once, then updated from the change
+    log."""
+
+    def __init__(self, size):
+        self.size = size
+        self.plays = []
+        self.last_played = 0
+
+    def load(self):
+        """Reads recently played tracks from the database."""
+        self.plays = []
+        self.last_played = 0
+        if self.size:
+            self.plays = [tuple(row) for row in ardj.database.fetch("SELECT last_played, id, artist FROM tracks WHERE artist IS NOT NULL AND last_played IS NOT NULL ORDER BY last_played DESC LIMIT ?", (self.size, ))]
+            if self.plays:
+                self.last_played = self.plays[0][0]
+
+    def push(self, track_id, artist, last_played):
+        """Adds a track that was played at the specified time."""
+        if last_played <= self.last_played:
+            return
+        self.last_played = last_played
+        # A track only has one last_played time, the new play replaces it.
+        self.plays = [play for play in self.plays if play[1] != track_id]
+        self.plays.insert(0, (last_played, track_id, artist))
+        del self.plays[self.size:]
+
+    def get(self, count=None):
+        """Returns artists of the count last played tracks, in play order,
+        each name once."""
+        names = []
+        for last_played, track_id, artist in self.plays[:count]:
+            if artist not in names:
+                names.append(artist)
+        return names
+
+
+class CandidateIndex(object):
+    """Tracks and labels, indexed for fast filtering."""
+
+    def __init__(self):
+        self.tracks = {}
+        self.labels = ardj.labelsets.LabelIndex()
+        self.by_last_played = []
+        self.samplers = {}
+        self.recent = RecentArtists(0)
+        self.cursor = None
+        self.generation = None
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def load(self):
+        """Reads all tracks and labels from the database."""
+        ts = time.time()
+        db = ardj.database.Open()
+
+        # Read the change log position first: anything that happens while we
+        # read the tables will be re-applied on the next sync.
+        self.cursor = get_change_cursor()
+        self.generation = db.generation
+
+        self.tracks = {}
+        self.samplers = {}
+
+        for row in db.fetch("SELECT id, weight, artist, count, last_played, filename IS NOT NULL FROM tracks WHERE weight > 0"):
+            self.tracks[row[0]] = CandidateTrack(row)
+
+        # Reading label ids instead of the labels view saves a join per row
+        # and makes tracks share label strings.
+        names = dict(db.fetch("SELECT id, name FROM label_names"))
+        by_label = {}
+        for track_id, label_id in db.fetch("SELECT track_id, label_id FROM track_labels"):
+            label = names[label_id]
+            track = self.tracks.get(track_id)
+            if track is not None:
+                track.labels.add(label)
+                by_label.setdefault(label, []).append(track_id)
+        self.labels.load(self.tracks.keys(), by_label)
+
+        self.by_last_played = sorted((t.last_played, t.id) for t in self.tracks.values() if t.last_played)
+
+        self.recent = RecentArtists(ardj.settings.get_int("dupes", 0))
+        self.recent.load()
+
+        logging.debug("Candidate index loaded: %u tracks, %u labels, %.3f seconds." % (
+            len(self.tracks), len(self.labels.bits), time.time() - ts))
+
+    def sync(self):
+        """Applies changes made since the last load or sync.
+
+        Rebuilds the whole index when the change log is unavailable or was
+        purged past our position, or when a transaction was rolled back."""
+        if self.cursor is None or self.generation != ardj.database.Open().generation:
+            return self.load()
+
+        first, last = get_change_range()
+        if last is None or last == self.cursor:
+            return
+        if not has_changes_since(self.cursor, first, last):
+            return self.load()
+
+        ids = ardj.database.fetchcol(
+            "SELECT DISTINCT track_id FROM track_changes WHERE id > ?", (self.cursor, )) or []
+        self.cursor = last
+        self.refresh(ids)
+
+    def refresh(self, track_ids):
+        """Reloads the specified tracks from the database."""
+        track_ids = list(track_ids)
+        played = []
+        for idx in range(0, len(track_ids), REFRESH_CHUNK):
+            chunk = track_ids[idx:idx + REFRESH_CHUNK]
+            params_sql = ", ".join(["?"] * len(chunk))
+
+            old = dict((track_id, self._drop(track_id)) for track_id in chunk)
+
+            for row in ardj.database.fetch("SELECT id, weight, artist, count, last_played, filename IS NOT NULL FROM tracks WHERE weight > 0 AND id IN (%s)" % params_sql, chunk):
+                self.tracks[row[0]] = CandidateTrack(row)
+
+            for track_id, label in ardj.database.fetch("SELECT track_id, label FROM labels WHERE track_id IN (%s)" % params_sql, chunk):
+                track = self.tracks.get(track_id)
+                if track is not None:
+                    track.labels.add(label)
+
+            for track_id in chunk:
+                self._add(track_id, old[track_id])
+
+            # Deleted tracks count too, so they're read separately.
+            if self.recent.size:
+                played.extend(ardj.database.fetch("SELECT last_played, id, artist FROM tracks WHERE artist IS NOT NULL AND last_played > ? AND id IN (%s)" % params_sql, [self.recent.last_played] + chunk))
+
+        for last_played, track_id, artist in sorted(played):
+            self.recent.push(track_id, artist, last_played)
+
+        if track_ids:
+            logging.debug("Candidate index: refreshed %u tracks." % len(track_ids))
+
+    def _add(self, track_id, old=None):
+        """Updates secondary structures after a track was (re)loaded.  Old
+        is the track as it was before, if it was in the index."""
+        track = self.tracks.get(track_id)
+        self.labels.update_track(track_id, old.labels if old is not None else None,
+                                 track.labels if track is not None else None)
+        if track is None:
+            for cfilter, sampler in self.samplers.values():
+                sampler.remove(track_id)
+            return
+
+        if track.last_played:
+            bisect.insort(self.by_last_played, (track.last_played, track_id))
+
+        for cfilter, sampler in self.samplers.values():
+            if cfilter.match(track):
+                sampler.set(track_id, track.artist_key, track.weight)
+            else:
+                sampler.remove(track_id)
+
+    def _drop(self, track_id):
+        """Removes a track, except from the label index, which is updated by
+        _add().  Returns the removed track."""
+        track = self.tracks.pop(track_id, None)
+        if track is None:
+            return None
+        if track.last_played:
+            item = (track.last_played, track_id)
+            pos = bisect.bisect_left(self.by_last_played, item)
+            if pos < len(self.by_last_played) and self.by_last_played[pos] == item:
+                del self.by_last_played[pos]
+        return track
+
+    def match_labels(self, labels):
+        """Returns the bitset of tracks that match a label expression, see
+        ardj.labelsets."""
+        return ardj.labelsets.compile(labels).evaluate(self.labels)
+
+    def find_ids(self, labels):
+        """Returns sorted ids of tracks that match a label expression."""
+        return ardj.labelsets.to_ids(self.match_labels(labels))
+
+    def find(self, labels, repeat=None, skip_artists=None, weight_range=None,
+             played_before=None):
+        """Returns rows for tracks that can be played from a playlist.
+
+        Only tracks that have a file and an artist name are returned.  Rows
+        are sorted by track id and have the (id, weight, artist, count,
+        last_played) form expected by tracks.get_random_row().
+
+        Arguments:
+        labels -- label expression, see ardj.labelsets.
+        repeat -- only return tracks played less than this many times.
+        skip_artists -- names of artists to skip.
+        weight_range -- a (min, max) tuple, inclusive.
+        played_before -- only return tracks not played since this timestamp.
+        """
+        cfilter = CandidateFilter(labels, repeat, weight_range)
+        skip_artists = set(skip_artists or [])
+
+        rows = []
+        for track_id in self.find_ids(labels):
+            track = self.tracks[track_id]
+            if not cfilter.match(track):
+                continue
+            if track.artist in skip_artists:
+                continue
+            if played_before is not None and track.last_played is not None and track.last_played > played_before:
+                continue
+            rows.append(track.as_row())
+
+        return rows
+
+    def get_sampler(self, labels, repeat=None, weight_range=None):
+        """Returns the weighted sampler for a playlist.
+
+        Samplers are built on first use, then kept up to date by refresh()."""
+        cfilter = CandidateFilter(labels, repeat, weight_range)
+        if cfilter.key in self.samplers:
+            return self.samplers[cfilter.key][1]
+
+        if len(self.samplers) >= MAX_SAMPLERS:
+            self.samplers = {}
+
+        sampler = ardj.sampler.ArtistSampler()
+        for track_id in self.find_ids(labels):
+            track = self.tracks[track_id]
+            if cfilter.match(track):
+                sampler.set(track_id, track.artist_key, track.weight)
+
+        self.samplers[cfilter.key] = (cfilter, sampler)
+        return sampler
+
+    def get_recent_artists(self, count):
+        """Returns artists of the count last played tracks, most recent
+        first."""
+        if count > self.recent.size:
+            self.recent = RecentArtists(count)
+            self.recent.load()
+        return self.recent.get(count)
+
+    def get_played_since(self, ts):
+        """Returns ids of tracks played after the timestamp."""
+        pos = bisect.bisect_right(self.by_last_played, (ts, float("inf")))
+        return [track_id for last_played, track_id in self.by_last_played[pos:]]
+
+    def pick(self, labels, repeat=None, skip_artists=None, weight_range=None,
+             played_before=None):
+        """Picks a random track using the default strategy.
+
+        Takes the same arguments as find(), returns a track id or None.  Only
+        the tracks excluded by skip_artists and played_before are looked at,
+        the rest is done by the sampler in O(log n)."""
+        sampler = self.get_sampler(labels, repeat, weight_range)
+        exclude = self._get_excluded(sampler, skip_artists, played_before)
+        return sampler.pick(exclude)
+
+    def count_all(self, queries):
+        """Returns the number of candidates for each query.
+
+        Each query is a dictionary of find() arguments, usually one per active
+        playlist.  Recently played tracks are looked up once for all queries,
+        the rest comes from the samplers, so this is cheap enough to do on
+        every pick."""
+        played = {}
+        counts = []
+        for query in queries:
+            sampler = self.get_sampler(query["labels"], query.get("repeat"), query.get("weight_range"))
+            exclude = self._get_excluded(sampler, query.get("skip_artists"),
+                                         query.get("played_before"), played)
+            counts.append(len(sampler) - len(exclude))
+        return counts
+
+    def _get_excluded(self, sampler, skip_artists, played_before, played=None):
+        """Returns ids of sampler tracks that must not be picked.
+
+        Arguments:
+        played -- a dictionary to cache get_played_since() results in.
+        """
+        exclude = set()
+        if skip_artists:
+            skip_artists = set(skip_artists)
+            for key in set(name.lower() for name in skip_artists):
+                tracks = sampler.tracks.get(key)
+                if tracks:
+                    exclude.update(tid for tid in tracks if self.tracks[tid].artist in skip_artists)
+
+        if played_before is not None:
+            if played is None:
+                played = {}
+            if played_before not in played:
+                played[played_before] = self.get_played_since(played_before)
+            exclude.update(tid for tid in played[played_before] if tid in sampler)
+
+        return exclude
+
+
+_index = None
+
+
+def get_change_cursor():
+    """Returns the id of the last change log entry, zero if the log is empty,
+    None if there's no log (the database was not initialized)."""
+    first, last = get_change_range()
+    if first is None and last is None and not has_change_log():
+        return None
+    return last or 0
+
+
+def get_change_range():
+    """Returns ids of the first and last change log entries.
+
+    The last id is taken from the AUTOINCREMENT sequence, so it's known even
+    after old entries were purged."""
+    try:
+        first = ardj.database.fetchone("SELECT MIN(id) FROM track_changes")[0]
+        last = ardj.database.fetchone("SELECT seq FROM sqlite_sequence WHERE name = 'track_changes'")
+    except ardj.database.OperationalError:
+        return None, None
+    return first, last[0] if last else None
+
+
+def has_changes_since(cursor, first, last):
+    """Checks whether the change log has all entries after the cursor, given
+    the change range.  It doesn't if entries were purged past the cursor,
+    including when the log was emptied, or the sequence went backwards."""
+    if last < cursor:
+        return False
+    if first is None:
+        return last == cursor
+    return first <= cursor + 1
+
+
+def has_change_log():
+    row = ardj.database.fetchone(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'track_changes'")
+    if not row[0]:
+        logging.warning("Table track_changes not found, candidate index will be rebuilt on every pick.  Run \"ardj db-init\" to fix this.")
+        return False
+    return True
+
+
+def get_index():
+    """Returns the up to date candidate index, builds it when necessary."""
+    global _index
+    # The index follows the change log of the main database, even when
+    # called by code which reads from a replica.
+    with ardj.database.writing():
+        if _index is None:
+            _index = CandidateIndex()
+            _index.load()
+        else:
+            _index.sync()
+    return _index
+
+
+def reset():
+    """Drops the cached index, it will be rebuilt on next access."""
+    global _index
+    _index = None
+
+
+__all__ = ["get_index", "reset", "CandidateIndex"]
@@ -276,9 +276,17 @@ def cmd_mark_long(*args):
 
 def cmd_mark_orphans(*args):
     """marks tracks that don't belong to a playlist with the "orphan" label"""
-    from ardj import database
+    from ardj import database, is_verbose
     database.Open().mark_orphans()
-    database.commit()
+    if is_verbose():
+        cmd_list_orphans()
+
+
+def cmd_list_orphans(*args):
+    """lists tracks labelled "orphan" by mark-orphans"""
+    from ardj import database
+    for track in database.Track.iter_by_tag("orphan"):
+        print("%8u; %s -- %s" % (track["id"], track["artist"] or "unknown", track["title"] or "unknown"))
 
 
 def cmd_mark_recent(*args):
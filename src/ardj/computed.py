@@ -0,0 +1,196 @@
+# encoding=utf-8
+
+"""Computed labels.
+
+Some labels are not set by people but derived from other data: "hitlist",
+"recent", "fresh", "long", "orphan" and "concert-soon".  Every such label is
+declared once in RULES, as an SQL condition on the tracks table, optionally
+with parameters that depend on the whole library (like the weight of the
+20th best track) or on outside data (playlists, the event schedule).
+
+update() brings the labels up to date.  Only tracks changed since the last
+run (according to the track change log, see ardj.candidates) are checked,
+unless the parameters of a rule changed, then all tracks are.  Either way
+only the difference is written: the label is removed from tracks that no
+longer match and added to tracks that do.  The last seen change log id and
+parameters of every rule are stored in the computed_labels table.
+
+Usage:
+
+    ardj.computed.update(["recent", "fresh"])
+
+or from the command line, for all rules:
+
+    python3 -m ardj update-labels [full]
+"""
+
+import json
+import logging
+import time
+
+import ardj.candidates
+import ardj.database
+import ardj.settings
+
+
+# Labels are added on behalf of this user.
+OWNER = "ardj"
+
+# Condition for "music" tracks, used by several rules.
+MUSIC = "id IN (SELECT track_id FROM labels WHERE label = 'music')"
+
+
+class Rule(object):
+    """A computed label.
+
+    Arguments:
+    label -- the label to maintain.
+    where -- SQL condition on tracks, can have "?" placeholders.
+    params -- function that returns values for the placeholders, or None if
+    the rule can't be applied right now; None if there are no placeholders.
+    """
+
+    def __init__(self, label, where, params=None):
+        self.label = label
+        self.where = where
+        self.params = params
+
+    def get_params(self):
+        if self.params is None:
+            return []
+        return self.params()
+
+
+def get_hitlist_threshold():
+    """Returns the real weight of the 20th best music track, None if there
+    are less."""
+    row = ardj.database.fetchone("SELECT real_weight FROM tracks WHERE real_weight IS NOT NULL AND %s ORDER BY real_weight DESC LIMIT 19, 1" % MUSIC)
+    return [row[0] if row else None]
+
+
+def get_recent_threshold():
+    """Returns the id of the 100th newest music track, 0 if there are less."""
+    row = ardj.database.fetchone("SELECT id FROM tracks WHERE %s ORDER BY id DESC LIMIT 99, 1" % MUSIC)
+    return [row[0] if row else 0]
+
+
+def get_average_length():
+    return [ardj.database.Track.get_average_length()]
+
+
+def get_playlist_labels():
+    """Returns labels used by playlists, as JSON."""
+    labels = set()
+    for playlist in ardj.settings.load().get_playlists():
+        for label in playlist.get("labels", [playlist["name"]]):
+            if not label.startswith("-"):
+                labels.add(label)
+    if not labels:
+        logging.warning("Could not mark orphan tracks: no labels are used in playlists.yaml")
+        return None
+    return [json.dumps(sorted(labels))]
+
+
+def get_concert_artists():
+    """Returns names of artists with upcoming events, as JSON."""
+    import ardj.tout
+    return [json.dumps(ardj.tout.get_concert_artists())]
+
+
+RULES = [
+    Rule("hitlist", "real_weight >= ? AND " + MUSIC, get_hitlist_threshold),
+    Rule("recent", "id >= ? AND " + MUSIC, get_recent_threshold),
+    Rule("fresh", "count < 10 AND weight > 0 AND " + MUSIC),
+    Rule("long", "length > ?", get_average_length),
+    Rule("orphan", "weight > 0 AND id NOT IN (SELECT track_id FROM track_labels WHERE label_id IN (SELECT id FROM label_names WHERE name IN (SELECT value FROM json_each(?))))", get_playlist_labels),
+    Rule("concert-soon", "artist IN (SELECT value FROM json_each(?))", get_concert_artists),
+]
+
+
+def get_rule(label):
+    for rule in RULES:
+        if rule.label == label:
+            return rule
+    raise KeyError("no rule for label %s" % label)
+
+
+def get_changed_tracks(cursor, last):
+    """Returns ids of tracks changed after the cursor, None if the change
+    log doesn't go back that far."""
+    if cursor is None or last is None:
+        return None
+    if not ardj.candidates.has_changes_since(cursor, ardj.candidates.get_change_range()[0], last):
+        return None
+    return ardj.database.fetchcol(
+        "SELECT DISTINCT track_id FROM track_changes WHERE id > ? AND id <= ?", (cursor, last)) or []
+
+
+def apply_rule(rule, full=False):
+    """Updates one label.  Returns numbers of added and removed tracks, None
+    if the rule was skipped."""
+    params = rule.get_params()
+    if params is None:
+        return None
+
+    with ardj.database.transaction("labels: " + rule.label):
+        last = ardj.candidates.get_change_cursor()
+        state = ardj.database.fetchone("SELECT cursor, params FROM computed_labels WHERE label = ?", (rule.label, ))
+
+        changed = None
+        if state is not None and not full and state[1] == json.dumps(params):
+            changed = get_changed_tracks(state[0], last)
+            if changed == []:
+                ardj.database.execute("UPDATE computed_labels SET cursor = ? WHERE label = ?", (last or 0, rule.label))
+                return 0, 0
+
+        want_sql = "SELECT id FROM tracks WHERE " + rule.where
+        have_sql = "SELECT track_id FROM labels WHERE label = ?"
+        want_params, have_params = list(params), [rule.label]
+        if changed is not None:
+            want_sql += " AND id IN (SELECT value FROM json_each(?))"
+            have_sql += " AND track_id IN (SELECT value FROM json_each(?))"
+            want_params.append(json.dumps(changed))
+            have_params.append(json.dumps(changed))
+
+        want = set(ardj.database.fetchcol(want_sql, want_params) or [])
+        have = set(ardj.database.fetchcol(have_sql, have_params) or [])
+        added, removed = sorted(want - have), sorted(have - want)
+
+        if removed:
+            ardj.database.execute_many("DELETE FROM labels WHERE track_id = ? AND label = ?",
+                                       [(track_id, rule.label) for track_id in removed])
+        if added:
+            ardj.database.bulk_insert("labels", ("track_id", "label", "email"),
+                                      [(track_id, rule.label, OWNER) for track_id in added])
+
+        # Our own label changes are in the log after the cursor, so the
+        # next run checks these tracks again.  That's cheap and lets rules
+        # depend on each other's labels.
+        ardj.database.execute("INSERT OR REPLACE INTO computed_labels (label, cursor, params, ts) VALUES (?, ?, ?, ?)",
+                              (rule.label, last or 0, json.dumps(params), int(time.time())))
+
+    logging.info("Label %s: %s, %u added, %u removed." % (
+        rule.label, "all tracks checked" if changed is None else "%u tracks checked" % len(changed),
+        len(added), len(removed)))
+    return len(added), len(removed)
+
+
+def update(labels=None, full=False):
+    """Updates computed labels, all or the listed ones.  Returns a
+    dictionary of labels and (added, removed) counts."""
+    result = {}
+    for rule in RULES:
+        if labels is None or rule.label in labels:
+            counts = apply_rule(rule, full)
+            if counts is not None:
+                result[rule.label] = counts
+    return result
+
+
+def cmd_update_labels(*args):
+    """Update computed labels (hitlist, recent, fresh, long, orphan, concert-soon)"""
+    for label, (added, removed) in update(full="full" in args).items():
+        print("%-15s %5u added %5u removed" % (label, added, removed))
+
+
+__all__ = ["RULES", "Rule", "cmd_update_labels", "get_rule", "update"]
@@ -382,7 +382,6 @@ def on_play(args, sender):
             return 'Playing everything.'
         return 'Current filter: %s' % ' '.join(current)
     ardj.tracks.set_urgent(args)
-    ardj.database.commit()
     return 'OK.'
 
 
@@ -395,9 +394,7 @@ def on_tags(args, sender):
     tags -- show the tag cloud.
     """
     if not args or args == '-a':
-        data = ardj.database.fetch('SELECT l.label, COUNT(*) AS count FROM labels l '
-                                   'INNER JOIN tracks t ON t.id = l.track_id '
-                                   'WHERE t.weight > 0 GROUP BY label ORDER BY l.label')
+        data = ardj.database.Label.get_counts()
         if args != '-a':
             data = [x for x in data if ':' not in x[0]]
         if not data:
@@ -649,6 +646,13 @@ command_map = (
     ('votes', True, on_votes, 'shows who voted for a track'),
 )
 
+# Commands which only read, or wait for remote hosts and don't need to hold
+# the write lock meanwhile.  Others run in a transaction, see
+# process_command().
+NO_TRANSACTION_COMMANDS = ('admins', 'dump', 'echo', 'find', 'help',
+                           'hitlist', 'last', 'news', 'restart', 'shitlist',
+                           'show', 'skip', 'status', 'twit', 'voters', 'votes')
+
 command_aliases = {
     'кщслы': 'rocks',
     'ыгслы': 'sucks',
@@ -722,7 +726,11 @@ def process_command(text, sender=None, quiet=False):
         return 'Did you mean %s?' % ardj.util.shortlist(
             [o[0] for o in options], limit=1000, glue='or')
 
-    return options[0][1](args.strip(), sender=sender)
+    cmd_name, handler = options[0]
+    if cmd_name in NO_TRANSACTION_COMMANDS:
+        return handler(args.strip(), sender=sender)
+    with ardj.database.transaction("command " + cmd_name):
+        return handler(args.strip(), sender=sender)
 
 
 def print_response(message):
@@ -759,7 +767,6 @@ def run_cli(args):
             if text:
                 response = process_command(text, sender, quiet=True)
                 print_response(response)
-                ardj.database.Open().commit()
         except EOFError:
             readline.write_history_file(histfile)
             print('\nBye.')
@@ -20,11 +20,13 @@
 This module contains the database related code.
 """
 
+import contextlib
 import logging
 import os
 import random
 import re
 import sys
+import threading
 import time
 import traceback
 import urllib.request
@@ -38,6 +40,8 @@ except ImportError:
     print('Please install pysqlite2.', file=sys.stderr)
     sys.exit(13)
 
+import ardj.computed
+import ardj.profiler
 import ardj.settings
 import ardj.scrobbler
 import ardj.tags
@@ -46,6 +50,13 @@ import ardj.util
 
 RECENT_SECONDS = 2 * 3600
 
+# Label triggers must be re-created whenever the table is.
+LABEL_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS trg_labels_insert AFTER INSERT ON labels BEGIN INSERT INTO track_changes (track_id, ts) VALUES (NEW.track_id, strftime('%s', 'now')); END;",
+    "CREATE TRIGGER IF NOT EXISTS trg_labels_update AFTER UPDATE ON labels BEGIN INSERT INTO track_changes (track_id, ts) VALUES (OLD.track_id, strftime('%s', 'now')); INSERT INTO track_changes (track_id, ts) VALUES (NEW.track_id, strftime('%s', 'now')); END;",
+    "CREATE TRIGGER IF NOT EXISTS trg_labels_delete AFTER DELETE ON labels BEGIN INSERT INTO track_changes (track_id, ts) VALUES (OLD.track_id, strftime('%s', 'now')); END;",
+]
+
 SQL_INIT = [
     # playlists
     "CREATE TABLE IF NOT EXISTS playlists (id INTEGER PRIMARY KEY, name TEXT, last_played INTEGER);",
@@ -55,7 +66,6 @@ SQL_INIT = [
     "CREATE INDEX IF NOT EXISTS idx_tracks_owner ON tracks (owner);",
     "CREATE INDEX IF NOT EXISTS idx_tracks_last ON tracks (last_played);",
     "CREATE INDEX IF NOT EXISTS idx_tracks_count ON tracks (count);",
-    "CREATE INDEX IF NOT EXISTS idx_tracks_weight ON tracks (weight);",
     "CREATE INDEX IF NOT EXISTS idx_tracks_real_weight ON tracks (real_weight);",
     "CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY, track_id INTEGER, owner TEXT);",
 
@@ -64,14 +74,11 @@ SQL_INIT = [
     "CREATE INDEX IF NOT EXISTS urgent_playlists_expires ON urgent_playlists (expires);",
 
     # labels
-    "CREATE TABLE IF NOT EXISTS labels (track_id INTEGER NOT NULL, email TEXT NOT NULL, label TEXT NOT NULL);",
-    "CREATE INDEX IF NOT EXISTS idx_labels_track_id ON labels (track_id);",
-    "CREATE INDEX IF NOT EXISTS idx_labels_email ON labels (email);",
-    "CREATE INDEX IF NOT EXISTS idx_labels_label ON labels (label);",
+    # (a view since migration 4, then this does nothing)
+    "CREATE TABLE IF NOT EXISTS labels (track_id INTEGER NOT NULL, email TEXT NOT NULL, label TEXT NOT NULL, UNIQUE (track_id, label) ON CONFLICT IGNORE);",
 
     # voting
     "CREATE TABLE IF NOT EXISTS votes (track_id INTEGER NOT NULL, email TEXT NOT NULL, vote INTEGER, weight REAL, ts INTEGER);",
-    "CREATE INDEX IF NOT EXISTS idx_votes_track_id ON votes (track_id);",
     "CREATE INDEX IF NOT EXISTS idx_votes_email ON votes (email);",
     "CREATE INDEX IF NOT EXISTS idx_votes_ts ON votes (ts);",
 
@@ -92,8 +99,257 @@ SQL_INIT = [
 
     # web authentication
     "CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY NOT NULL, login TEXT NOT NULL, login_type TEXT NOT NULL, active INTEGER NOT NULL DEFAULT 0);",
+
+    # track change log, used to update in-memory indexes (see ardj.candidates)
+    "CREATE TABLE IF NOT EXISTS track_changes (id INTEGER PRIMARY KEY AUTOINCREMENT, track_id INTEGER NOT NULL, ts INTEGER NOT NULL);",
+    "CREATE TRIGGER IF NOT EXISTS trg_tracks_insert AFTER INSERT ON tracks BEGIN INSERT INTO track_changes (track_id, ts) VALUES (NEW.id, strftime('%s', 'now')); END;",
+    "CREATE TRIGGER IF NOT EXISTS trg_tracks_update AFTER UPDATE OF id, weight, artist, count, last_played, filename ON tracks BEGIN INSERT INTO track_changes (track_id, ts) VALUES (NEW.id, strftime('%s', 'now')); END;",
+    "CREATE TRIGGER IF NOT EXISTS trg_tracks_delete AFTER DELETE ON tracks BEGIN INSERT INTO track_changes (track_id, ts) VALUES (OLD.id, strftime('%s', 'now')); END;",
+]
+
+def _fold_sql(expr):
+    """Folds ё to е in SQL, same as ardj.util.lower() does.  Case is folded
+    by the full text search tokenizer."""
+    return "replace(replace(%s, 'ё', 'е'), 'Ё', 'Е')" % expr
+
+
+def _search_labels_sql(track_id):
+    return "(SELECT group_concat(label, ' ') FROM labels WHERE track_id = %s)" % track_id
+
+
+def _insert_label_sql(row):
+    return ("INSERT OR IGNORE INTO label_names (name) VALUES ({0}.label); "
+            "INSERT OR IGNORE INTO label_owners (email) VALUES ({0}.email); "
+            "INSERT INTO track_labels (track_id, label_id, owner_id) VALUES ({0}.track_id, "
+            "(SELECT id FROM label_names WHERE name = {0}.label), "
+            "(SELECT id FROM label_owners WHERE email = {0}.email));").format(row)
+
+
+def _delete_label_sql(row):
+    return ("DELETE FROM track_labels WHERE track_id = {0}.track_id "
+            "AND label_id = (SELECT id FROM label_names WHERE name = {0}.label);").format(row)
+
+
+def _label_stats_sql(row, sign):
+    """Updates label_stats when a track_labels row is added or removed."""
+    return ("INSERT OR IGNORE INTO label_stats (label_id) VALUES ({0}.label_id); "
+            "UPDATE label_stats SET total = total {1} 1, "
+            "live = live {1} (SELECT COUNT(*) FROM tracks WHERE id = {0}.track_id AND weight > 0) "
+            "WHERE label_id = {0}.label_id;").format(row, sign)
+
+
+LABEL_STATS_REBUILD = ("INSERT OR REPLACE INTO label_stats (label_id, live, total) "
+                       "SELECT tl.label_id, COALESCE(SUM(t.weight > 0), 0), COUNT(*) FROM track_labels tl "
+                       "LEFT JOIN tracks t ON t.id = tl.track_id GROUP BY tl.label_id;")
+
+
+# Schema changes on top of SQL_INIT, applied once and in order by
+# init_database().  Applied versions are stored in schema_migrations.
+MIGRATIONS = [
+    (1, "unique playlist names", [
+        "DELETE FROM playlists WHERE id NOT IN (SELECT MAX(id) FROM playlists GROUP BY name);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_playlists_name ON playlists (name);",
+    ]),
+    (2, "unique labels, composite indexes", [
+        # Labels are copied to a table with a unique constraint, only the
+        # first copy of every duplicate label is kept.
+        "DROP TABLE IF EXISTS labels_new;",
+        "CREATE TABLE labels_new (track_id INTEGER NOT NULL, email TEXT NOT NULL, label TEXT NOT NULL, UNIQUE (track_id, label) ON CONFLICT IGNORE);",
+        "INSERT INTO labels_new (track_id, email, label) SELECT track_id, email, label FROM labels WHERE rowid IN (SELECT MIN(rowid) FROM labels GROUP BY track_id, label) ORDER BY rowid;",
+        "DROP TABLE labels;",
+        "ALTER TABLE labels_new RENAME TO labels;",
+        "CREATE INDEX IF NOT EXISTS idx_labels_email ON labels (email);",
+        "CREATE INDEX IF NOT EXISTS idx_labels_label_track ON labels (label, track_id);",
+    ] + LABEL_TRIGGERS + [
+        "DROP INDEX IF EXISTS idx_votes_track_id;",
+        "CREATE INDEX IF NOT EXISTS idx_votes_track_email_ts ON votes (track_id, email, ts);",
+        "CREATE INDEX IF NOT EXISTS idx_playlog_lastfm_ts ON playlog (lastfm, ts);",
+        "CREATE INDEX IF NOT EXISTS idx_playlog_librefm_ts ON playlog (librefm, ts);",
+        "DROP INDEX IF EXISTS idx_tracks_weight;",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_weight_artist ON tracks (weight, artist);",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_download ON tracks (download);",
+    ]),
+    (3, "full text search", [
+        # Diacritics are kept, only ё is folded, by _fold_sql().
+        "CREATE VIRTUAL TABLE IF NOT EXISTS track_search USING fts5 (artist, title, labels, tokenize = 'unicode61 remove_diacritics 0');",
+        "DELETE FROM track_search;",
+        "INSERT INTO track_search (rowid, artist, title, labels) SELECT id, %s, %s, %s FROM tracks;" % (
+            _fold_sql("artist"), _fold_sql("title"), _search_labels_sql("tracks.id")),
+        "CREATE TRIGGER IF NOT EXISTS trg_search_insert AFTER INSERT ON tracks BEGIN INSERT INTO track_search (rowid, artist, title, labels) VALUES (NEW.id, %s, %s, %s); END;" % (
+            _fold_sql("NEW.artist"), _fold_sql("NEW.title"), _search_labels_sql("NEW.id")),
+        "CREATE TRIGGER IF NOT EXISTS trg_search_update AFTER UPDATE OF id, artist, title ON tracks BEGIN DELETE FROM track_search WHERE rowid = OLD.id; INSERT INTO track_search (rowid, artist, title, labels) VALUES (NEW.id, %s, %s, %s); END;" % (
+            _fold_sql("NEW.artist"), _fold_sql("NEW.title"), _search_labels_sql("NEW.id")),
+        "CREATE TRIGGER IF NOT EXISTS trg_search_delete AFTER DELETE ON tracks BEGIN DELETE FROM track_search WHERE rowid = OLD.id; END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_search_labels_insert AFTER INSERT ON labels BEGIN UPDATE track_search SET labels = %s WHERE rowid = NEW.track_id; END;" % _search_labels_sql("NEW.track_id"),
+        "CREATE TRIGGER IF NOT EXISTS trg_search_labels_update AFTER UPDATE ON labels BEGIN UPDATE track_search SET labels = %s WHERE rowid = OLD.track_id; UPDATE track_search SET labels = %s WHERE rowid = NEW.track_id; END;" % (
+            _search_labels_sql("OLD.track_id"), _search_labels_sql("NEW.track_id")),
+        "CREATE TRIGGER IF NOT EXISTS trg_search_labels_delete AFTER DELETE ON labels BEGIN UPDATE track_search SET labels = %s WHERE rowid = OLD.track_id; END;" % _search_labels_sql("OLD.track_id"),
+    ]),
+    (4, "label and owner dictionaries", [
+        # Label names and owner emails are stored once, track_labels only
+        # has integers.  The labels view, with triggers that write through
+        # it, keeps existing queries working.
+        "CREATE TABLE label_names (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);",
+        "CREATE TABLE label_owners (id INTEGER PRIMARY KEY, email TEXT NOT NULL UNIQUE);",
+        "CREATE TABLE track_labels (track_id INTEGER NOT NULL, label_id INTEGER NOT NULL, owner_id INTEGER NOT NULL, PRIMARY KEY (track_id, label_id) ON CONFLICT IGNORE) WITHOUT ROWID;",
+        "INSERT INTO label_names (name) SELECT DISTINCT label FROM labels ORDER BY label;",
+        "INSERT INTO label_owners (email) SELECT DISTINCT email FROM labels ORDER BY email;",
+        "INSERT INTO track_labels (track_id, label_id, owner_id) SELECT l.track_id, n.id, o.id FROM labels l INNER JOIN label_names n ON n.name = l.label INNER JOIN label_owners o ON o.email = l.email;",
+        "DROP TABLE labels;",
+        "CREATE INDEX idx_track_labels_label ON track_labels (label_id, track_id);",
+        "CREATE INDEX idx_track_labels_owner ON track_labels (owner_id);",
+        "CREATE VIEW labels AS SELECT tl.track_id AS track_id, o.email AS email, n.name AS label FROM track_labels tl INNER JOIN label_names n ON n.id = tl.label_id INNER JOIN label_owners o ON o.id = tl.owner_id;",
+        "CREATE TRIGGER trg_labels_view_insert INSTEAD OF INSERT ON labels BEGIN %s END;" % _insert_label_sql("NEW"),
+        "CREATE TRIGGER trg_labels_view_delete INSTEAD OF DELETE ON labels BEGIN %s END;" % _delete_label_sql("OLD"),
+        "CREATE TRIGGER trg_labels_view_update INSTEAD OF UPDATE ON labels BEGIN %s %s END;" % (_delete_label_sql("OLD"), _insert_label_sql("NEW")),
+        # Change log and search index.
+        "CREATE TRIGGER trg_track_labels_insert AFTER INSERT ON track_labels BEGIN INSERT INTO track_changes (track_id, ts) VALUES (NEW.track_id, strftime('%%s', 'now')); UPDATE track_search SET labels = %s WHERE rowid = NEW.track_id; END;" % _search_labels_sql("NEW.track_id"),
+        "CREATE TRIGGER trg_track_labels_update AFTER UPDATE ON track_labels BEGIN INSERT INTO track_changes (track_id, ts) VALUES (OLD.track_id, strftime('%%s', 'now')); INSERT INTO track_changes (track_id, ts) VALUES (NEW.track_id, strftime('%%s', 'now')); UPDATE track_search SET labels = %s WHERE rowid = OLD.track_id; UPDATE track_search SET labels = %s WHERE rowid = NEW.track_id; END;" % (
+            _search_labels_sql("OLD.track_id"), _search_labels_sql("NEW.track_id")),
+        "CREATE TRIGGER trg_track_labels_delete AFTER DELETE ON track_labels BEGIN INSERT INTO track_changes (track_id, ts) VALUES (OLD.track_id, strftime('%%s', 'now')); UPDATE track_search SET labels = %s WHERE rowid = OLD.track_id; END;" % _search_labels_sql("OLD.track_id"),
+    ]),
+    (5, "log real weight and length changes", [
+        # Computed labels depend on these, see ardj.computed.
+        "DROP TRIGGER IF EXISTS trg_tracks_update;",
+        "CREATE TRIGGER trg_tracks_update AFTER UPDATE OF id, weight, real_weight, artist, count, length, last_played, filename ON tracks BEGIN INSERT INTO track_changes (track_id, ts) VALUES (NEW.id, strftime('%s', 'now')); END;",
+    ]),
+    (6, "last.fm love state", [
+        # What was last sent to last.fm for every track, see
+        # database.sync_lastfm_loves().  Error is set when last.fm refused
+        # the track.
+        "CREATE TABLE lastfm_loves (track_id INTEGER PRIMARY KEY, loved INTEGER NOT NULL, ts INTEGER NOT NULL, error TEXT);",
+    ]),
+    (7, "computed label state", [
+        # Change log position and parameters of every rule in
+        # ardj.computed.RULES when it was last applied.
+        "CREATE TABLE computed_labels (label TEXT PRIMARY KEY, cursor INTEGER NOT NULL, params TEXT NOT NULL, ts INTEGER NOT NULL);",
+    ]),
+    (8, "label counts", [
+        # Number of tracks with every label: live ones (weight > 0) and all.
+        # Kept up to date by triggers, read by the tag cloud, rebuilt by
+        # purge() just in case.
+        "CREATE TABLE label_stats (label_id INTEGER PRIMARY KEY, live INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0);",
+        LABEL_STATS_REBUILD,
+        "CREATE TRIGGER trg_label_stats_insert AFTER INSERT ON track_labels BEGIN %s END;" % _label_stats_sql("NEW", "+"),
+        "CREATE TRIGGER trg_label_stats_delete AFTER DELETE ON track_labels BEGIN %s END;" % _label_stats_sql("OLD", "-"),
+        "CREATE TRIGGER trg_label_stats_update AFTER UPDATE ON track_labels BEGIN %s %s END;" % (
+            _label_stats_sql("OLD", "-"), _label_stats_sql("NEW", "+")),
+        "CREATE TRIGGER trg_label_stats_names AFTER DELETE ON label_names BEGIN DELETE FROM label_stats WHERE label_id = OLD.id; END;",
+        # Tracks deleted, undeleted or inserted over stale labels.
+        "CREATE TRIGGER trg_label_stats_tracks_insert AFTER INSERT ON tracks WHEN NEW.weight > 0 BEGIN UPDATE label_stats SET live = live + 1 WHERE label_id IN (SELECT label_id FROM track_labels WHERE track_id = NEW.id); END;",
+        "CREATE TRIGGER trg_label_stats_tracks_update AFTER UPDATE OF weight ON tracks WHEN COALESCE(OLD.weight > 0, 0) <> COALESCE(NEW.weight > 0, 0) BEGIN UPDATE label_stats SET live = live + (CASE WHEN NEW.weight > 0 THEN 1 ELSE -1 END) WHERE label_id IN (SELECT label_id FROM track_labels WHERE track_id = NEW.id); END;",
+        "CREATE TRIGGER trg_label_stats_tracks_delete AFTER DELETE ON tracks WHEN OLD.weight > 0 BEGIN UPDATE label_stats SET live = live - 1 WHERE label_id IN (SELECT label_id FROM track_labels WHERE track_id = OLD.id); END;",
+    ]),
+    (9, "maintenance job log", [
+        # Last run of every job in ardj.maintenance.JOBS.
+        "CREATE TABLE maintenance_jobs (name TEXT PRIMARY KEY, status TEXT NOT NULL, ts INTEGER NOT NULL, duration REAL, error TEXT);",
+    ]),
 ]
 
+# Queries that must use indexes, see explain_queries().
+HOT_QUERIES = [
+    ("picker: candidate index", "SELECT track_id, label FROM labels WHERE track_id IN (?, ?)", (1, 2)),
+    ("picker: track labels", "SELECT label FROM labels WHERE track_id = ?", (1, )),
+    ("picker: tracks by label", "SELECT id FROM tracks WHERE weight > 0 AND id IN (SELECT track_id FROM labels WHERE label = ?)", ("music", )),
+    ("picker: recent artists", "SELECT artist, last_played FROM tracks WHERE artist IS NOT NULL AND last_played IS NOT NULL ORDER BY last_played DESC LIMIT 10", ()),
+    ("scrobbler: last.fm backlog", "SELECT t.artist, t.title, p.ts FROM tracks t INNER JOIN playlog p ON p.track_id = t.id WHERE p.lastfm = 0 AND t.weight > 0 AND t.length > 60 ORDER BY p.ts", ()),
+    ("scrobbler: libre.fm backlog", "SELECT t.artist, t.title, p.ts FROM tracks t INNER JOIN playlog p ON p.track_id = t.id WHERE p.librefm = 0 AND t.weight > 0 AND t.length > 60 ORDER BY p.ts", ()),
+    ("votes: last vote per user", "SELECT email, vote FROM votes WHERE track_id = ? ORDER BY email, ts", (1, )),
+    ("search: by artist", "SELECT id FROM tracks WHERE weight > 0 AND artist = ?", ("somebody", )),
+    ("search: text", "SELECT t.id FROM track_search s INNER JOIN tracks t ON t.id = s.rowid WHERE track_search MATCH ? AND t.weight > 0 ORDER BY bm25(track_search, 10.0, 5.0, 1.0)", ('"somebody"*', )),
+    ("search: by download url", "SELECT id FROM tracks WHERE download = ?", ("http://example.com/", )),
+    ("labels: orphans", "SELECT id FROM tracks WHERE weight > 0 AND id NOT IN (SELECT track_id FROM track_labels WHERE label_id IN (SELECT id FROM label_names WHERE name IN (SELECT value FROM json_each(?))))", ('["music"]', )),
+]
+
+# First pause before retrying a transaction on a busy database, doubles on
+# every attempt.
+TRANSACTION_RETRY_DELAY = 0.1
+
+# Per transaction name: count, failed, retries, wait and hold times (total,
+# max), in seconds.  Filled by database.transaction().
+transaction_stats = {}
+_transaction_stats_lock = threading.Lock()
+
+
+def record_transaction(name, wait, hold, retries, failed=False):
+    with _transaction_stats_lock:
+        item = transaction_stats.get(name)
+        if item is None:
+            item = transaction_stats[name] = {"count": 0, "failed": 0, "retries": 0,
+                                              "wait": 0.0, "max_wait": 0.0,
+                                              "hold": 0.0, "max_hold": 0.0}
+        item["count"] += 1
+        item["failed"] += int(failed)
+        item["retries"] += retries
+        item["wait"] += wait
+        item["max_wait"] = max(item["max_wait"], wait)
+        item["hold"] += hold
+        item["max_hold"] = max(item["max_hold"], hold)
+
+    if hold * 1000 >= ardj.settings.get_int("database_slow_transaction_ms", 500):
+        logging.warning("Transaction %s held the database for %.3f seconds." % (name, hold))
+
+
+# Change log entries older than this are deleted by purge().
+TRACK_CHANGES_TTL = 7 * 86400
+
+# Tracks which last.fm did not find are tried again after this many seconds.
+LASTFM_RETRY_DELAY = 7 * 86400
+
+# Applied to every new connection, can be changed with the database_pragmas
+# setting.  WAL lets readers (the picker) work while another process writes.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -16000,
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "memory",
+    "busy_timeout": 10000,
+}
+
+
+def get_pragmas():
+    """Returns the PRAGMA profile, defaults updated with settings."""
+    pragmas = dict(DEFAULT_PRAGMAS)
+    pragmas.update(ardj.settings.get("database_pragmas", None) or {})
+    return pragmas
+
+
+class Record(tuple):
+    """A read-only row, also accessible by field name like a dictionary.
+
+    Subclasses are created by Model.record_type()."""
+    __slots__ = ()
+    fields = ()
+    positions = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self.positions[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def get(self, key, default=None):
+        pos = self.positions.get(key)
+        if pos is None:
+            return default
+        return tuple.__getitem__(self, pos)
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return list(zip(self.fields, self))
+
+    def as_dict(self):
+        return dict(zip(self.fields, self))
+
+
+# Generated SQL, by (class, kind).
+_sql_cache = {}
+
 
 class Model(dict):
     table_name = None
@@ -102,18 +358,69 @@ class Model(dict):
 
     @classmethod
     def get_by_id(cls, id):
-        fields_sql = ", ".join(cls.fields)
-        sql = "SELECT %s FROM %s WHERE %s = ?" % (
-            fields_sql, cls.table_name, cls.key_name)
+        sql = cls._get_sql("get_by_id", lambda: "SELECT %s FROM %s WHERE %s = ?" % (
+            cls._fields_sql(), cls.table_name, cls.key_name))
         row = fetchone(sql, (id, ))
         if row is not None:
             return cls._from_row(row)
 
     @classmethod
     def find_all(cls):
-        fields_sql = ", ".join(cls.fields)
-        sql = "SELECT %s FROM %s" % (fields_sql, cls.table_name)
-        return cls._fetch_rows(sql, ())
+        return cls._fetch_rows(cls._select_sql(), ())
+
+    @classmethod
+    def iter_all(cls):
+        """Yields all records, see _iter_rows()."""
+        return cls._iter_rows(cls._select_sql())
+
+    @classmethod
+    def record_type(cls):
+        """Returns the compact read-only record class for this model."""
+        key = (cls, "record")
+        rtype = _sql_cache.get(key)
+        if rtype is None:
+            rtype = _sql_cache[key] = type(cls.__name__ + "Record", (Record, ), {
+                "__slots__": (),
+                "fields": tuple(cls.fields),
+                "positions": dict((name, idx) for idx, name in enumerate(cls.fields)),
+            })
+        return rtype
+
+    @classmethod
+    def _iter_rows(cls, sql, params=()):
+        """Yields records one by one as they are read from the cursor.
+
+        Records are read-only tuples with dictionary style access (see
+        Record), use find_all() etc when you need to modify them."""
+        rtype = cls.record_type()
+        db = Open()
+        profiler = getattr(db, "profiler", None)
+        cur = db.db.cursor()
+        try:
+            if profiler is None:
+                cur.execute(sql, params)
+                for row in cur:
+                    yield rtype(row)
+                return
+
+            # Time spent by the caller between records doesn't count.
+            ts = time.perf_counter()
+            elapsed, count = 0.0, 0
+            try:
+                cur.execute(sql, params)
+                elapsed = time.perf_counter() - ts
+                while True:
+                    ts = time.perf_counter()
+                    row = cur.fetchone()
+                    elapsed += time.perf_counter() - ts
+                    if row is None:
+                        break
+                    count += 1
+                    yield rtype(row)
+            finally:
+                profiler.record(db, sql, params, elapsed, count)
+        finally:
+            cur.close()
 
     @classmethod
     def _fetch_rows(cls, sql, params):
@@ -122,12 +429,26 @@ class Model(dict):
 
     @classmethod
     def _from_row(cls, row):
-        pairs = [(name, row[idx]) for idx, name in enumerate(cls.fields)]
-        return cls(dict(pairs))
+        return cls(zip(cls.fields, row))
+
+    @classmethod
+    def _get_sql(cls, kind, build):
+        """Returns generated SQL, building it on first use."""
+        key = (cls, kind)
+        sql = _sql_cache.get(key)
+        if sql is None:
+            sql = _sql_cache[key] = build()
+        return sql
 
     @classmethod
     def _fields_sql(cls):
-        return ", ".join(cls.fields)
+        return cls._get_sql("fields", lambda: ", ".join(cls.fields))
+
+    @classmethod
+    def _select_sql(cls):
+        """Returns "SELECT fields FROM table", without conditions."""
+        return cls._get_sql("select", lambda: "SELECT %s FROM %s" % (
+            cls._fields_sql(), cls.table_name))
 
     @classmethod
     def delete_all(cls):
@@ -149,11 +470,9 @@ class Model(dict):
             fields = self.fields
         else:
             fields = [f for f in self.fields if f != self.key_name]
-        fields_sql = ", ".join(fields)
-        params_sql = ", ".join(["?"] * len(fields))
 
-        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
-            self.table_name, fields_sql, params_sql)
+        sql = self._get_sql("insert_key" if with_key else "insert", lambda: "INSERT INTO %s (%s) VALUES (%s)" % (
+            self.table_name, ", ".join(fields), ", ".join(["?"] * len(fields))))
         params = [self.get(field) for field in fields]
 
         self[self.key_name] = execute(sql, params)
@@ -161,10 +480,9 @@ class Model(dict):
 
     def _update(self):
         fields = [f for f in self.fields if f != self.key_name]
-        fields_sql = ", ".join(["%s = ?" % field for field in fields])
 
-        sql = "UPDATE %s SET %s WHERE %s = ?" % (
-            self.table_name, fields_sql, self.key_name)
+        sql = self._get_sql("update", lambda: "UPDATE %s SET %s WHERE %s = ?" % (
+            self.table_name, ", ".join(["%s = ?" % field for field in fields]), self.key_name))
         params = [self.get(field) for field in fields] + [self[self.key_name]]
 
         return execute(sql, params)
@@ -227,11 +545,19 @@ class Track(Model):
     @classmethod
     def find_all(cls, deleted=False):
         """Returns all tracks with positive weight."""
-        sql = "SELECT %s FROM %s" % (cls._fields_sql(), cls.table_name)
+        sql = cls._select_sql()
         if not deleted:
             sql += " WHERE weight > 0"
         return cls._fetch_rows(sql, ())
 
+    @classmethod
+    def iter_all(cls, deleted=False):
+        """Same as find_all(), but yields read-only records lazily."""
+        sql = cls._select_sql()
+        if not deleted:
+            sql += " WHERE weight > 0"
+        return cls._iter_rows(sql)
+
     @classmethod
     def find_by_tag(cls, tag):
         """Returns tracks that have a specific tag."""
@@ -239,6 +565,14 @@ class Track(Model):
             cls._fields_sql(), cls.table_name)
         return cls._fetch_rows(sql, (tag, ))
 
+    @classmethod
+    def iter_by_tag(cls, tag):
+        """Same as find_by_tag(), but yields read-only records lazily, sorted
+        by artist and title."""
+        sql = "SELECT %s FROM %s WHERE weight > 0 AND id IN (SELECT track_id FROM labels WHERE label = ?) ORDER BY artist, title" % (
+            cls._fields_sql(), cls.table_name)
+        return cls._iter_rows(sql, (tag, ))
+
     @classmethod
     def find_by_url(cls, url):
         """Returns all tracks with the specified download URL."""
@@ -280,9 +614,9 @@ class Track(Model):
 
     @classmethod
     def find_tags(cls, min_count=5, cents=100):
-        sql = "SELECT label, COUNT(*) FROM labels WHERE track_id IN (SELECT id FROM tracks WHERE weight > 0) GROUP BY label ORDER BY label"
+        rows = Label.get_counts(min_count)
         rows = [
-            row for row in fetch(sql) if row[1] >= min_count and ":" not in row[0] and len(
+            tuple(row) for row in rows if ":" not in row[0] and len(
                 row[0]) > 1]
         return rows
 
@@ -299,13 +633,8 @@ class Track(Model):
             raise TypeError("Labels must be a list.")
 
         execute("DELETE FROM labels WHERE track_id = ?", (self["id"], ))
-        for tag in list(set(labels)):
-            execute(
-                "INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)",
-                (self["id"],
-                 tag,
-                 "unknown",
-                 ))
+        bulk_insert("labels", ("track_id", "label", "email"),
+                    [(self["id"], tag, "unknown") for tag in set(labels)])
 
         logging.debug(
             ("New labels for track %u: %s" %
@@ -342,6 +671,8 @@ class Track(Model):
                 "SELECT ROUND(length / 60) AS r, COUNT(*) FROM tracks GROUP BY r"):
             s_prc += prc * qty
             s_qty += qty
+        if not s_qty:
+            return 0
         return int(s_prc / s_qty * 60 * 1.5)
 
     def get_votes(self):
@@ -462,11 +793,18 @@ class Label(Model):
             "DELETE FROM `%s` WHERE `label` = ?" %
             cls.table_name, (name, ))
 
+    @classmethod
+    def get_counts(cls, min_count=1):
+        """Returns (label, count) tuples for labels that have at least
+        min_count live tracks, sorted by label.  Reads label_stats, so takes
+        time proportional to the number of labels, not tracks."""
+        return fetch(
+            "SELECT n.name, s.live FROM label_stats s INNER JOIN label_names n ON n.id = s.label_id WHERE s.live >= ? ORDER BY n.name",
+            (max(min_count, 1), ))
+
     @classmethod
     def find_all_names(cls):
-        rows = fetch(
-            "SELECT DISTINCT label FROM labels WHERE track_id IN (SELECT id FROM tracks WHERE weight > 0) ORDER BY label")
-        return [r[0] for r in rows]
+        return [r[0] for r in cls.get_counts()]
 
     @classmethod
     def find_never_played_names(cls):
@@ -493,6 +831,10 @@ class Label(Model):
 
     @classmethod
     def query_names(cls, playlist=None, artist=None):
+        if playlist == "all" and (not artist or artist == "All artists"):
+            return fetchcol(
+                "SELECT n.name FROM label_stats s INNER JOIN label_names n ON n.id = s.label_id WHERE s.total > 0 ORDER BY n.name") or []
+
         sql = "SELECT DISTINCT label FROM labels WHERE 1"
         params = []
 
@@ -577,21 +919,72 @@ class database:
     def __init__(self, filename):
         """
         Opens the database, creates tables if necessary.
+
+        Every thread gets its own connection (and transaction), opened on
+        first use.  The connection for the current thread is opened right
+        away, to report errors early.
         """
         self.filename = filename
-        isnew = not os.path.exists(self.filename)
+        self.generation = 0
+        self.local = threading.local()
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.local.conn = self.connect()
+
+    def __del__(self):
+        for conn in self.connections.values():
+            try:
+                conn.commit()
+            except Exception:
+                pass
+        logging.debug('Database closed.')
+
+    @property
+    def db(self):
+        """Returns the connection for the current thread."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def open_connection(self):
+        return sqlite.connect(self.filename, check_same_thread=False)
+
+    def get_pragmas(self):
+        return get_pragmas()
+
+    def connect(self):
         try:
-            self.db = sqlite.connect(self.filename, check_same_thread=False)
+            conn = self.open_connection()
         except Exception as e:
-            logging.error('Could not open database %s: %s' % (filename, e))
+            logging.error('Could not open database %s: %s' % (self.filename, e))
             raise
 
-        self.db.create_collation('UNICODE', ardj.util.ucmp)
-        self.db.create_function('ULIKE', 2, self.sqlite_ulike)
-
-    def __del__(self):
-        self.commit()
-        logging.debug('Database closed.')
+        for k, v in sorted(self.get_pragmas().items()):
+            try:
+                conn.execute("PRAGMA %s = %s" % (k, v))
+            except OperationalError as e:
+                logging.warning("Could not set database option %s: %s" % (k, e))
+
+        conn.create_collation('UNICODE', ardj.util.ucmp)
+        conn.create_function('ULIKE', 2, self.sqlite_ulike)
+
+        with self.lock:
+            # Connections of finished threads are closed, which rolls back
+            # whatever they did not commit.
+            for thread in [t for t in self.connections if not t.is_alive()]:
+                self.connections.pop(thread).close()
+            self.connections[threading.current_thread()] = conn
+        return conn
+
+    def close(self):
+        """Commits and closes connections of all threads."""
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for conn in connections.values():
+            conn.commit()
+            conn.close()
+        self.local = threading.local()
 
     @classmethod
     def get_instance(cls):
@@ -601,6 +994,8 @@ class database:
             if filename is None:
                 raise Exception('Config option database/local not set.')
             cls.instance = cls(filename)
+            if ardj.settings.get("database_profile", False):
+                ardj.profiler.enable(cls.instance)
         return cls.instance
 
     def sqlite_ulike(self, a, b):
@@ -617,13 +1012,85 @@ class database:
         return self.db.cursor()
 
     def commit(self):
-        """Commits current transaction, for internal use. """
+        """Commits current transaction, for internal use.  Within
+        transaction() does nothing, the transaction is committed when it
+        ends."""
+        if getattr(self.local, "depth", 0):
+            return
         self.db.commit()
 
+    @contextlib.contextmanager
+    def transaction(self, name="transaction"):
+        """Runs a unit of work in a write transaction.
+
+        Starts with BEGIN IMMEDIATE, so the write lock is taken at once or
+        not at all; when the database is busy, retries with a growing pause.
+        Commits when the block ends, rolls back on exceptions.  Nested calls
+        join the outer transaction.  Timing is collected in
+        transaction_stats, slow transactions are logged.
+
+        Example:
+
+        with db.transaction("vote"):
+            db.execute(...)
+        """
+        depth = getattr(self.local, "depth", 0)
+        if depth:
+            self.local.depth = depth + 1
+            try:
+                yield self
+            finally:
+                self.local.depth = depth
+            return
+
+        conn = self.db
+        if conn.in_transaction:
+            # Something was changed outside of a transaction block, that
+            # work belongs to this thread and would be committed anyway.
+            logging.debug("Committing pending changes before transaction %s." % name)
+            conn.commit()
+
+        ts = time.perf_counter()
+        retries = 0
+        delay = TRANSACTION_RETRY_DELAY
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if retries >= ardj.settings.get_int("database_lock_retries", 3):
+                    record_transaction(name, time.perf_counter() - ts, 0, retries, failed=True)
+                    raise
+                retries += 1
+                logging.warning("Database busy, retrying transaction %s in %.2f seconds." % (name, delay))
+                time.sleep(delay)
+                delay *= 2
+
+        started = time.perf_counter()
+        self.local.depth = 1
+        try:
+            yield self
+        except BaseException:
+            self.local.depth = 0
+            self.rollback()
+            record_transaction(name, started - ts, time.perf_counter() - started, retries, failed=True)
+            raise
+        self.local.depth = 0
+        conn.commit()
+        record_transaction(name, started - ts, time.perf_counter() - started, retries)
+
     def rollback(self):
         """Cancel pending changes."""
         logging.debug("Rolling back a transaction.")
-        self.db.rollback()
+        conn = self.db
+        changed = conn.in_transaction
+        conn.rollback()
+        # Lets in-memory caches know that what they've read can be gone.
+        # Nothing is gone if there was no transaction.
+        if changed:
+            self.generation += 1
 
     def fetch(self, sql, params=None):
         return self.execute(sql, params, fetch=True)
@@ -647,6 +1114,43 @@ class database:
         finally:
             cur.close()
 
+    def execute_many(self, sql, rows):
+        """Runs the statement once for every parameter tuple.
+
+        All rows are sent with one executemany() call inside a savepoint, so
+        either all of them are applied or none.  Like execute(), does not
+        commit.  Returns the number of affected rows."""
+        cur = self.db.cursor()
+        try:
+            if not self.db.in_transaction:
+                cur.execute("BEGIN")
+            cur.execute("SAVEPOINT execute_many")
+            try:
+                cur.executemany(sql, rows)
+                rowcount = cur.rowcount
+            except BaseException:
+                cur.execute("ROLLBACK TO execute_many")
+                raise
+            finally:
+                cur.execute("RELEASE execute_many")
+            return rowcount
+        except BaseException:
+            logging.exception(f"Failed SQL statement: {sql}")
+            raise
+        finally:
+            cur.close()
+
+    def bulk_insert(self, table, columns, rows):
+        """Inserts many rows at once, see execute_many().
+
+        Example:
+
+        db.bulk_insert('labels', ('track_id', 'label', 'email'), [(1, 'music', 'ardj')])
+        """
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+        return self.execute_many(sql, rows)
+
     def update(self, table, args):
         """Performs update on a label.
 
@@ -692,103 +1196,124 @@ class database:
             'DELETE FROM queue WHERE track_id NOT IN (SELECT id FROM tracks)')
         self.execute(
             'DELETE FROM labels WHERE track_id NOT IN (SELECT id FROM tracks)')
+        self.execute(
+            'DELETE FROM label_names WHERE id NOT IN (SELECT label_id FROM track_labels)')
+        self.execute(
+            'DELETE FROM label_owners WHERE id NOT IN (SELECT owner_id FROM track_labels)')
         self.execute(
             'DELETE FROM votes WHERE track_id NOT IN (SELECT id FROM tracks)')
-        for table in ('playlists', 'tracks', 'queue',
-                      'urgent_playlists', 'labels', 'karma'):
+        self.execute(
+            'DELETE FROM lastfm_loves WHERE track_id NOT IN (SELECT id FROM tracks)')
+        self.execute('DELETE FROM label_stats')
+        self.execute(LABEL_STATS_REBUILD)
+        self.execute(
+            'DELETE FROM track_changes WHERE ts < ?', (int(time.time()) - TRACK_CHANGES_TTL, ))
+        # Labels is a view, the planner uses the tables behind it.
+        for table in ('playlists', 'tracks', 'queue', 'urgent_playlists',
+                      'track_labels', 'label_names', 'label_owners',
+                      'label_stats', 'karma'):
             self.execute('ANALYZE ' + table)
         logging.info('%u bytes saved after database purge.' %
                      (os.stat(self.filename).st_size - old_size))
 
     def mark_hitlist(self):
-        """Marks best tracks with the "hitlist" label.
-
-        Only processes tracks labelled with "music".  Before applying the
-        label, removes it from the tracks that have it already."""
-        set_label, check_label = 'hitlist', 'music'
-
-        self.execute('DELETE FROM labels WHERE label = ?', (set_label, ))
-
-        weight = fetchone(
-            'SELECT real_weight FROM tracks WHERE id IN (SELECT track_id FROM labels WHERE label = ?) ORDER BY real_weight DESC LIMIT 19, 1',
-            (check_label,
-             ))
-        if weight:
-            self.execute(
-                'INSERT INTO labels (track_id, label, email) SELECT id, ?, ? FROM tracks WHERE real_weight >= ? AND id IN (SELECT track_id FROM labels WHERE label = ?)',
-                (set_label,
-                 'ardj',
-                 weight[0],
-                    check_label,
-                 ))
-
-            lastfm = ardj.scrobbler.LastFM()
-            lastfm.authorize()
+        """Marks best tracks with the "hitlist" label, see ardj.computed.
+
+        Then updates last.fm loves, see sync_lastfm_loves()."""
+        ardj.computed.update(["hitlist"])
+        self.sync_lastfm_loves([row[0] for row in self.fetch(
+            "SELECT track_id FROM labels WHERE label = 'hitlist'")])
+
+    def get_pending_loves(self, track_ids):
+        """Returns (track_id, love) pairs for tracks whose last.fm state
+        differs from the wanted one: tracks to love (listed in track_ids)
+        and to unlove (loved before, but not listed)."""
+        track_ids = set(track_ids)
+        retry = int(time.time()) - LASTFM_RETRY_DELAY
+        state = dict((row[0], row[1:]) for row in self.fetch(
+            'SELECT track_id, loved, ts, error FROM lastfm_loves'))
+
+        pending = []
+        for track_id in sorted(track_ids | set(state)):
+            want = track_id in track_ids
+            if track_id not in state:
+                if want:
+                    pending.append((track_id, True))
+                continue
+            loved, ts, error = state[track_id]
+            if bool(loved) != want:
+                # A track that could not be loved needs no unloving.
+                if want or error is None:
+                    pending.append((track_id, want))
+            elif error is not None and ts < retry:
+                pending.append((track_id, want))
+        return pending
+
+    def sync_lastfm_loves(self, track_ids):
+        """Loves the tracks on last.fm, unloves the ones that were loved
+        before but are not listed any more.
+
+        The result of every call is stored in lastfm_loves, so tracks that
+        did not change are not sent again.  Tracks that could not be sent
+        (unknown to last.fm, no artist or title, other errors) are retried
+        after LASTFM_RETRY_DELAY.  Network and authorization errors stop the
+        sync, the remaining tracks are sent on the next run."""
+        pending = self.get_pending_loves(track_ids)
+        if not pending:
+            return
+
+        lastfm = ardj.scrobbler.LastFM()
+        if not lastfm.authorize() or not lastfm.sk:
+            logging.debug("Not sending %u loves to last.fm: not authorized." % len(pending))
+            return
+
+        for track_id, love in pending:
+            rows = self.fetch('SELECT artist, title FROM tracks WHERE id = ?', (track_id, ))
+            if not rows:
+                with self.transaction("lastfm love"):
+                    self.execute('DELETE FROM lastfm_loves WHERE track_id = ?', (track_id, ))
+                continue
 
-            for artist, title in self.fetch(
-                    'SELECT t.artist, t.title FROM tracks t INNER JOIN labels l ON l.track_id = t.id WHERE l.label = ?', (set_label, )):
-                lastfm.love(artist, title)
+            artist, title = rows[0]
+            error = None
+            if not artist or not title:
+                error = "No artist or title"
+            else:
+                try:
+                    if love:
+                        ok = lastfm.love(artist, title)
+                    else:
+                        ok = lastfm.unlove(artist, title)
+                except (ardj.scrobbler.BadAuth, ardj.scrobbler.NetworkError) as e:
+                    logging.error("Could not sync loves with last.fm: %s" % e)
+                    break
+                except Exception as e:
+                    logging.error("Could not send love for track %u to last.fm: %s" % (track_id, e))
+                    error = str(e) or type(e).__name__
+                else:
+                    if not ok:
+                        break
+
+            with self.transaction("lastfm love"):
+                self.execute('INSERT OR REPLACE INTO lastfm_loves (track_id, loved, ts, error) VALUES (?, ?, ?, ?)',
+                             (track_id, int(love), int(time.time()), error))
 
     def mark_recent_music(self):
-        """Marks last 100 tracks with "recent"."""
-        self.execute('DELETE FROM labels WHERE label = ?', ('recent', ))
-        self.execute(
-            'INSERT INTO labels (track_id, label, email) SELECT id, ?, ? FROM tracks WHERE id IN (SELECT track_id FROM labels WHERE label = ?) ORDER BY id DESC LIMIT 100',
-            ('recent',
-             'ardj',
-             'music',
-             ))
-
-        self.execute('DELETE FROM labels WHERE label = ?', ('fresh', ))
-        self.execute(
-            'INSERT INTO labels (track_id, label, email) SELECT id, ?, ? FROM tracks WHERE count < 10 AND weight > 0 AND id IN (SELECT track_id FROM labels WHERE label = ?)',
-            ('fresh',
-             'ardj',
-             'music',
-             ))
+        """Marks last 100 tracks with "recent", rarely played ones with
+        "fresh", see ardj.computed."""
+        ardj.computed.update(["recent", "fresh"])
 
-        count = self.execute(
-            "SELECT COUNT(*) FROM labels WHERE label = ?", ('fresh', ))
+        count = self.fetch(
+            "SELECT COUNT(*) FROM labels WHERE label = ?", ('fresh', ))[0][0]
         print('Found %u fresh songs.' % count)
 
-    def mark_orphans(self, set_label='orphan', quiet=False):
-        """Labels orphan tracks with "orphan".
-
-        Orphans are tracks that don't belong to a playlist."""
-        used_labels = []
-        for playlist in ardj.settings.load().get_playlists():
-            if 'labels' in playlist:
-                labels = playlist['labels']
-            else:
-                labels = [playlist['name']]
-            used_labels += [l for l in labels if not l.startswith('-')]
-        used_labels = list(set(used_labels))
-
-        if not(used_labels):
-            logging.warning(
-                'Could not mark orphan tracks: no labels are used in playlists.yaml')
-            return False
-
-        self.execute('DELETE FROM labels WHERE label = ?', (set_label, ))
+    def mark_orphans(self):
+        """Labels orphan tracks with "orphan", see ardj.computed.
 
-        sql = 'SELECT id, artist, title FROM tracks WHERE weight > 0 AND id NOT IN (SELECT track_id FROM labels WHERE label IN (%s)) ORDER BY artist, title' % ', '.join([
-            '?'] * len(used_labels))
-        rows = self.fetch(sql, used_labels)
-
-        if rows:
-            if not quiet:
-                print('%u orphan tracks found:' % len(rows))
-            for row in rows:
-                if not quiet:
-                    print(
-                        '%8u; %s -- %s' %
-                        (row[0],
-                         (row[1] or 'unknown').encode('utf-8'),
-                            (row[2] or 'unknown').encode('utf-8')))
-                self.execute(
-                    'INSERT INTO labels (track_id, email, label) VALUES (?, ?, ?)', (int(
-                        row[0]), 'ardj', set_label))
-            return True
+        Orphans are tracks that don't belong to a playlist.  Returns False if
+        playlists use no labels.  To list orphans, use
+        Track.iter_by_tag("orphan")."""
+        return bool(ardj.computed.update(["orphan"]))
 
     def get_artist_names(self, label=None, weight=0):
         if label is None:
@@ -803,9 +1328,120 @@ class database:
         return [r[0] for r in rows]
 
 
+class replica(database):
+    """A read-only copy of the database, used by the web API so that its
+    reads don't compete with the writers.  Enabled with the webapi_replica
+    setting, which can be:
+
+    snapshot -- a copy of the database made with the SQLite backup API,
+    refreshed by refresh(), which the web server calls every
+    webapi_replica_interval seconds (60 by default).  The copy is stored in
+    webapi_replica_path, next to the database by default.
+
+    readonly -- read-only connections to the database itself.  With WAL
+    readers never block writers, the data is always fresh.
+
+    Write attempts fail with "attempt to write a readonly database".
+    """
+    instance = None
+
+    def __init__(self, primary, mode="snapshot", filename=None):
+        if mode not in ("snapshot", "readonly"):
+            raise ValueError("bad replica mode: %s" % mode)
+        self.primary = primary
+        self.mode = mode
+        self.updated = None
+        if mode == "readonly":
+            filename = primary
+        elif filename is None:
+            filename = primary + ".snapshot"
+        self.refresh_lock = threading.Lock()
+        if mode == "snapshot":
+            self.refresh(filename)
+        database.__init__(self, filename)
+
+    def open_connection(self):
+        return sqlite.connect("file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(self.filename)),
+                              uri=True, check_same_thread=False)
+
+    def get_pragmas(self):
+        # The journal is the primary's business.
+        pragmas = get_pragmas()
+        for k in ("journal_mode", "synchronous"):
+            pragmas.pop(k, None)
+        return pragmas
+
+    def refresh(self, filename=None):
+        """Copies the primary database to the snapshot.  Readers wait while
+        pages are copied, the primary is only read."""
+        if self.mode != "snapshot":
+            return
+        with self.refresh_lock:
+            ts = time.time()
+            src = sqlite.connect("file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(self.primary)), uri=True)
+            try:
+                dst = sqlite.connect(filename or self.filename)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
+            self.updated = ts
+            logging.debug("Database snapshot refreshed in %.3f seconds." % (time.time() - ts))
+
+    def get_age(self):
+        """Returns the age of the data in seconds, 0 for live data."""
+        if self.updated is None:
+            return 0
+        return max(0, time.time() - self.updated)
+
+    @classmethod
+    def get_instance(cls):
+        """Returns the configured replica, None if disabled."""
+        if cls.instance is None:
+            mode = ardj.settings.get("webapi_replica", None)
+            if not mode:
+                return None
+            primary = database.get_instance().filename
+            cls.instance = cls(primary, mode,
+                               ardj.settings.getpath("webapi_replica_path", None))
+        return cls.instance
+
+
+# Per-thread database override, see reading() and writing().
+_routing = threading.local()
+
+
 def Open(filename=None):
     """Returns the active database instance."""
-    return database.get_instance()
+    return getattr(_routing, "instance", None) or database.get_instance()
+
+
+@contextlib.contextmanager
+def reading():
+    """Sends queries of the current thread to the replica while active,
+    unless it's disabled.  Returns the replica or None."""
+    target = replica.get_instance()
+    saved = getattr(_routing, "instance", None)
+    _routing.instance = target
+    try:
+        yield target
+    finally:
+        _routing.instance = saved
+
+
+@contextlib.contextmanager
+def writing():
+    """Sends queries of the current thread to the main database while
+    active, e.g. for code called within reading() that must see or change
+    current data."""
+    saved = getattr(_routing, "instance", None)
+    _routing.instance = None
+    try:
+        yield
+    finally:
+        _routing.instance = saved
 
 
 def commit():
@@ -840,6 +1476,20 @@ def execute(*args, **kwargs):
     return Open().execute(*args, **kwargs)
 
 
+def transaction(name="transaction"):
+    """Runs a block in a short write transaction, see
+    database.transaction()."""
+    return Open().transaction(name)
+
+
+def execute_many(sql, rows):
+    return Open().execute_many(sql, rows)
+
+
+def bulk_insert(table, columns, rows):
+    return Open().bulk_insert(table, columns, rows)
+
+
 def init_database():
     logging.info("Checking database integrity...")
     db = Open()
@@ -851,6 +1501,71 @@ def init_database():
             logging.error("Init statement failed: %s" % statement)
             raise
     db.commit()
+    migrate()
+
+
+def migrate():
+    """Applies schema migrations which weren't applied yet.
+
+    Every migration runs in its own transaction, which also records the
+    version, so a failed migration leaves no trace and is tried again next
+    time.  Query plans of HOT_QUERIES that the migrations change are
+    logged."""
+    db = Open()
+    execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, ts INTEGER NOT NULL)")
+    db.commit()
+    applied = set(fetchcol("SELECT version FROM schema_migrations") or [])
+    pending = [m for m in MIGRATIONS if m[0] not in applied]
+    if not pending:
+        return
+
+    before = explain_queries(db.db)
+    for version, title, statements in pending:
+        logging.info("Applying database migration %u: %s." % (version, title))
+        cur = db.cursor()
+        statement = "BEGIN"
+        try:
+            # Without an explicit BEGIN, sqlite3 commits DDL statements
+            # one by one.
+            cur.execute("BEGIN")
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (version, ts) VALUES (?, ?)",
+                        (version, int(time.time())))
+            db.db.commit()
+        except BaseException:
+            logging.exception("Migration %u failed on: %s" % (version, statement))
+            db.rollback()
+            raise
+        finally:
+            cur.close()
+
+    for name, old, new in compare_plans(before, explain_queries(db.db)):
+        logging.info("Query plan for %s changed:\n  before: %s\n  after:  %s" % (
+            name, "; ".join(old), "; ".join(new)))
+
+
+def explain_queries(conn=None):
+    """Returns query plans for HOT_QUERIES, as (name, plan lines) tuples.
+    Uses the current connection unless another one is specified.  Queries
+    that can't run there (because of an older schema) have the error
+    message as the plan."""
+    conn = conn or Open().db
+    result = []
+    for name, sql, params in HOT_QUERIES:
+        try:
+            rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            result.append((name, [row[-1] for row in rows]))
+        except OperationalError as e:
+            result.append((name, ["error: %s" % e]))
+    return result
+
+
+def compare_plans(before, after):
+    """Returns (name, old plan, new plan) for queries whose plans differ."""
+    old = dict(before)
+    return [(name, old.get(name, []), plan) for name, plan in after
+            if old.get(name) != plan]
 
 
 def cmd_console(*args):
@@ -883,6 +1598,34 @@ def cmd_init():
     init_database()
 
 
+def cmd_explain(other=None):
+    """Show query plans for frequent queries, compared to another database
+    (e.g. a copy made before migrations) if specified"""
+    init_database()
+    plans = explain_queries()
+    if other is not None:
+        # Opened read-only, so that nothing is migrated there.
+        conn = sqlite.connect("file:%s?mode=ro" % other, uri=True)
+        try:
+            before = explain_queries(conn)
+        finally:
+            conn.close()
+        changed = dict((name, old) for name, old, new in compare_plans(before, plans))
+
+    for name, plan in plans:
+        print("%s:" % name)
+        if other is not None and name in changed:
+            print("  before:")
+            for line in changed[name]:
+                print("    %s" % line)
+            print("  after:")
+            for line in plan:
+                print("    %s" % line)
+        else:
+            for line in plan:
+                print("  %s" % line)
+
+
 def cmd_purge():
     """Delete stale data"""
     Open().purge()
@@ -891,9 +1634,7 @@ def cmd_purge():
 
 def cmd_stats():
     """Show database statistics"""
-    tracks = Track.find_all()
-    count = len(tracks)
-    length = sum([t.get("length", 0) for t in tracks])
+    count, length = fetchone("SELECT COUNT(*), IFNULL(SUM(length), 0) FROM tracks")
     print("%u tracks, %.1f hours." % (count, length / 60 / 60))
 
 
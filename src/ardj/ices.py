@@ -8,12 +8,14 @@ import logging
 import os
 
 from ardj.log import install as init_logging
+from ardj.lookahead import Lookahead, is_enabled as is_lookahead_enabled
 from ardj.tracks import get_track_to_play_next
 
 
 SONG_NUMBER = -1
 LAST_TRACK = None
 LAST_GOOD_FILE = None
+LOOKAHEAD = None
 
 
 def ices_init():
@@ -21,8 +23,14 @@ def ices_init():
     Function called to initialize your Python environment.
     Should return 1 if ok, and 0 if something went wrong.
     """
+    global LOOKAHEAD
+
     init_logging("ardj-ices")
     logging.info('Initializing.')
+
+    if is_lookahead_enabled():
+        logging.info('Lookahead enabled.')
+        LOOKAHEAD = Lookahead()
     return 1
 
 
@@ -42,7 +50,10 @@ def ices_get_next():
     """
     global LAST_TRACK, LAST_GOOD_FILE
 
-    LAST_TRACK = get_track_to_play_next()
+    if LOOKAHEAD is not None:
+        LAST_TRACK = LOOKAHEAD.get_next()
+    else:
+        LAST_TRACK = get_track_to_play_next()
 
     if LAST_TRACK and os.path.exists(LAST_TRACK["filepath"]):
         LAST_GOOD_FILE = LAST_TRACK["filepath"].encode("utf-8")
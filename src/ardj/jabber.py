@@ -16,6 +16,7 @@ import xmpp
 import ardj.console
 import ardj.database
 import ardj.log
+import ardj.profiler
 import ardj.settings
 import ardj.tracks
 import ardj.util
@@ -60,6 +61,8 @@ class MyFileReceivingBot(FileBot):
         finally:
             if tmpname is not None and os.path.exists(tmpname):
                 os.unlink(tmpname)
+            # No transaction here: it would keep the database locked while
+            # the files are being analyzed.
             ardj.database.Open().commit()
 
     def process_incoming_file(self, sender, filename):
@@ -128,11 +131,7 @@ class ardjbot(MyFileReceivingBot):
             ardj.tracks.do_idle_tasks(self.set_busy)
         except Exception as e:
             ardj.log.log_error("ERROR in jabber idle handlers: %s" % e, e)
-
-        try:
-            ardj.database.commit()
-        except Exception as e:
-            logging.error("Could not commit changes: %s." % e)
+            ardj.database.rollback()
 
         super(ardjbot, self).idle_proc()
 
@@ -272,7 +271,8 @@ class ardjbot(MyFileReceivingBot):
     def callback_message(self, conn, mess):
         """Extended message handler.
 
-        Adds an explicit database commit after all messages.
+        Commands run in their own transactions, see
+        ardj.console.process_command().
         """
         if self._handle_chat_room_message(mess):
             return
@@ -289,7 +289,6 @@ class ardjbot(MyFileReceivingBot):
                     "ERROR: %s, MESSAGE: %s" %
                     (e, mess.getBody().encode("utf-8")), e)
                 rep = str(e)
-            ardj.database.commit()
             if isinstance(rep, str):
                 self.send_simple_reply(mess, rep.strip())
             self.send_pending_messages()
@@ -318,16 +317,14 @@ class ardjbot(MyFileReceivingBot):
         """Sends all pending messages to the chat room or exact recipients.
         Messages are added to the queue using the chat_say() function."""
         try:
-            commit = False
+            # Messages are sent without holding the lock, deleted afterwards.
             for msg in ardj.database.Message.find_all():
                 if msg.get("re"):
                     self.say_to_jid(msg["re"], msg["message"])
                 else:
                     self.say_to_chat(msg["message"])
-                msg.delete()
-                commit = True
-            if commit:
-                ardj.database.commit()
+                with ardj.database.transaction("jabber message"):
+                    msg.delete()
         except Exception as e:
             ardj.log.log_error("Could not send pending messages: %s" % e, e)
 
@@ -384,16 +381,17 @@ def chat_say(message, recipient=None):
     """Adds a message to the chat room queue.  This is the only way for command
     handlers to notify chat users.  If the recipient is not specified, the
     message is sent to the chat room."""
-    ardj.database.execute(
-        "INSERT INTO jabber_messages (re, message) VALUES (?, ?)",
-        (recipient,
-         message,
-         ))
-    ardj.database.commit()
+    with ardj.database.transaction("chat_say"):
+        ardj.database.execute(
+            "INSERT INTO jabber_messages (re, message) VALUES (?, ?)",
+            (recipient,
+             message,
+             ))
 
 
 def cmd_run_bot(*args, **kwargs):
     """Run the jabber bot"""
+    ardj.profiler.save_on_exit()
     debug = "--debug" in args
     bot = Open(debug=debug)
     if bot is not None:
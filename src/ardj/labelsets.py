@@ -0,0 +1,203 @@
+# encoding=utf-8
+
+"""Label expressions evaluated over bitsets.
+
+Every label is stored as a Python integer used as a bitset, where bit N is set
+if track N has the label.  A label expression, as used in playlists, urgent
+playlists, sticky labels and searches, is a list of labels where:
+
+- plain labels are alternatives, at least one must be present,
+- labels prefixed with "+" are required,
+- labels prefixed with "-" are excluded.
+
+This turns into a union, an intersection and a difference of bitsets, all of
+which are done by the interpreter in C.  Compiled expressions remember their
+result along with versions of the labels they use, so an expression is only
+re-evaluated when one of its labels has changed.
+"""
+
+import itertools
+
+
+# Offsets of set bits in every byte value, for decoding bitsets.
+_BYTE_BITS = [tuple(bit for bit in range(8) if value & (1 << bit))
+              for value in range(256)]
+
+
+def from_ids(ids):
+    """Builds a bitset from a list of non-negative integers."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for item in ids:
+        buf[item >> 3] |= 1 << (item & 7)
+    return int.from_bytes(bytes(buf), "little")
+
+
+def to_ids(bits):
+    """Returns a sorted list of bits set in the bitset."""
+    if not bits:
+        return []
+    result = []
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for idx, value in enumerate(data):
+        if value:
+            base = idx << 3
+            result.extend([base + bit for bit in _BYTE_BITS[value]])
+    return result
+
+
+def count(bits):
+    return bin(bits).count("1")
+
+
+_serials = itertools.count(1)
+
+
+class LabelIndex(object):
+    """Bitsets of tracks, one per label, plus the set of all tracks."""
+
+    def __init__(self):
+        self.serial = next(_serials)
+        self.bits = {}
+        self.versions = {}
+        self.all = 0
+        self.all_version = 0
+
+    def load(self, tracks, labels):
+        """Builds the index from scratch.
+
+        Arguments:
+        tracks -- ids of all tracks.
+        labels -- a dictionary of label names and track id lists.
+        """
+        # A new serial number invalidates all cached results.
+        self.serial = next(_serials)
+        self.all = from_ids(tracks)
+        self.bits = {}
+        for label, ids in labels.items():
+            self.bits[label] = from_ids(ids)
+            self.versions[label] = self.versions.get(label, 0) + 1
+
+    def get(self, label):
+        return self.bits.get(label, 0)
+
+    def get_version(self, label):
+        return self.versions.get(label, 0)
+
+    # Versions only change when a bitset does, so that cached results of
+    # expressions survive updates that don't affect them, like a play.
+
+    def add_track(self, track_id):
+        if not self.all >> track_id & 1:
+            self.all |= 1 << track_id
+            self.all_version += 1
+
+    def remove_track(self, track_id):
+        if self.all >> track_id & 1:
+            self.all &= ~(1 << track_id)
+            self.all_version += 1
+
+    def add(self, label, track_id):
+        bits = self.bits.get(label, 0)
+        if not bits >> track_id & 1:
+            self.bits[label] = bits | (1 << track_id)
+            self.versions[label] = self.versions.get(label, 0) + 1
+
+    def remove(self, label, track_id):
+        bits = self.bits.get(label, 0)
+        if not bits >> track_id & 1:
+            return
+        bits &= ~(1 << track_id)
+        if bits:
+            self.bits[label] = bits
+        else:
+            self.bits.pop(label, None)
+        self.versions[label] = self.versions.get(label, 0) + 1
+
+    def update_track(self, track_id, old, new):
+        """Moves a track from one label set to another.  Either can be None
+        if the track was not or is no longer in the index."""
+        if new is not None:
+            self.add_track(track_id)
+        elif old is not None:
+            self.remove_track(track_id)
+        old, new = old or (), new or ()
+        for label in old:
+            if label not in new:
+                self.remove(label, track_id)
+        for label in new:
+            if label not in old:
+                self.add(label, track_id)
+
+    def names(self):
+        return list(self.bits.keys())
+
+
+class LabelExpression(object):
+    """A compiled label expression, see the module description."""
+
+    def __init__(self, labels):
+        self.labels = tuple(labels)
+        self.either = [l for l in labels if not l.startswith("-") and not l.startswith("+")]
+        self.neither = [l[1:] for l in labels if l.startswith("-")]
+        self.every = [l[1:] for l in labels if l.startswith("+")]
+        self.cache_key = None
+        self.cache = 0
+
+    def match(self, labels):
+        """Checks a single track's label set."""
+        if self.either and not any(l in labels for l in self.either):
+            return False
+        if any(l not in labels for l in self.every):
+            return False
+        if any(l in labels for l in self.neither):
+            return False
+        return True
+
+    def _get_key(self, index):
+        key = [index.get_version(l) for l in self.either + self.every + self.neither]
+        # Without alternatives we start with all tracks, which also changes.
+        if not self.either:
+            key.append(index.all_version)
+        return tuple(key)
+
+    def evaluate(self, index):
+        """Returns the bitset of matching tracks."""
+        key = (index.serial, self._get_key(index))
+        if key == self.cache_key:
+            return self.cache
+
+        if self.either:
+            bits = 0
+            for label in self.either:
+                bits |= index.get(label)
+        else:
+            bits = index.all
+
+        for label in self.every:
+            bits &= index.get(label)
+
+        for label in self.neither:
+            bits &= ~index.get(label)
+
+        self.cache_key, self.cache = key, bits
+        return bits
+
+
+_expressions = {}
+
+
+def compile(labels):
+    """Returns a compiled expression, reusing previously compiled ones."""
+    key = tuple(labels)
+    expr = _expressions.get(key)
+    if expr is None:
+        if len(_expressions) > 256:
+            _expressions.clear()
+        expr = _expressions[key] = LabelExpression(labels)
+    return expr
+
+
+__all__ = ["LabelIndex", "LabelExpression", "compile", "from_ids", "to_ids"]
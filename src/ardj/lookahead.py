@@ -0,0 +1,172 @@
+# encoding=utf-8
+
+"""Choosing the next track in advance.
+
+Normally a track is chosen when the source client (ezstream, ices) asks for
+it, which includes selection, reading tags from the file and a commit.  When
+that's slow, listeners hear silence.  With lookahead enabled, track N+1 is
+chosen in a background thread as soon as track N starts, and the request only
+has to write the prepared pick.
+
+A prepared pick is thrown away and the track is chosen the usual way when the
+queue, the urgent playlist, playlist.yaml or the set of active playlists has
+changed since it was prepared, or when a schedule boundary lies between the
+time it was prepared for and the time it is used.
+
+Only works in long running processes (ices, the next-track daemon).  To
+enable, set this in ardj.yaml:
+
+lookahead: yes
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import ardj.database
+import ardj.settings
+import ardj.tags
+import ardj.tracks
+
+
+def get_pick_state():
+    """Describes everything that invalidates a prepared pick."""
+    queue = ardj.database.fetchone("SELECT MAX(id), COUNT(*) FROM queue")
+    urgent = ardj.database.fetch("SELECT labels, expires FROM urgent_playlists ORDER BY expires")
+    return (tuple(queue), tuple(tuple(row) for row in urgent),
+            ardj.settings.get_playlists_mtime())
+
+
+def get_active_playlist_names(timestamp=None):
+    return [p.get("name") for p in ardj.tracks.Playlist.get_active(timestamp)]
+
+
+def is_enabled():
+    return ardj.settings.get("lookahead", False) in (True, "yes")
+
+
+class Lookahead(object):
+    """Prepares picks in a background thread.
+
+    Picks are made under self.lock, because the candidate index is shared
+    with the thread.  There is one worker thread, started on first use, so
+    there is one more database connection, open while the worker runs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None
+        self.state = None
+        self.active = None
+        self.boundary = None
+        self.requests = queue.Queue()
+        self.worker = None
+
+    def get_next(self):
+        """Returns the track to play now, see
+        tracks.get_track_to_play_next()."""
+        with self.lock:
+            pick = self.pop()
+            track = ardj.tracks.get_track_to_play_next(pick)
+
+        if track is not None and track.get("id"):
+            self.prepare(track.get("length"))
+        return track
+
+    def pop(self):
+        """Returns the prepared pick if it's still valid, None otherwise."""
+        pick, self.pending = self.pending, None
+        if pick is None:
+            return None
+
+        try:
+            if self.state != get_pick_state():
+                logging.info("Lookahead: queue, urgent playlist or playlists changed, picking again.")
+                return None
+
+            if self.boundary != ardj.tracks.Playlist.get_next_change():
+                logging.info("Lookahead: crossed a schedule boundary, picking again.")
+                return None
+
+            if self.active != get_active_playlist_names():
+                logging.info("Lookahead: active playlists changed, picking again.")
+                return None
+
+            if pick.track_id and not ardj.database.fetchone("SELECT 1 FROM tracks WHERE id = ? AND weight > 0 AND filename IS NOT NULL", (pick.track_id, )):
+                logging.info("Lookahead: track %s was deleted, picking again." % pick.track_id)
+                return None
+        except Exception as e:
+            logging.exception("Lookahead: could not check prepared pick: %s" % e)
+            return None
+
+        logging.debug("Lookahead: using prepared track %s." % pick.track_id)
+        return pick
+
+    def prepare(self, delay=None):
+        """Starts choosing the next track in background.  Returns an event
+        which is set when done.
+
+        Arguments:
+        delay -- seconds till the next track starts, usually the length of
+        the current one.
+        """
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._work, name="lookahead")
+            self.worker.daemon = True
+            self.worker.start()
+        done = threading.Event()
+        self.requests.put((time.time() + (delay or 0), done))
+        return done
+
+    def close(self):
+        """Stops the worker thread."""
+        if self.worker is not None:
+            self.requests.put(None)
+            self.worker.join()
+            self.worker = None
+
+    def _work(self):
+        while True:
+            request = self.requests.get()
+            # Only the latest request matters.
+            skipped = []
+            while request is not None and not self.requests.empty():
+                skipped.append(request[1])
+                request = self.requests.get()
+            for done in skipped:
+                done.set()
+            if request is None:
+                return
+
+            timestamp, done = request
+            try:
+                self._prepare(timestamp)
+            finally:
+                done.set()
+
+    def _prepare(self, timestamp):
+        with self.lock:
+            try:
+                ts = time.time()
+                state = get_pick_state()
+                active = get_active_playlist_names(timestamp)
+                boundary = ardj.tracks.Playlist.get_next_change(timestamp)
+
+                pick = ardj.tracks.select_next_track(timestamp)
+                if pick.track_id:
+                    track = ardj.tracks.Track.get_by_id(pick.track_id)
+                    if track is not None and track.get("filename"):
+                        pick.tags = ardj.tags.get(track.get_filepath())
+
+                self.pending, self.state, self.active = pick, state, active
+                self.boundary = boundary
+                logging.debug("Lookahead: prepared track %s in %.3f seconds." % (
+                    pick.track_id, time.time() - ts))
+            except Exception as e:
+                logging.exception("Lookahead: could not prepare a track: %s" % e)
+            finally:
+                # Nothing was written, but the read transaction must end.
+                ardj.database.commit()
+
+
+__all__ = ["Lookahead", "is_enabled"]
@@ -0,0 +1,256 @@
+# encoding=utf-8
+
+"""Nightly maintenance.
+
+Runs the daily jobs: computed labels, last.fm loves, the event schedule and
+database cleanup.  Every job declares the jobs it must run after, whether it
+talks to the network and whether it writes to the database.  Jobs run as
+soon as their dependencies are done, each in its own thread, so network
+requests don't hold up local work; jobs that write take the write lock and
+run one at a time.  If a job fails, the jobs that depend on it are skipped,
+the rest go on.
+
+Results are stored in the maintenance_jobs table.  Usage:
+
+    python3 -m ardj maintenance            # run all jobs
+    python3 -m ardj maintenance resume     # rerun failed and skipped jobs
+    python3 -m ardj maintenance offline    # skip network jobs
+    python3 -m ardj maintenance dry-run    # show the plan with timing
+    python3 -m ardj maintenance long purge # run some jobs only
+
+Jobs which are not selected count as done.
+"""
+
+import logging
+import threading
+import time
+
+import ardj.computed
+import ardj.database
+
+
+class Job(object):
+    """A maintenance job.
+
+    Arguments:
+    name -- job name.
+    func -- the function to call, commits its own changes.
+    after -- names of jobs that must finish first.
+    network -- True if the job needs network access.
+    writes -- True if the job must hold the write lock while running.
+    """
+
+    def __init__(self, name, func, after=(), network=False, writes=True):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.network = network
+        self.writes = writes
+
+
+def sync_lastfm_loves():
+    ardj.database.Open().sync_lastfm_loves(
+        ardj.database.fetchcol("SELECT track_id FROM labels WHERE label = 'hitlist'") or [])
+
+
+def update_schedule():
+    import ardj.tout
+    ardj.tout.update_schedule()
+
+
+def purge():
+    with ardj.database.transaction("purge"):
+        ardj.database.Open().purge()
+
+
+JOBS = [
+    Job("hitlist", lambda: ardj.computed.update(["hitlist"])),
+    Job("recent", lambda: ardj.computed.update(["recent", "fresh"])),
+    Job("long", lambda: ardj.computed.update(["long"])),
+    # Playlists may use the labels set by the previous jobs.
+    Job("orphan", lambda: ardj.computed.update(["orphan"]), after=("hitlist", "recent", "long")),
+    # Writes in short transactions of its own, one per track.
+    Job("lastfm-loves", sync_lastfm_loves, after=("hitlist", ), network=True, writes=False),
+    # Same, only the concert-soon labels are written.
+    Job("update-schedule", update_schedule, network=True, writes=False),
+    Job("purge", purge, after=("hitlist", "recent", "long", "orphan")),
+]
+
+
+def get_job(name):
+    for job in JOBS:
+        if job.name == name:
+            return job
+    raise KeyError("no such job: %s" % name)
+
+
+def get_last_results():
+    """Returns a dictionary of job names and (status, ts, duration, error)
+    of their last runs."""
+    rows = ardj.database.fetch("SELECT name, status, ts, duration, error FROM maintenance_jobs") or []
+    return dict((row[0], tuple(row[1:])) for row in rows)
+
+
+def record_result(job, status, ts, duration, error=None):
+    with ardj.database.transaction("maintenance"):
+        ardj.database.execute(
+            "INSERT OR REPLACE INTO maintenance_jobs (name, status, ts, duration, error) VALUES (?, ?, ?, ?, ?)",
+            (job.name, status, int(ts), duration, error))
+
+
+def select_jobs(names=None, resume=False, offline=False):
+    """Returns jobs to run."""
+    jobs = list(JOBS)
+    if names:
+        for name in names:
+            get_job(name)
+        jobs = [job for job in jobs if job.name in names]
+    if resume:
+        last = get_last_results()
+        jobs = [job for job in jobs if job.name not in last or last[job.name][0] != "ok"]
+    if offline:
+        jobs = [job for job in jobs if not job.network]
+    return jobs
+
+
+class Runner(object):
+    """Runs jobs in dependency order, in parallel where possible."""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.names = set(job.name for job in jobs)
+        self.status = {}
+        self.write_lock = threading.Lock()
+        self.cond = threading.Condition()
+
+    def is_ready(self, job):
+        return all(self.status.get(name) is not None for name in job.after if name in self.names)
+
+    def run(self):
+        """Runs all jobs, returns a dictionary of names and statuses: ok,
+        failed or skipped."""
+        pending = list(self.jobs)
+        threads = []
+        with self.cond:
+            while pending:
+                for job in [job for job in pending if self.is_ready(job)]:
+                    pending.remove(job)
+                    failed = [name for name in job.after if self.status.get(name) in ("failed", "skipped")]
+                    if failed:
+                        logging.warning("Maintenance job %s skipped: %s did not finish." % (job.name, ", ".join(failed)))
+                        self.status[job.name] = "skipped"
+                        record_result(job, "skipped", time.time(), None, "%s did not finish" % ", ".join(failed))
+                        continue
+                    self.status[job.name] = None
+                    thread = threading.Thread(target=self.run_job, args=(job, ), name="maintenance-" + job.name)
+                    thread.start()
+                    threads.append(thread)
+                if pending and not any(self.is_ready(job) for job in pending):
+                    self.cond.wait()
+
+        for thread in threads:
+            thread.join()
+        return self.status
+
+    def run_job(self, job):
+        lock = self.write_lock if job.writes else None
+        if lock is not None:
+            lock.acquire()
+        ts = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            logging.info("Maintenance job %s started." % job.name)
+            job.func()
+        except Exception as e:
+            logging.exception("Maintenance job %s failed: %s" % (job.name, e))
+            error = str(e) or type(e).__name__
+        finally:
+            if lock is not None:
+                lock.release()
+
+        duration = time.perf_counter() - started
+        status = "failed" if error else "ok"
+        logging.info("Maintenance job %s: %s in %.1f seconds." % (job.name, status, duration))
+        try:
+            record_result(job, status, ts, duration, error)
+        finally:
+            with self.cond:
+                self.status[job.name] = status
+                self.cond.notify()
+
+
+def plan(jobs, durations):
+    """Simulates a run using known job durations (seconds, missing ones
+    count as zero).  Returns (name, start, end) tuples and the total time."""
+    names = set(job.name for job in jobs)
+    finished = {}
+    running = []
+    pending = list(jobs)
+    lock_free_at = 0.0
+    now = 0.0
+    result = []
+
+    while pending or running:
+        for job in list(pending):
+            if not all(name in finished for name in job.after if name in names):
+                continue
+            start = max([now] + [finished[name] for name in job.after if name in names])
+            if job.writes:
+                start = max(start, lock_free_at)
+            end = start + (durations.get(job.name) or 0.0)
+            if job.writes:
+                lock_free_at = end
+            pending.remove(job)
+            running.append((end, job.name))
+            result.append((job.name, start, end))
+        if not running:
+            break
+        running.sort()
+        now, name = running.pop(0)
+        finished[name] = now
+
+    total = max([end for name, start, end in result] or [0.0])
+    return result, total
+
+
+def format_plan(jobs):
+    """Returns the dry run report: jobs, their last status and estimated
+    start and end times, based on last durations."""
+    last = get_last_results()
+    durations = dict((name, row[2]) for name, row in last.items())
+    steps, total = plan(jobs, durations)
+    times = dict((name, (start, end)) for name, start, end in steps)
+    serial = sum(durations.get(job.name) or 0.0 for job in jobs)
+
+    lines = ["job              after                          flags           last    start      end"]
+    for job in jobs:
+        flags = ",".join([f for f, on in (("network", job.network), ("writes", job.writes)) if on]) or "-"
+        start, end = times[job.name]
+        lines.append("%-16s %-30s %-15s %-7s %6.1f %8.1f" % (
+            job.name, ", ".join(job.after) or "-", flags,
+            last.get(job.name, ("never", ))[0], start, end))
+    lines.append("")
+    lines.append("Estimated time: %.1f seconds (%.1f if run one by one)." % (total, serial))
+    return "\n".join(lines)
+
+
+def cmd_maintenance(*args):
+    """Run nightly maintenance jobs"""
+    names = [arg for arg in args if arg not in ("dry-run", "resume", "offline")]
+    jobs = select_jobs(names, resume="resume" in args, offline="offline" in args)
+
+    if "dry-run" in args:
+        print(format_plan(jobs))
+        return
+
+    if not jobs:
+        print("Nothing to do.")
+        return
+
+    status = Runner(jobs).run()
+    for job in jobs:
+        print("%-16s %s" % (job.name, status.get(job.name)))
+
+
+__all__ = ["JOBS", "Job", "Runner", "cmd_maintenance", "get_job", "plan"]
@@ -0,0 +1,117 @@
+# encoding=utf-8
+
+"""The next-track daemon.
+
+ezstream runs a program every time it needs a new file.  Starting a Python
+interpreter, importing ardj.tracks with everything it pulls in, parsing the
+settings, opening the database and building the candidate index for every
+song is slow, so this daemon does that once and then serves file names over a
+Unix socket.  bin/ardj-next-track is the client; when the daemon is not
+running, it falls back to "python3 -m ardj next-track", but not once the
+request was sent: the pick may have been applied already.
+
+The protocol is one line per connection: the client sends "next", the daemon
+replies with the full path to the file to play (an empty line if there's
+nothing to play).  "ping" is answered with "pong".
+
+The socket is next-track.sock in the config folder, can be changed with the
+next_track_socket setting (the client reads ARDJ_NEXT_TRACK_SOCKET).
+"""
+
+import logging
+import os
+import signal
+import socketserver
+import sys
+import time
+
+import ardj.candidates
+import ardj.database
+import ardj.lookahead
+import ardj.profiler
+import ardj.settings
+import ardj.tracks
+
+
+def get_socket_path():
+    return ardj.settings.getpath(
+        "next_track_socket",
+        os.path.join(ardj.settings.get_config_dir(), "next-track.sock"))
+
+
+class PickerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode("utf-8").strip()
+        if command == "ping":
+            response = "pong"
+        elif command == "next":
+            response = self.server.get_next_file() or ""
+        else:
+            logging.warning("next-track daemon: unknown command: %s" % command)
+            response = ""
+        self.wfile.write((response + "\n").encode("utf-8"))
+
+
+class PickerServer(socketserver.UnixStreamServer):
+    """Serves one request at a time, so picks never overlap."""
+
+    def __init__(self, path):
+        self.lookahead = None
+        if ardj.lookahead.is_enabled():
+            logging.info("next-track daemon: lookahead enabled.")
+            self.lookahead = ardj.lookahead.Lookahead()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, PickerHandler)
+
+    def get_next_file(self):
+        ts = time.time()
+        try:
+            if self.lookahead is not None:
+                track = self.lookahead.get_next()
+            else:
+                track = ardj.tracks.get_track_to_play_next()
+        except Exception as e:
+            logging.exception("next-track daemon: could not pick a track: %s" % e)
+            ardj.database.rollback()
+            return None
+
+        logging.debug("next-track daemon: picked in %.3f seconds." % (time.time() - ts))
+        if track:
+            return track.get("filepath")
+
+
+def serve(path=None):
+    """Runs the daemon until interrupted."""
+    if path is None:
+        path = get_socket_path()
+
+    # Warm up: open the database and build the candidate index now, not when
+    # the first listener is waiting.
+    ardj.candidates.get_index()
+    ardj.database.commit()
+
+    # supervisord stops programs with SIGTERM, make sure the socket is removed.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    server = PickerServer(path)
+    logging.info("next-track daemon listening on %s" % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def cmd_serve(*args):
+    """Run the next-track daemon"""
+    ardj.profiler.save_on_exit()
+    ardj.database.init_database()
+    serve()
+
+
+__all__ = ["serve", "get_socket_path"]
@@ -0,0 +1,289 @@
+# encoding=utf-8
+
+"""SQL statement profiler.
+
+Shows which queries take the database time.  Enable it with this setting:
+
+    database_profile: yes
+
+Then every statement sent through ardj.database is timed, including records
+read by Model.iter_all() and similar (only time spent in SQLite counts).
+Schema migrations and query plan reports use the connection directly and
+are not profiled.  Statistics are
+kept per statement text, with literals and parameter lists normalised, so
+that "WHERE id IN (1, 2)" and "WHERE id IN (3, 4, 5)" are the same statement.
+Statements that take longer than database_slow_query_ms (100 by default) are
+logged with their query plan, once per statement.
+
+Every process writes its statistics to the db-profile folder (in the config
+folder) when it receives SIGUSR2, long running programs (the bot, the web
+server, the next-track daemon, the scrobbler, see save_on_exit()) also when
+they exit.  Short commands only log slow statements, otherwise there would be
+a file per run.  A running server or bot can be inspected with:
+
+    kill -USR2 <pid>
+    python3 -m ardj db-profile
+
+Only processes that are still running are counted; dumps of finished ones
+are listed as stale, "db-profile all" counts them too.  Stale dumps are
+deleted after a week.  Use "db-profile reset" to delete collected
+statistics.
+
+When the setting is off nothing is wrapped, so profiling costs nothing.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+import ardj.settings
+
+
+# Dumps of processes that are no longer running are deleted after this many
+# seconds.
+STALE_TTL = 7 * 86400
+
+# Set by long running programs, see save_on_exit().
+_save_on_exit = False
+_dump = None
+
+_spaces = re.compile(r"\s+")
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\bIN \(\?(?:, ?\?)+\)", re.I)
+
+
+def normalize(sql):
+    """Returns statement text with whitespace, literals and parameter lists
+    collapsed."""
+    sql = _spaces.sub(" ", sql.strip())
+    sql = _literals.sub("?", sql)
+    return _lists.sub("IN (?, ...)", sql)
+
+
+def get_folder():
+    return os.path.join(ardj.settings.get_config_dir(), "db-profile")
+
+
+class Profiler(object):
+    """Collects timing of statements run by a database instance."""
+
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold
+        self.stats = {}
+        self.explained = set()
+        self.started = int(time.time())
+        # Reentrant because dump() can be called by a signal handler while
+        # the same thread is inside record().
+        self.lock = threading.RLock()
+
+    def record(self, db, sql, params, elapsed, rows):
+        key = normalize(sql)
+        with self.lock:
+            item = self.stats.get(key)
+            if item is None:
+                item = self.stats[key] = {"count": 0, "total": 0.0, "max": 0.0, "rows": 0}
+            item["count"] += 1
+            item["total"] += elapsed
+            item["max"] = max(item["max"], elapsed)
+            item["rows"] += rows
+            slow = elapsed >= self.threshold and key not in self.explained
+            if slow:
+                self.explained.add(key)
+
+        if slow:
+            logging.warning("Slow SQL statement (%.1f ms): %s\n%s" % (
+                elapsed * 1000, sql, "\n".join(self.explain(db, sql, params))))
+
+    def explain(self, db, sql, params):
+        """Returns query plan lines.  Uses the connection directly, so that
+        the plan query is not profiled."""
+        try:
+            rows = db.db.execute("EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()
+        except Exception as e:
+            return ["  (no plan: %s)" % e]
+        return ["  " + row[-1] for row in rows]
+
+    def snapshot(self):
+        with self.lock:
+            return dict((k, dict(v)) for k, v in self.stats.items())
+
+    def dump(self, folder=None):
+        """Writes statistics to the profile folder, returns the file name."""
+        folder = folder or get_folder()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        filename = os.path.join(folder, "%u.json" % os.getpid())
+        data = {
+            "pid": os.getpid(),
+            "command": " ".join(sys.argv),
+            "started": self.started,
+            "dumped": int(time.time()),
+            "stats": self.snapshot(),
+        }
+        with open(filename + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.rename(filename + ".tmp", filename)
+        return filename
+
+
+def install(db, profiler):
+    """Wraps the execute methods of a database instance.  The wrappers are
+    instance attributes, so uninstall() only has to delete them."""
+    execute = db.execute
+    execute_many = db.execute_many
+
+    def profiled_execute(sql, params=None, fetch=False):
+        ts = time.perf_counter()
+        result = execute(sql, params, fetch)
+        rows = len(result) if fetch else 0
+        profiler.record(db, sql, params, time.perf_counter() - ts, rows)
+        return result
+
+    def profiled_execute_many(sql, rows):
+        ts = time.perf_counter()
+        result = execute_many(sql, rows)
+        profiler.record(db, sql, None, time.perf_counter() - ts, 0)
+        return result
+
+    db.execute = profiled_execute
+    db.execute_many = profiled_execute_many
+    db.profiler = profiler
+
+
+def uninstall(db):
+    for name in ("execute", "execute_many", "profiler"):
+        db.__dict__.pop(name, None)
+
+
+def enable(db):
+    """Starts profiling the database instance according to settings."""
+    threshold = float(ardj.settings.get("database_slow_query_ms", 100)) / 1000
+    global _dump
+    profiler = Profiler(threshold)
+    install(db, profiler)
+
+    def dump(*args):
+        try:
+            filename = profiler.dump()
+            logging.info("SQL profile written to %s" % filename)
+        except Exception as e:
+            logging.error("Could not write SQL profile: %s" % e)
+
+    _dump = dump
+    if _save_on_exit:
+        atexit.register(dump)
+    # Signal handlers can only be installed by the main thread.
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, dump)
+    logging.info("SQL profiling enabled, slow statement threshold %u ms." % (threshold * 1000))
+    return profiler
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to another user.
+        return True
+    return True
+
+
+def save_on_exit():
+    """Makes the profiler, if enabled now or later, save statistics when the
+    program exits.  Called by long running programs."""
+    global _save_on_exit
+    if _save_on_exit:
+        return
+    _save_on_exit = True
+    if _dump is not None:
+        atexit.register(_dump)
+
+
+def load(folder=None, stale=False):
+    """Reads and merges dumped statistics.  Returns a list of processes and
+    the merged statistics.
+
+    Processes that are no longer running are marked stale, their statistics
+    are only merged if stale is True.  Stale dumps older than STALE_TTL are
+    deleted."""
+    processes = []
+    stats = {}
+    for filename in sorted(glob.glob(os.path.join(folder or get_folder(), "*.json"))):
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warning("Could not read %s: %s" % (filename, e))
+            continue
+
+        data["stale"] = not is_running(data["pid"])
+        if data["stale"] and data["dumped"] < time.time() - STALE_TTL:
+            try:
+                os.unlink(filename)
+            except OSError as e:
+                logging.warning("Could not delete %s: %s" % (filename, e))
+            continue
+
+        processes.append(data)
+        if data["stale"] and not stale:
+            continue
+        for key, item in data["stats"].items():
+            total = stats.setdefault(key, {"count": 0, "total": 0.0, "max": 0.0, "rows": 0})
+            total["count"] += item["count"]
+            total["total"] += item["total"]
+            total["max"] = max(total["max"], item["max"])
+            total["rows"] += item["rows"]
+    return processes, stats
+
+
+def format_report(stats, limit=30):
+    lines = ["   count   total ms    mean ms     max ms       rows  statement"]
+    for key, item in sorted(stats.items(), key=lambda x: -x[1]["total"])[:limit]:
+        lines.append("%8u %10.1f %10.2f %10.1f %10u  %s" % (
+            item["count"], item["total"] * 1000,
+            item["total"] * 1000 / item["count"], item["max"] * 1000,
+            item["rows"], key))
+    return "\n".join(lines)
+
+
+def cmd_profile(*args):
+    """Show SQL statistics collected by running programs"""
+    folder = get_folder()
+    if args and args[0] == "reset":
+        for filename in glob.glob(os.path.join(folder, "*.json")):
+            os.unlink(filename)
+        return
+
+    stale = "all" in args
+    processes, stats = load(folder, stale=stale)
+    if not processes:
+        print("No SQL profiles in %s.  Set database_profile: yes and restart programs." % folder)
+        return
+
+    finished = "Finished (counted):" if stale else "Finished (not counted, use \"all\"):"
+    for title, is_stale in (("Running:", False), (finished, True)):
+        group = [data for data in processes if data["stale"] == is_stale]
+        if not group:
+            continue
+        print(title)
+        for data in group:
+            print("  pid %u: %s (%s to %s)" % (
+                data["pid"], data["command"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(data["started"])),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(data["dumped"]))))
+    print()
+
+    limit = [int(arg) for arg in args if arg.isdigit()]
+    print(format_report(stats, limit=limit[0] if limit else 30))
+
+
+__all__ = ["Profiler", "cmd_profile", "enable", "install", "normalize", "save_on_exit", "uninstall"]
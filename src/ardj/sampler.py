@@ -0,0 +1,218 @@
+# encoding=utf-8
+
+"""Weighted random sampling for ardj.
+
+The default track picking strategy divides each track's weight by the number
+of tracks its artist has, then picks a track proportionally to that.  Doing
+this over a list of rows costs a few passes over all candidates on every pick.
+This module keeps the weights in Fenwick trees instead, so that both picking a
+track and changing one track's weight cost O(log n).
+
+The artist normalisation is done with two levels: an artist is picked with
+probability proportional to the average weight of its tracks, then a track is
+picked from that artist proportionally to its weight.  This gives every track
+the chance of weight / artist_track_count / total, exactly what the row based
+code does.
+"""
+
+import random
+
+
+# Floating point errors accumulate with updates, so trees are rebuilt from
+# plain values after this many of them.
+REBUILD_INTERVAL = 100000
+
+
+class FenwickTree(object):
+    """Prefix sums over an array of non-negative values."""
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.values)
+
+    def rebuild(self, size=None):
+        """Recalculates the tree from values, optionally growing it."""
+        if size is not None and size > len(self.values):
+            self.values.extend([0.0] * (size - len(self.values)))
+
+        tree = [0.0] + self.values
+        for idx in range(1, len(tree)):
+            parent = idx + (idx & -idx)
+            if parent < len(tree):
+                tree[parent] += tree[idx]
+        self.tree = tree
+        self.updates = 0
+
+    def set(self, idx, value):
+        """Changes the value at position idx."""
+        delta = value - self.values[idx]
+        self.values[idx] = value
+
+        self.updates += 1
+        if self.updates >= REBUILD_INTERVAL:
+            return self.rebuild()
+
+        idx += 1
+        size = len(self.tree)
+        while idx < size:
+            self.tree[idx] += delta
+            idx += idx & -idx
+
+    def total(self):
+        """Returns the sum of all values."""
+        result, idx = 0.0, len(self.values)
+        while idx > 0:
+            result += self.tree[idx]
+            idx -= idx & -idx
+        return result
+
+    def find(self, value):
+        """Returns the position where the running sum exceeds value."""
+        pos, step = 0, 1
+        while step * 2 < len(self.tree):
+            step *= 2
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] <= value:
+                value -= self.tree[nxt]
+                pos = nxt
+            step //= 2
+
+        # Rounding can make us land past the end or on a zero slot (like one
+        # that was freed), take the nearest slot with a weight then.
+        pos = min(pos, len(self.values) - 1)
+        if self.values[pos] > 0:
+            return pos
+        for dist in range(1, len(self.values)):
+            for idx in (pos - dist, pos + dist):
+                if 0 <= idx < len(self.values) and self.values[idx] > 0:
+                    return idx
+        return pos
+
+
+class WeightedSampler(object):
+    """Picks keys at random, proportionally to their weights."""
+
+    def __init__(self):
+        self.slots = {}
+        self.keys = []
+        self.free = []
+        self.tree = FenwickTree()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def get(self, key, default=None):
+        if key not in self.slots:
+            return default
+        return self.tree.values[self.slots[key]]
+
+    def set(self, key, weight):
+        """Adds a key or changes its weight."""
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                self.keys[slot] = key
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                if slot >= len(self.tree):
+                    self.tree.rebuild(max(16, slot * 2))
+            self.slots[key] = slot
+        self.tree.set(slot, float(weight))
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            self.tree.set(slot, 0.0)
+            self.keys[slot] = None
+            self.free.append(slot)
+
+    def total(self):
+        return self.tree.total()
+
+    def pick(self, rnd=None):
+        """Returns a random key, None if there are no positive weights."""
+        total = self.total()
+        if total <= 0:
+            return None
+        if rnd is None:
+            rnd = random.random()
+        return self.keys[self.tree.find(rnd * total)]
+
+
+class ArtistSampler(object):
+    """Implements the default track picking strategy.
+
+    Tracks are added with set(track_id, artist_key, weight), where the key is
+    the normalised (lower case) artist name."""
+
+    def __init__(self):
+        self.artists = WeightedSampler()
+        self.tracks = {}
+        self.track_artist = {}
+
+    def __len__(self):
+        return len(self.track_artist)
+
+    def __contains__(self, track_id):
+        return track_id in self.track_artist
+
+    def set(self, track_id, artist_key, weight):
+        old_key = self.track_artist.get(track_id)
+        if old_key is not None and old_key != artist_key:
+            self.remove(track_id)
+
+        self.track_artist[track_id] = artist_key
+        self.tracks.setdefault(artist_key, WeightedSampler()).set(track_id, weight)
+        self._update_artist(artist_key)
+
+    def remove(self, track_id):
+        artist_key = self.track_artist.pop(track_id, None)
+        if artist_key is not None:
+            self.tracks[artist_key].remove(track_id)
+            self._update_artist(artist_key)
+
+    def _update_artist(self, artist_key):
+        tracks = self.tracks.get(artist_key)
+        if not tracks:
+            self.artists.remove(artist_key)
+            self.tracks.pop(artist_key, None)
+        else:
+            self.artists.set(artist_key, tracks.total() / len(tracks))
+
+    def pick(self, exclude=None):
+        """Returns a random track id.
+
+        Tracks listed in exclude are temporarily removed, which also changes
+        the number of tracks their artists have -- the same as if they were
+        filtered out before picking."""
+        removed = []
+        if exclude:
+            for track_id in exclude:
+                artist_key = self.track_artist.get(track_id)
+                if artist_key is not None:
+                    removed.append((track_id, artist_key, self.tracks[artist_key].get(track_id)))
+                    self.remove(track_id)
+
+        try:
+            artist_key = self.artists.pick()
+            if artist_key is None:
+                return None
+            return self.tracks[artist_key].pick()
+        finally:
+            for track_id, artist_key, weight in removed:
+                self.set(track_id, artist_key, weight)
+
+
+__all__ = ["ArtistSampler", "WeightedSampler"]
@@ -0,0 +1,95 @@
+# encoding=utf-8
+
+"""Weekly playlist schedule.
+
+Playlists can be limited to certain days of week, hours and minutes (the
+days, hours and minutes properties in playlist.yaml).  Checking this for
+every playlist on every pick means formatting the time and expanding the
+ranges over and over, so instead playlists are compiled into a table with
+one entry per minute of the week.  Every entry is a bitmask of playlists
+scheduled at that minute, bit N being the N-th playlist.
+
+The table is built when playlist.yaml is loaded (or changed), then finding
+the scheduled playlists is a single lookup.  Transitions (minutes where the
+set of scheduled playlists changes) are kept in a sorted list, so the time
+of the next change is a binary search.
+
+Delays (the delay property) depend on when the playlist was last played and
+are not part of the schedule.
+"""
+
+import bisect
+import time
+
+import ardj.util
+
+
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+
+def get_minute_of_week(timestamp=None):
+    """Returns the minute of week, counting from Sunday midnight (same as
+    days in playlist.yaml, where 0 is Sunday)."""
+    now = time.localtime(timestamp)
+    day = (now.tm_wday + 1) % 7
+    return (day * 24 + now.tm_hour) * 60 + now.tm_min
+
+
+def _get_allowed(playlist, key, size):
+    """Returns values from range(size) allowed by the playlist property."""
+    if key not in playlist:
+        return list(range(size))
+    allowed = ardj.util.expand(playlist[key])
+    return [value for value in range(size) if value in allowed]
+
+
+class WeeklySchedule(object):
+    """Which playlists are scheduled at every minute of the week."""
+
+    def __init__(self, playlists):
+        self.size = len(playlists)
+        self.table = [0] * MINUTES_PER_WEEK
+
+        for pos, playlist in enumerate(playlists):
+            bit = 1 << pos
+            days = _get_allowed(playlist, "days", 7)
+            hours = _get_allowed(playlist, "hours", 24)
+            minutes = _get_allowed(playlist, "minutes", 60)
+            for day in days:
+                for hour in hours:
+                    base = (day * 24 + hour) * 60
+                    for minute in minutes:
+                        self.table[base + minute] |= bit
+
+        self.transitions = [minute for minute in range(MINUTES_PER_WEEK)
+                            if self.table[minute] != self.table[minute - 1]]
+
+    def get_mask(self, timestamp=None):
+        """Returns the bitmask of playlists scheduled at that time."""
+        return self.table[get_minute_of_week(timestamp)]
+
+    def is_scheduled(self, pos, timestamp=None):
+        return bool(self.get_mask(timestamp) >> pos & 1)
+
+    def get_next_change(self, timestamp=None):
+        """Returns the time when the set of scheduled playlists changes next,
+        None if it never does."""
+        if not self.transitions:
+            return None
+
+        if timestamp is None:
+            timestamp = time.time()
+        minute = get_minute_of_week(timestamp)
+
+        idx = bisect.bisect_right(self.transitions, minute)
+        if idx < len(self.transitions):
+            delta = self.transitions[idx] - minute
+        else:
+            delta = self.transitions[0] + MINUTES_PER_WEEK - minute
+
+        # Start of the current minute plus the distance.
+        start = int(timestamp) - time.localtime(timestamp).tm_sec
+        return start + delta * 60
+
+
+__all__ = ["WeeklySchedule", "get_minute_of_week"]
@@ -3,6 +3,7 @@ import logging
 import time
 
 import ardj.database
+import ardj.profiler
 import ardj.settings
 import ardj.util
 
@@ -17,6 +18,11 @@ class BadAuth(Error):
     pass
 
 
+class NetworkError(Error):
+    """Thrown when last.fm could not be reached."""
+    pass
+
+
 class InvalidParameters(Error):
     pass
 
@@ -91,8 +97,14 @@ class LastFM(object):
                       post=True)
 
     def love(self, artist, title):
+        return self._send_love("track.love", "love", artist, title)
+
+    def unlove(self, artist, title):
+        return self._send_love("track.unlove", "unlove", artist, title)
+
+    def _send_love(self, method, verb, artist, title):
         if self.sk:
-            data = self.call(method='track.love',
+            data = self.call(method=method,
                              artist=artist.encode('utf-8'),
                              track=title.encode('utf-8'),
                              api_sig=True,
@@ -100,13 +112,13 @@ class LastFM(object):
                              post=True)
             if 'error' in data:
                 logging.info(
-                    "Could not love a track with last.fm: %s" %
-                    data["message"].encode("utf-8"))
+                    "Could not %s a track with last.fm: %s" %
+                    (verb, data["message"].encode("utf-8")))
                 return False
             else:
                 logging.info(
-                    ("Sent to last.fm love for: %s -- %s" %
-                     (artist, title)).encode("utf-8"))
+                    ("Sent to last.fm %s for: %s -- %s" %
+                     (verb, artist, title)).encode("utf-8"))
                 return True
 
     def get_events_for_artist(self, artist_name):
@@ -283,7 +295,7 @@ class LastFM(object):
         response = ardj.util.fetch_json(
             self.ROOT, args=kwargs, post=post, quiet=True, ret=True)
         if response is None:
-            raise Error("Empty response")
+            raise NetworkError("Empty response")
         if "error" in response:
             logging.error(
                 "Last.fm error %u: %s" %
@@ -424,6 +436,7 @@ class LibreFM(object):
 
 def cmd_start():
     """Start the scrobbler process"""
+    ardj.profiler.save_on_exit()
 
     lastfm = LastFM()
     librefm = LibreFM()
@@ -18,6 +18,7 @@ import web
 from . import auth
 from . import console
 from . import database
+from . import profiler
 from . import scrobbler
 from . import settings
 from . import tracks
@@ -252,6 +253,49 @@ def send_json(f):
     return wrapper
 
 
+def read_only(f):
+    """The @read_only decorator, runs the request on the database replica,
+    if one is enabled (see the webapi_replica setting).  Age of the data is
+    sent in the X-Data-Age header and, for dictionaries, in data_age."""
+    def wrapper(*args, **kwargs):
+        with database.reading() as replica:
+            data = f(*args, **kwargs)
+            if replica is not None:
+                age = int(replica.get_age())
+                web.header("X-Data-Age", str(age))
+                if isinstance(data, dict):
+                    data["data_age"] = age
+        return data
+    return wrapper
+
+
+def writes(f):
+    """The @writes decorator, runs the request in a database transaction,
+    which is committed before the response is sent."""
+    def wrapper(self, *args, **kwargs):
+        with database.transaction("%s.%s" % (self.__class__.__name__, f.__name__)):
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaUpdater(threading.Thread):
+    """Refreshes the database snapshot periodically."""
+
+    def __init__(self, replica, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.replica = replica
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.replica.refresh()
+            except Exception as e:
+                logging.error("Could not refresh database snapshot: %s" % e)
+
+
 class UsageError(RuntimeError):
     pass
 
@@ -261,12 +305,9 @@ class Controller:
         logging.debug("Request from %s: %s" %
                       (web.ctx.environ["REMOTE_ADDR"], web.ctx.path))
 
-    def __del__(self):
-        logging.debug("Request finished, closing the transaction.")
-        database.commit()
-
 
 class AuthController(Controller):
+    @writes
     def GET(self):
         args = web.input(token=None)
         if args.token is None:
@@ -281,6 +322,7 @@ class AuthController(Controller):
             return "Wrong token."
 
     @send_json
+    @writes
     def POST(self):
         args = web.input(id=None, type=None)
         auth.create_token(args.id, args.type)
@@ -312,6 +354,7 @@ class IndexController(Controller):
 
 class InfoController(Controller):
     @send_json
+    @read_only
     def GET(self):
         args = web.input(id=None, token=None)
         sender = auth.get_id_by_token(args.token)
@@ -329,6 +372,7 @@ class InfoController(Controller):
 
 class PlaylistController(Controller):
     @send_json
+    @read_only
     def GET(self):
         args = web.input(name="all", artist=None, tag=None)
 
@@ -362,6 +406,7 @@ class PlaylistController(Controller):
 
 class QueueController(Controller):
     @send_json
+    @writes
     def GET(self):
         args = web.input(track=None, token=None)
 
@@ -370,7 +415,6 @@ class QueueController(Controller):
 
         sender = auth.get_id_by_token(args.token)
         console.on_queue("-s " + str(args.track), sender or "Anonymous Coward")
-        database.commit()
         return {"success": True}
 
 
@@ -403,6 +447,7 @@ class SkipController(Controller):
 
 class RecentController(Controller):
     @send_json
+    @read_only
     def GET(self):
         return {
             "success": True,
@@ -431,6 +476,7 @@ class RocksController(Controller):
             % (args.track_id, args.token, url)
 
     @send_json
+    @writes
     def POST(self):
         try:
             args = web.input(track_id="", token=None)
@@ -449,8 +495,6 @@ class RocksController(Controller):
             if weight is None:
                 return {"status": "error", "message": "No such track."}
 
-            database.commit()
-
             message = 'OK, current weight of track #%u is %.04f.' % (
                 track_id, weight)
             return {
@@ -468,11 +512,14 @@ class RocksController(Controller):
 
 class SearchController(Controller):
     @send_json
+    @read_only
     def GET(self):
         args = web.input(query=None)
 
-        track_ids = tracks.find_ids(args.query)
-        track_info = [database.Track.get_by_id(id) for id in track_ids]
+        # The candidate index is for the picker, the web server searches
+        # the replica, which can lag behind: skip tracks it doesn't have.
+        track_ids = tracks.find_ids(args.query, use_index=False)
+        track_info = [t for t in (database.Track.get_by_id(id) for id in track_ids) if t is not None]
 
         return {
             "success": True,
@@ -506,6 +553,7 @@ class SucksController(RocksController):
 
 class TagCloudController(Controller):
     @send_json
+    @read_only
     def GET(self):
         tags = database.Track.find_tags(
             cents=4, min_count=1)
@@ -514,6 +562,7 @@ class TagCloudController(Controller):
 
 class UpdateTrackController(Controller):
     @send_json
+    @writes
     def POST(self):
         args = web.input(
             token=None,
@@ -545,14 +594,14 @@ class UpdateTrackController(Controller):
             log_debug("{0} set labels for track {1} to {2}",
                       sender, args.id, ", ".join(args.tag))
 
-        database.commit()
-
         return {"success": True}
 
 
 class ExceptionHandlingMiddleWare(object):
     """Завершение предыдущей транзакции после обработки каждого запроса, для
-    исключения блокировки базы данных."""
+    исключения блокировки базы данных.  Запросы, которые что-то меняют,
+    делают это в database.transaction(), здесь откатываются только случайные
+    изменения вне транзакций."""
 
     def __init__(self, app):
         self.app = app
@@ -616,6 +665,7 @@ def cmd_create_token(email=None, *args):
 
 def cmd_serve():
     """Starts the HTTP web server on the configured socket."""
+    profiler.save_on_exit()
     database.init_database()
 
     root = get_web_root()
@@ -625,6 +675,12 @@ def cmd_serve():
 
     logging.info("Web root is %s" % root)
 
+    replica = database.replica.get_instance()
+    if replica is not None:
+        logging.info("Read-only requests use the %s replica." % replica.mode)
+        if replica.mode == "snapshot":
+            ReplicaUpdater(replica, settings.get_int("webapi_replica_interval", 60)).start()
+
     os.chdir(root)
     serve_http(*settings.get("webapi_socket", "127.0.0.1:8080").split(":", 1))
 
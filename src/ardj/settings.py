@@ -78,7 +78,7 @@ class wrapper:
             self.getpath('musicdir', os.path.dirname(self.filename))))
 
     def get_playlists(self):
-        filename = os.path.join(get_config_dir(), 'playlist.yaml')
+        filename = get_playlists_filename()
         if not os.path.exists(filename):
             logging.warning(
                 "File %s not found, using built-in playlists." %
@@ -116,6 +116,19 @@ def get_config_dir():
     return config_dir
 
 
+def get_playlists_filename():
+    return os.path.join(get_config_dir(), 'playlist.yaml')
+
+
+def get_playlists_mtime():
+    """Returns modification time of playlist.yaml, None if there's no such
+    file."""
+    try:
+        return os.stat(get_playlists_filename()).st_mtime
+    except OSError:
+        return None
+
+
 def load_data():
     """Returns the raw contents of the config file.
 
@@ -0,0 +1,376 @@
+# encoding=utf-8
+
+"""Offline playout simulator.
+
+Runs the track picker for a number of simulated hours without putting
+anything on air, to check how fast it is and what it plays.  The picker works
+on a copy of an existing database or on a synthetic one, with a virtual clock
+that advances by the length of every picked track, so playlist schedules,
+delays, prerolls and sticky labels work as they would on air.
+
+Usage:
+
+    python3 -m ardj simulate [hours [source [seed]]]
+
+Source is either the path to an ardj database, which is copied, or the number
+of tracks to generate (1000 by default).  The report includes pick latency,
+SQL statements per pick and some fairness statistics.
+
+    python3 -m ardj simulate-contention [hours [source [hold_ms]]]
+
+Runs the same simulation twice, the second time with a background writer
+that keeps the database locked for hold_ms milliseconds at a time, and shows
+how pick latency changes.
+
+Side effects that reach outside of the database (program name files and
+handlers, chat announcements, listener counts) are disabled while the
+simulation runs.
+"""
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import ardj.candidates
+import ardj.database
+import ardj.settings
+import ardj.tracks
+
+
+# Length of tracks which have none.
+DEFAULT_LENGTH = 240
+
+# Settings that make picks touch the outside world.
+DISABLED_SETTINGS = ("program_name_file", "program_name_announce",
+                     "program_name_handler", "icecast_status_url")
+
+
+class VirtualClock(object):
+    """Replaces time.time() while active."""
+
+    def __init__(self, start=None):
+        self.now = float(start or time.time())
+        self.real_time = None
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def install(self):
+        self.real_time = time.time
+        time.time = self
+
+    def uninstall(self):
+        if self.real_time is not None:
+            time.time = self.real_time
+            self.real_time = None
+
+
+class SimulationDatabase(ardj.database.database):
+    """The simulation database.  Every connection, whichever thread opens
+    it, reports statements to the trace function."""
+
+    def __init__(self, filename, trace):
+        self.trace = trace
+        ardj.database.database.__init__(self, filename)
+
+    def open_connection(self):
+        conn = ardj.database.database.open_connection(self)
+        conn.set_trace_callback(self.trace)
+        return conn
+
+
+class Simulation(object):
+    """A sandbox for the picker: a temporary database, sticky label file and
+    settings, a virtual clock.  Use as a context manager.
+
+    The seed is used for the generated data and for the picks, which use the
+    random module, so runs with the same seed play the same tracks."""
+
+    def __init__(self, source=None, tracks=1000, seed=None, start=None):
+        self.source = source
+        self.track_count = tracks
+        self.seed = seed
+        self.rnd = random.Random(seed)
+        self.clock = VirtualClock(start)
+        # Statements of the picker thread, and of other threads (like
+        # BackgroundWriter) that used the database.
+        self.statements = 0
+        self.other_statements = 0
+        self.thread = None
+        self.count_lock = threading.Lock()
+        self.folder = None
+
+    def __enter__(self):
+        self.folder = tempfile.mkdtemp(prefix="ardj-simulator-")
+        filename = os.path.join(self.folder, "simulation.sqlite")
+        if self.source:
+            shutil.copyfile(self.source, filename)
+
+        self.thread = threading.current_thread()
+        self.saved_db = ardj.database.database.instance
+        ardj.database.database.instance = SimulationDatabase(filename, self._count_statement)
+        ardj.database.init_database()
+        if not self.source:
+            self.generate()
+        ardj.database.commit()
+
+        self.saved_sticky = ardj.tracks.STICKY_LABEL_FILE_NAME
+        ardj.tracks.STICKY_LABEL_FILE_NAME = os.path.join(self.folder, "sticky.json")
+
+        settings = ardj.settings.load()
+        self.saved_settings = settings.data
+        settings.data = dict((k, v) for k, v in (settings.data or {}).items()
+                             if k not in DISABLED_SETTINGS)
+
+        self.saved_random = random.getstate()
+        random.seed(self.seed)
+
+        ardj.candidates.reset()
+        self.clock.install()
+        return self
+
+    def __exit__(self, *args):
+        self.clock.uninstall()
+        random.setstate(self.saved_random)
+        ardj.candidates.reset()
+        ardj.settings.load().data = self.saved_settings
+        ardj.tracks.STICKY_LABEL_FILE_NAME = self.saved_sticky
+
+        ardj.database.Open().close()
+        ardj.database.database.instance = self.saved_db
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _count_statement(self, sql):
+        with self.count_lock:
+            if threading.current_thread() is self.thread:
+                self.statements += 1
+            else:
+                self.other_statements += 1
+
+    def generate(self):
+        """Fills the database with random tracks, labelled so that every
+        playlist has something to play."""
+        labels = set(["music"])
+        for playlist in ardj.settings.load().get_playlists():
+            for key in ("labels", "preroll", "sticky_labels"):
+                for label in playlist.get(key) or []:
+                    labels.add(label.lstrip("+-"))
+        labels = sorted(labels)
+
+        artists = ["Artist %u" % idx for idx in range(max(self.track_count // 10, 1))]
+        for idx in range(self.track_count):
+            weight = round(self.rnd.uniform(0.2, 2.0), 2)
+            track_id = ardj.database.execute(
+                "INSERT INTO tracks (artist, title, filename, length, weight, real_weight, count) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (self.rnd.choice(artists), "Track %u" % idx, "track%u.mp3" % idx,
+                 self.rnd.randint(120, 420), weight, weight))
+            for label in set(self.rnd.sample(labels, min(len(labels), 2)) + ["music"]):
+                ardj.database.execute(
+                    "INSERT INTO labels (track_id, label, email) VALUES (?, ?, 'simulator')",
+                    (track_id, label))
+
+    def run(self, hours):
+        """Plays tracks until the virtual clock advances by that many hours,
+        returns a Report."""
+        report = Report(self.clock.now)
+        weights = dict(ardj.database.fetch("SELECT id, weight FROM tracks WHERE weight > 0"))
+        stop = self.clock.now + hours * 3600
+        started = time.perf_counter()
+
+        while self.clock.now < stop:
+            statements = self.statements
+            ts = time.perf_counter()
+
+            pick = ardj.tracks.select_next_track(self.clock.now)
+            track_id = ardj.tracks.apply_pick(pick)
+            ardj.database.commit()
+
+            latency = time.perf_counter() - ts
+            if not track_id:
+                logging.warning("Simulator: nothing to play, stopping.")
+                break
+
+            row = ardj.database.fetchone("SELECT artist, length FROM tracks WHERE id = ?", (track_id, ))
+            labels = ardj.database.fetchcol("SELECT label FROM labels WHERE track_id = ?", (track_id, )) or []
+            playlist = pick.sticky[1].get("name", "urgent") if pick.sticky else None
+            report.add(track_id, row[0], labels, playlist, latency,
+                       self.statements - statements)
+
+            self.clock.advance(row[1] or DEFAULT_LENGTH)
+
+        report.finish(time.perf_counter() - started, weights)
+        return report
+
+
+class BackgroundWriter(threading.Thread):
+    """Imitates other daemons writing to the database: the web server, the
+    jabber bot, the scrobbler, maintenance jobs.
+
+    Every cycle updates a batch of tracks and adds play log entries in one
+    transaction, which is held for the specified time, then sleeps.  Uses
+    its own database connection, like another process would."""
+
+    def __init__(self, batch=500, hold=0.05, pause=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.batch = batch
+        self.hold = hold
+        self.pause = pause
+        self.cycles = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            ardj.database.execute("UPDATE tracks SET real_weight = real_weight WHERE id IN (SELECT id FROM tracks ORDER BY RANDOM() LIMIT ?)", (self.batch, ))
+            ardj.database.execute("INSERT INTO playlog (ts, track_id, listeners) SELECT 0, id, 0 FROM tracks ORDER BY RANDOM() LIMIT ?", (self.batch, ))
+            self.stopped.wait(self.hold)
+            ardj.database.commit()
+            self.cycles += 1
+            self.stopped.wait(self.pause)
+        ardj.database.commit()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def correlation(xs, ys):
+    """Pearson correlation coefficient, None if undefined."""
+    if len(xs) < 2:
+        return None
+    mx = sum(xs) / float(len(xs))
+    my = sum(ys) / float(len(ys))
+    cov = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    vx = sum((x - mx) ** 2 for x in xs)
+    vy = sum((y - my) ** 2 for y in ys)
+    if not vx or not vy:
+        return None
+    return cov / (vx * vy) ** 0.5
+
+
+class Report(object):
+    """Statistics collected during a simulation."""
+
+    # Artist repeats are counted within this many picks.
+    REPEAT_WINDOW = 10
+
+    def __init__(self, start):
+        self.start = start
+        self.picks = []
+        self.latencies = []
+        self.statements = []
+        self.artist_repeats = 0
+        self.labels = {}
+        self.playlists = {}
+        self.plays = {}
+        self.wall_time = 0
+        self.weight_correlation = None
+
+    def add(self, track_id, artist, labels, playlist, latency, statements):
+        recent = [a for t, a in self.picks[-self.REPEAT_WINDOW:]]
+        if artist and artist in recent:
+            self.artist_repeats += 1
+
+        self.picks.append((track_id, artist))
+        self.latencies.append(latency)
+        self.statements.append(statements)
+        self.plays[track_id] = self.plays.get(track_id, 0) + 1
+        for label in labels:
+            self.labels[label] = self.labels.get(label, 0) + 1
+        name = playlist or "(none)"
+        self.playlists[name] = self.playlists.get(name, 0) + 1
+
+    def finish(self, wall_time, weights):
+        self.wall_time = wall_time
+        ids = sorted(weights)
+        self.weight_correlation = correlation(
+            [weights[i] for i in ids], [self.plays.get(i, 0) for i in ids])
+
+    def format(self):
+        count = len(self.picks)
+        lines = []
+        lines.append("Picks:                %u" % count)
+        if not count:
+            return "\n".join(lines)
+
+        lines.append("Picks per second:     %.1f" % (count / self.wall_time if self.wall_time else 0))
+        lines.append("Latency p50/p95/p99:  %.2f / %.2f / %.2f ms" % tuple(
+            percentile(self.latencies, p) * 1000 for p in (50, 95, 99)))
+        lines.append("SQL statements/pick:  %.1f" % (sum(self.statements) / float(count)))
+        lines.append("Distinct tracks:      %u" % len(self.plays))
+        lines.append("Artist repeats:       %u (within %u picks)" % (self.artist_repeats, self.REPEAT_WINDOW))
+        if self.weight_correlation is None:
+            lines.append("Weight/plays corr.:   n/a")
+        else:
+            lines.append("Weight/plays corr.:   %.3f" % self.weight_correlation)
+
+        lines.append("")
+        lines.append("Playlists:")
+        for name, value in sorted(self.playlists.items(), key=lambda x: -x[1]):
+            lines.append("  %-20s %5.1f%%" % (name, value * 100.0 / count))
+
+        lines.append("")
+        lines.append("Labels:")
+        for name, value in sorted(self.labels.items(), key=lambda x: -x[1])[:20]:
+            lines.append("  %-20s %5.1f%%" % (name, value * 100.0 / count))
+
+        return "\n".join(lines)
+
+
+def cmd_simulate(hours="24", source=None, seed=None):
+    """Simulate playout and report picker performance"""
+    tracks = 1000
+    if source is not None and source.isdigit():
+        tracks, source = int(source), None
+    elif source is not None and not os.path.exists(source):
+        print("Database %s not found." % source, file=sys.stderr)
+        sys.exit(1)
+
+    with Simulation(source, tracks=tracks, seed=seed) as sim:
+        report = sim.run(float(hours))
+    print(report.format())
+
+
+def cmd_contention(hours="4", source=None, hold_ms="50"):
+    """Compare pick latency with and without concurrent writers"""
+    tracks = 1000
+    if source is not None and source.isdigit():
+        tracks, source = int(source), None
+
+    for title, hold in (("Idle database", None), ("Concurrent writer, %s ms transactions" % hold_ms, float(hold_ms) / 1000)):
+        with Simulation(source, tracks=tracks, seed=1) as sim:
+            writer = None
+            if hold is not None:
+                writer = BackgroundWriter(hold=hold)
+                writer.start()
+            try:
+                report = sim.run(float(hours))
+            finally:
+                if writer is not None:
+                    writer.stop()
+
+        print(title)
+        print("-" * len(title))
+        print(report.format().split("\n\n")[0])
+        if writer is not None:
+            print("Writer transactions:  %u" % writer.cycles)
+            print("Writer statements:    %u" % sim.other_statements)
+        print()
+
+
+__all__ = ["Simulation", "cmd_contention", "cmd_simulate"]
@@ -6,6 +6,7 @@ import os
 import sys
 import time
 
+import ardj.computed
 import ardj.database
 import ardj.settings
 import ardj.scrobbler
@@ -77,12 +78,25 @@ def fetch_artist_events(lastfm, artist_name):
     return events
 
 
-def fetch_events(refresh=False):
-    """Returns events from LastFM.  Uses caching (12 hours by default)."""
-    cache_fn = ardj.settings.getpath(
+def get_cache_path():
+    return ardj.settings.getpath(
         "event_schedule_cache",
         "/tmp/ardj-events-cache.json")
 
+
+def get_concert_artists():
+    """Returns names of artists that have events in the cache."""
+    cache_fn = get_cache_path()
+    if not os.path.exists(cache_fn):
+        return []
+    events = json.loads(open(cache_fn, 'rb').read())
+    return sorted(set([e['artist'] for e in events if e.get('artist')]))
+
+
+def fetch_events(refresh=False):
+    """Returns events from LastFM.  Uses caching (12 hours by default)."""
+    cache_fn = get_cache_path()
+
     if os.path.exists(cache_fn):
         ttl = int(ardj.settings.get("event_schedule_cache_ttl", "43200"))
         if time.time() - os.stat(cache_fn).st_mtime < ttl and not refresh:
@@ -102,9 +116,7 @@ def fetch_events(refresh=False):
         events += tmp
 
     open(cache_fn, 'wb').write(json.dumps(events))
-
-    artist_names = list(set([e['artist'] for e in events if e.get('artist')]))
-    update_labels(artist_names)
+    update_labels()
 
     return events
 
@@ -134,14 +146,10 @@ def update_website(filename):
     logging.info('Wrote event schedule to %s' % filename)
 
 
-def update_labels(artist_names):
-    """Adds the concert-soon labels to appropriate tracks."""
-    ardj.database.execute("DELETE FROM labels WHERE label = 'concert-soon'")
-    for name in artist_names:
-        logging.debug("Tagging %s with concert-soon" % name.encode("utf-8"))
-        ardj.database.execute('INSERT INTO labels (track_id, label, email) '
-                              'SELECT id, ?, ? FROM tracks WHERE artist = ?', (
-                                  'concert-soon', 'ardj', name, ))
+def update_labels():
+    """Adds the concert-soon labels to tracks by artists that have events,
+    see get_concert_artists()."""
+    ardj.computed.update(["concert-soon"])
 
 
 def update_schedule(refresh=False):
@@ -19,13 +19,17 @@ import urllib.request
 import urllib.parse
 import urllib.error
 
+import ardj.candidates
+import ardj.computed
 import ardj.database
 import ardj.jabber
 import ardj.jamendo
+import ardj.labelsets
 import ardj.listeners
 import ardj.log
 import ardj.podcast
 import ardj.replaygain
+import ardj.schedule
 import ardj.settings
 import ardj.scrobbler
 import ardj.tags
@@ -97,7 +101,16 @@ class SamplePlaylist(object):
         return list(filter(os.path.exists, playlist))
 
 
+_compiled_playlists = None
+
+
 class Playlist(dict):
+    # Compiled days/hours/minutes, see is_scheduled().
+    schedule = None
+
+    # Parsed track conditions, see match_conditions().
+    conditions = None
+
     def add_ts(self, stats):
         self['last_played'] = 0
         if self['name'] in stats:
@@ -115,6 +128,35 @@ class Playlist(dict):
             return False
         return True
 
+    def match_conditions(self, labels, count, weight):
+        """Same as match_track(), with conditions parsed only once.
+
+        Arguments:
+        labels -- a set of track labels.
+        """
+        if self.conditions is None:
+            plabels = self.get('labels', [self.get('name')])
+            weight_range = None
+            if '-' in self.get('weight', ''):
+                weight_range = [float(x) for x in self.get('weight').split('-', 1)]
+            self.conditions = (
+                set(l for l in plabels if not l.startswith('+')),
+                set(l[1:] for l in plabels if l.startswith('+')),
+                set(l[1:] for l in plabels if l.startswith('-')),
+                self.get('repeat'),
+                weight_range)
+
+        either, every, neither, repeat, weight_range = self.conditions
+        if not labels or labels.isdisjoint(either):
+            return False
+        if not every.issubset(labels) or not neither.isdisjoint(labels):
+            return False
+        if repeat is not None and count and count >= repeat:
+            return False
+        if weight_range is not None and not (weight_range[0] <= weight <= weight_range[1]):
+            return False
+        return True
+
     def match_weight(self, other):
         if '-' not in self.get('weight', ''):
             return True
@@ -150,23 +192,20 @@ class Playlist(dict):
 
     def is_active(self, timestamp=None):
         """Checks whether the playlist can be used right now."""
-        now = time.localtime(timestamp)
+        return self.is_scheduled(timestamp) and not self.is_delayed(timestamp)
 
-        now_ts = time.mktime(now)
-        now_day = int(time.strftime('%w', now))
-        now_hour = int(time.strftime('%H', now))
-        now_minutes = int(time.strftime('%M', now))
-
-        if 'delay' in self and self['delay'] * \
-                60 + self['last_played'] >= now_ts:
-            return False
-        if 'hours' in self and now_hour not in self.get_hours():
-            return False
-        if 'days' in self and now_day not in self.get_days():
+    def is_delayed(self, timestamp=None):
+        """Checks whether the playlist was played too recently."""
+        if 'delay' not in self:
             return False
-        if 'minutes' in self and now_minutes not in self.get_minutes():
-            return False
-        return True
+        now_ts = int(time.time() if timestamp is None else timestamp)
+        return self['delay'] * 60 + self['last_played'] >= now_ts
+
+    def is_scheduled(self, timestamp=None):
+        """Checks the days, hours and minutes properties."""
+        if self.schedule is None:
+            self.schedule = ardj.schedule.WeeklySchedule([self])
+        return self.schedule.is_scheduled(0, timestamp)
 
     def get_days(self):
         return ardj.util.expand(self['days'])
@@ -179,31 +218,89 @@ class Playlist(dict):
 
     @classmethod
     def get_active(cls, timestamp=None):
-        return [p for p in cls.get_all() if p.is_active(timestamp)]
+        playlists, schedule = cls.get_compiled()
+        mask = schedule.get_mask(timestamp)
+        return [p for pos, p in enumerate(playlists)
+                if mask >> pos & 1 and not p.is_delayed(timestamp)]
+
+    @classmethod
+    def get_next_change(cls, timestamp=None):
+        """Returns the time when the set of scheduled playlists changes,
+        delays not counted."""
+        return cls.get_compiled()[1].get_next_change(timestamp)
 
     @classmethod
     def get_all(cls):
         """Returns information about all known playlists.  Information from
         playlists.yaml is complemented by the last_played column of the
         `playlists' table."""
+        return cls.get_compiled()[0]
+
+    @classmethod
+    def get_compiled(cls):
+        """Returns all playlists and their weekly schedule.
+
+        Playlists are only compiled when playlist.yaml changes, the
+        last_played property is refreshed on every call."""
+        global _compiled_playlists
+        data = ardj.settings.load().get_playlists()
+        if _compiled_playlists is None or _compiled_playlists[0] is not data:
+            playlists = [cls(p) for p in data]
+            _compiled_playlists = (data, playlists, ardj.schedule.WeeklySchedule(playlists))
+
         stats = dict(ardj.database.fetch(
             'SELECT name, last_played FROM playlists WHERE name IS NOT NULL AND last_played IS NOT NULL'))
-        return [cls(p).add_ts(stats)
-                for p in ardj.settings.load().get_playlists()]
+        for playlist in _compiled_playlists[1]:
+            playlist.add_ts(stats)
+        return _compiled_playlists[1], _compiled_playlists[2]
+
+    @classmethod
+    def find_by_track(cls, track):
+        """Returns names of all playlists that contain the track.
+
+        Arguments:
+        track -- a dictionary with labels, count and weight.
+        """
+        labels = set(track.get('labels') or [])
+        count = track.get('count', 0)
+        weight = track.get('weight', 1.0)
+
+        names = []
+        for playlist in cls.get_all():
+            name = playlist.get('name')
+            if name and playlist.match_conditions(labels, count, weight):
+                names.append(name)
+        return names
 
     @classmethod
     def touch_by_track(cls, track_id):
         """Finds playlists that contain this track and updates their last_played
         property, so that they could be delayed properly."""
-        track = get_track_by_id(track_id)
+        row = ardj.database.fetchone(
+            'SELECT count, weight FROM tracks WHERE id = ?', (track_id, ))
+        if row is None:
+            return
+        labels = ardj.database.fetchcol(
+            'SELECT label FROM labels WHERE track_id = ?', (track_id, )) or []
+
+        names = cls.find_by_track({'labels': labels, 'count': row[0] or 0, 'weight': row[1]})
+        if not names:
+            return
+
+        logging.debug('Track %u touches playlists: %s.' % (track_id, ', '.join(names)))
         ts = int(time.time())
+        params = []
+        for name in names:
+            params.extend([name, ts])
 
-        for playlist in cls.get_all():
-            name = playlist.get('name')
-            if name and playlist.match_track(track):
-                logging.debug(
-                    'Track %u touches playlist "%s".' %
-                    (track_id, name))
+        try:
+            ardj.database.execute(
+                'INSERT INTO playlists (name, last_played) VALUES %s ON CONFLICT (name) DO UPDATE SET last_played = excluded.last_played' % ', '.join(['(?, ?)'] * len(names)),
+                params)
+        except ardj.database.OperationalError as e:
+            # No unique index on playlists.name yet.
+            logging.warning('Could not update playlists: %s.  Run "ardj db-init" to fix this.' % e)
+            for name in names:
                 rowcount = ardj.database.execute(
                     'UPDATE playlists SET last_played = ? WHERE name = ?', (ts, name, ))
                 if rowcount == 0:
@@ -278,8 +375,9 @@ class Track(dict):
              ))
         return votes[0] if votes else 0
 
-    def refresh_tags(self, filepath):
-        tags = ardj.tags.get(filepath)
+    def refresh_tags(self, filepath, tags=None):
+        if tags is None:
+            tags = ardj.tags.get(filepath)
 
         write = False
 
@@ -437,8 +535,12 @@ def get_queue():
     return [get_track_by_id(row[0]) for row in rows]
 
 
-def find_ids(pattern, sender=None, limit=None):
-    search_order = 'weight DESC'
+def find_ids(pattern, sender=None, limit=None, use_index=True):
+    """Returns ids of tracks that match the search pattern: words, #labels,
+    ids and sort flags.  Labels are matched by the candidate index, unless
+    use_index is False, then by SQL on the current database (e.g. the
+    replica in the web server, which has no index)."""
+    search_order = None
     search_args = []
     search_labels = []
     search_ids = []
@@ -471,51 +573,97 @@ def find_ids(pattern, sender=None, limit=None):
     if search_ids:
         return [int(x) for x in search_ids]
 
-    pattern = ' '.join(search_args)
-
-    params = []
-    where = []
-
-    if search_labels:
-        _add_label_filter(search_labels, where, params)
-
-    if search_args:
-        like = ' '.join(search_args)
-        where.append('(ULIKE(artist, ?) OR ULIKE(title, ?))')
-        params.append(like)
-        params.append(like)
+    if not search_args and not search_labels:
+        return []
 
-    if not params:
+    # Labels are matched using the candidate index bitsets, which only has
+    # tracks with positive weight, same as the query below.
+    matching = None
+    if search_labels and not use_index:
+        if not search_args:
+            sql, params = add_labels_filter('SELECT id FROM tracks WHERE weight > 0', [], search_labels)
+            sql += ' ORDER BY %s' % (search_order or 'weight DESC')
+            if limit is not None:
+                sql += ' LIMIT %u' % limit
+            return [row[0] for row in ardj.database.fetch(sql, params)]
+    elif search_labels:
+        index = ardj.candidates.get_index()
+        matching = index.match_labels(search_labels)
+
+        if not search_args:
+            ids = _sort_found_ids(index, ardj.labelsets.to_ids(matching), search_order or 'weight DESC')
+            if limit is not None:
+                ids = ids[:limit]
+            return ids
+
+    query = get_search_query(search_args)
+    if query is None:
         return []
 
-    sql = 'SELECT id FROM tracks WHERE weight > 0 AND %s ORDER BY %s' % (
-        ' AND '.join(where), search_order)
-    if limit is not None:
+    # Best matches first, unless a different order was requested.
+    if search_order is None:
+        search_order = 'bm25(track_search, 10.0, 5.0, 1.0), t.weight DESC'
+    sql = 'SELECT t.id FROM track_search s INNER JOIN tracks t ON t.id = s.rowid WHERE track_search MATCH ? AND t.weight > 0'
+    params = [query]
+    if search_labels and not use_index:
+        sql, params = add_labels_filter(sql, params, search_labels)
+    sql += ' ORDER BY %s' % search_order
+    if limit is not None and matching is None:
         sql += ' LIMIT %u' % limit
-    rows = ardj.database.fetch(sql, params)
-    return [row[0] for row in rows]
 
+    ids = [row[0] for row in ardj.database.fetch(sql, params)]
+    if matching is not None:
+        ids = [i for i in ids if matching >> i & 1]
+        if limit is not None:
+            ids = ids[:limit]
+    return ids
+
+
+def get_search_query(words, column=None):
+    """Builds a full text search query which finds tracks that have all the
+    words, as prefixes, in artist, title or labels.  Returns None if there
+    are no words to search for."""
+    terms = []
+    for word in words:
+        word = ardj.util.lower(word)
+        if any(c.isalnum() for c in word):
+            terms.append('"%s"*' % word.replace('"', '""'))
+    if not terms:
+        return None
+    query = ' AND '.join(terms)
+    if column is not None:
+        query = '%s : (%s)' % (column, query)
+    return query
 
-def _add_label_filter(labels, where, params):
-    """Adds condition for filtering tracks by labels."""
-    other_labels = []
 
-    for label in labels:
-        if label.startswith("+"):
-            where.append('id IN (SELECT track_id FROM labels WHERE label = ?)')
-            params.append(label[1:])
-        elif label.startswith("-"):
-            where.append(
-                'id NOT IN (SELECT track_id FROM labels WHERE label = ?)')
-            params.append(label[1:])
-        else:
-            other_labels.append(label)
+def _find_exact(column, value):
+    """Returns ids of tracks whose artist or title is value, ignoring case.
+    Candidates are found by the full text index, then checked."""
+    query = get_search_query(value.split(' '), column)
+    if query is None:
+        return ardj.database.fetchcol(
+            'SELECT id FROM tracks WHERE %s = ? COLLATE unicode' % column, (value, )) or []
 
-    if other_labels:
-        sql = "id IN (SELECT track_id FROM labels WHERE label IN (%s))" % ", ".join(
-            ['?'] * len(other_labels))
-        where.append(sql)
-        params.extend(other_labels)
+    value = ardj.util.lower(value)
+    rows = ardj.database.fetch(
+        'SELECT t.id, t.%s FROM track_search s INNER JOIN tracks t ON t.id = s.rowid WHERE track_search MATCH ? ORDER BY t.id' % column, (query, ))
+    return [row[0] for row in rows if row[1] is not None and ardj.util.lower(row[1]) == value]
+
+
+def _sort_found_ids(index, ids, order):
+    """Sorts track ids found by labels like the SQL query in find_ids()
+    would."""
+    if order == 'RANDOM()':
+        random.shuffle(ids)
+    elif order == 'id DESC':
+        ids.reverse()
+    elif order == 'count DESC':
+        ids.sort(key=lambda i: index.tracks[i].count or 0, reverse=True)
+    elif order == 'count ASC':
+        ids.sort(key=lambda i: index.tracks[i].count or 0)
+    elif order == 'weight DESC':
+        ids.sort(key=lambda i: index.tracks[i].weight or 0, reverse=True)
+    return ids
 
 
 def add_labels(track_id, labels, owner=None):
@@ -615,12 +763,12 @@ def purge():
     # ardj.database.Open().purge()
 
 
-def get_urgent():
+def get_urgent(timestamp=None):
     """Returns current playlist preferences."""
     data = ardj.database.fetch(
         'SELECT labels FROM urgent_playlists WHERE expires > ? ORDER BY expires',
         (int(
-            time.time()),
+            timestamp or time.time()),
          ))
     if data:
         return re.split('[,\\s]+', data[0][0])
@@ -770,13 +918,8 @@ def add_file(filename, add_labels=None, owner=None,
          owner or 'ardj',
          dlink,
          ))
-    for label in labels:
-        ardj.database.execute(
-            'INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)',
-            (track_id,
-             label,
-             (owner or 'ardj').lower(),
-             ))
+    ardj.database.bulk_insert('labels', ('track_id', 'label', 'email'),
+                              [(track_id, label, (owner or 'ardj').lower()) for label in labels])
     return track_id
 
 
@@ -800,18 +943,46 @@ def get_track_id_from_queue():
 
 
 def get_random_track_id_from_playlist(playlist, skip_artists):
-    sql = 'SELECT id, weight, artist, count, last_played FROM tracks WHERE weight > 0 AND artist IS NOT NULL AND filename IS NOT NULL'
-    params = []
+    track_id = _pick_from_playlist(playlist, skip_artists)
+
+    if track_id is not None:
+        update_sticky_label(track_id, playlist)
+        if playlist.get('preroll'):
+            track_id = add_preroll(track_id, playlist.get('preroll'))
+
+    return track_id
+
+
+def _pick_from_playlist(playlist, skip_artists, timestamp=None, query=None):
+    """Picks a random track from the playlist, without side effects (sticky
+    labels and prerolls are the caller's business)."""
+    if query is None:
+        query = get_playlist_query(playlist, skip_artists, timestamp)
 
+    index = ardj.candidates.get_index()
+    strategy = playlist.get("strategy", "default")
+    if strategy in ("fresh", "oldest"):
+        rows = index.find(**query)
+        logging.debug("Found %u candidates for labels: %s." % (
+            len(rows), ", ".join(query["labels"])))
+        track_id = get_random_row(rows, strategy)
+    else:
+        track_id = index.pick(**query)
+        logging.debug(
+            "Picked track %s using strategy '%s'." %
+            (track_id, strategy))
+
+    return track_id
+
+
+def get_playlist_query(playlist, skip_artists, timestamp=None):
+    """Returns playlist conditions as CandidateIndex.find() arguments."""
     labels = list(playlist.get('labels', [playlist.get('name', 'music')]))
     labels.extend(get_sticky_label(playlist))
 
-    sql, params = add_labels_filter(sql, params, labels)
-
     repeat_count = playlist.get('repeat')
     if repeat_count:
-        sql += ' AND count < ?'
-        params.append(int(repeat_count))
+        repeat_count = int(repeat_count)
 
     if skip_artists:
         skip_count = int(
@@ -821,35 +992,55 @@ def get_random_track_id_from_playlist(playlist, skip_artists):
                     "history",
                     "10")))
         skip_artists = skip_artists[:skip_count]
-        if skip_artists:
-            sql += ' AND artist NOT IN (%s)' % ', '.join(
-                ['?'] * len(skip_artists))
-            params += skip_artists
 
+    weight_range = None
     weight = playlist.get('weight', '')
     if '-' in weight:
         parts = weight.split('-', 1)
-        sql += ' AND weight >= ? AND weight <= ?'
-        params.append(float(parts[0]))
-        params.append(float(parts[1]))
+        weight_range = (float(parts[0]), float(parts[1]))
 
+    played_before = None
     delay = playlist.get('track_delay')
     if delay:
-        sql += ' AND (last_played IS NULL OR last_played <= ?)'
-        params.append(int(time.time()) - int(delay) * 60)
+        played_before = int(timestamp or time.time()) - int(delay) * 60
 
-    ardj.database.Open().debug(sql, params)
-    track_id = get_random_row(
-        ardj.database.fetch(
-            sql, tuple(params)), playlist.get(
-            "strategy", "default"))
+    return {"labels": labels,
+            "repeat": repeat_count,
+            "skip_artists": skip_artists,
+            "weight_range": weight_range,
+            "played_before": played_before}
 
-    if track_id is not None:
-        update_sticky_label(track_id, playlist)
-        if playlist.get('preroll'):
-            track_id = add_preroll(track_id, playlist.get('preroll'))
 
-    return track_id
+def pick_from_playlists(playlists, skip_artists, timestamp=None, report=None):
+    """Picks a track from the first playlist that has candidates.
+
+    Candidates for all playlists are counted at once, so playlists that would
+    yield nothing are skipped without trying to pick from them.  Returns a
+    (track_id, playlist) tuple, (None, None) if nothing was found.
+
+    Arguments:
+    report -- a list to add (playlist name, candidate count) tuples to.
+    """
+    if not playlists:
+        return None, None
+
+    queries = [get_playlist_query(p, skip_artists, timestamp) for p in playlists]
+    counts = ardj.candidates.get_index().count_all(queries)
+
+    summary = [(p.get('name', 'unnamed'), c) for p, c in zip(playlists, counts)]
+    if report is not None:
+        report.extend(summary)
+    logging.debug("Candidates per playlist: %s." % ", ".join(
+        "%s=%u" % item for item in summary))
+
+    for playlist, query, count in zip(playlists, queries, counts):
+        if not count:
+            continue
+        track_id = _pick_from_playlist(playlist, skip_artists, timestamp, query)
+        if track_id is not None:
+            return track_id, playlist
+
+    return None, None
 
 
 def update_sticky_label(track_id, playlist):
@@ -978,22 +1169,17 @@ def get_random_row_default(rows):
     """
     ID_COL, WEIGHT_COL, NAME_COL = 0, 1, 2
 
+    names = [(row[NAME_COL] or "").lower() for row in rows]
+
     artist_counts = {}
-    for row in rows:
-        name = row[NAME_COL].lower()
-        if name not in artist_counts:
-            artist_counts[name] = 0
-        artist_counts[name] += 1
-
-    probability_sum = 0
-    for row in rows:
-        name = row[NAME_COL].lower()
-        probability_sum += row[WEIGHT_COL] / artist_counts[name]
-
-    rnd = random.random() * probability_sum
-    for row in rows:
-        name = row[NAME_COL].lower()
-        weight = row[WEIGHT_COL] / artist_counts[name]
+    for name in names:
+        artist_counts[name] = artist_counts.get(name, 0) + 1
+
+    weights = [row[WEIGHT_COL] / artist_counts[name]
+               for row, name in zip(rows, names)]
+
+    rnd = random.random() * sum(weights)
+    for row, weight in zip(rows, weights):
         if rnd < weight:
             return row[ID_COL]
         rnd -= weight
@@ -1034,6 +1220,18 @@ def add_preroll(track_id, labels=None):
 
     Tracks that have a preroll-* never have a preroll.
     """
+    preroll_id = find_preroll(track_id, labels)
+    if preroll_id is None:
+        return track_id
+
+    queue(track_id)
+    return preroll_id
+
+
+def find_preroll(track_id, labels=None):
+    """Picks a preroll for the specified track, see add_preroll().
+
+    Returns the preroll id or None."""
     # Skip if the track is a preroll.
     logging.debug(
         "Looking for prerolls for track %u (labels=%s)" %
@@ -1045,7 +1243,7 @@ def add_preroll(track_id, labels=None):
          ))
     if row and row[0]:
         logging.debug("Track %u is a preroll itself." % track_id)
-        return track_id
+        return None
 
     if labels:
         prerolls = get_prerolls_for_labels(labels)
@@ -1058,11 +1256,9 @@ def add_preroll(track_id, labels=None):
         prerolls.remove(track_id)
 
     if prerolls:
-        queue(track_id)
-        track_id = prerolls[random.randrange(len(prerolls))]
-        logging.debug("Will play track %u (a preroll)." % track_id)
-
-    return track_id
+        preroll_id = prerolls[random.randrange(len(prerolls))]
+        logging.debug("Will play track %u (a preroll)." % preroll_id)
+        return preroll_id
 
 
 def get_built_in_track():
@@ -1077,9 +1273,12 @@ def get_built_in_track():
     return pl.pick_file()
 
 
-def get_next_track():
+def get_next_track(pick=None):
     try:
-        track_id = get_next_track_id()
+        if pick is not None:
+            track_id = apply_pick(pick)
+        else:
+            track_id = get_next_track_id()
         if not track_id:
             logging.warning(
                 "Could not find a track to play -- empty database?")
@@ -1101,33 +1300,48 @@ def get_next_track():
         return None
 
 
-def get_next_track_id(update_stats=True):
+class Pick(object):
+    """A track chosen to be played next.
+
+    Choosing a track has no side effects.  Everything that must be written
+    when the track actually starts (queue, sticky labels, prerolls, program
+    name, statistics) is recorded here and done by apply_pick().  This lets
+    the track be chosen in advance, see ardj.lookahead.
     """
-    Picks a track to play.
 
-    The track is chosen from the active playlists. If nothing could be chosen,
-    a random track is picked regardless of the playlist (e.g., the track can be
-    in no playlist or in an unexisting one).  If that fails too, None is
-    returned.
+    def __init__(self, timestamp=None):
+        self.timestamp = timestamp
+        self.track_id = None
+        self.queue_id = None
+        self.sticky = None
+        self.queued = []
+        self.program = None
+        self.tags = None
+        # (playlist name, candidate count) for every active playlist.
+        self.candidates = []
 
-    Normally returns a dictionary with keys that corresponds to the "tracks"
-    table fields, e.g.: filename, artist, title, length, weight, count,
-    last_played, playlist.  An additional key is filepath, which contains the
-    full path name to the picked track, encoded in UTF-8.
 
-    Before the track is returned, its and the playlist's statistics are
-    updated.
+def select_next_track(timestamp=None):
+    """
+    Chooses a track to play, returns a Pick.
+
+    The track is chosen from the active playlists. If nothing could be chosen,
+    a random track is picked regardless of the playlist (e.g., the track can be
+    in no playlist or in an unexisting one).  If that fails too, pick.track_id
+    is None.
 
     Arguments:
-    update_stats -- set to False to not update last_played.
+    timestamp -- when the track is going to start, defaults to now.  Used to
+    find active playlists and to apply delays.
     """
+    pick = Pick(timestamp)
+
     want_preroll = True
     debug = ardj.settings.get("debug_playlists") == "yes"
 
     dupe_count = ardj.settings.get_int("dupes", 0)
     if dupe_count:
-        skip_artists = list(set([row[0] for row in ardj.database.fetch(
-            'SELECT artist FROM tracks WHERE artist IS NOT NULL AND last_played IS NOT NULL ORDER BY last_played DESC LIMIT ' + str(dupe_count))]))
+        skip_artists = ardj.candidates.get_index().get_recent_artists(dupe_count)
     else:
         skip_artists = []
 
@@ -1135,42 +1349,50 @@ def get_next_track_id(update_stats=True):
         msg = 'Artists to skip: %s' % ', '.join(skip_artists or ['none']) + '.'
         logging.debug(msg)
 
-    track_id = get_track_id_from_queue()
-    if track_id:
-        want_preroll = False
-        if debug:
-            logging.debug('Picked track %u from the queue.' % track_id)
+    track_id = None
+    row = ardj.database.fetchone(
+        'SELECT id, track_id FROM queue ORDER BY id LIMIT 1')
+    if row:
+        pick.queue_id = row[0]
+        track = get_track_by_id(row[1]) if row[1] else None
+        if track is not None and track.get('filename'):
+            track_id = row[1]
+            want_preroll = False
+            if debug:
+                logging.debug('Picked track %u from the queue.' % track_id)
 
     if not track_id:
-        labels = get_urgent()
+        labels = get_urgent(timestamp)
         if labels:
-            track_id = get_random_track_id_from_playlist(
-                {'labels': labels}, skip_artists)
+            playlist = {'labels': labels}
+            track_id = _pick_from_playlist(playlist, skip_artists, timestamp)
+            if track_id is not None:
+                pick.sticky = (track_id, playlist)
             if debug and track_id:
                 logging.debug(
                     'Picked track %u from the urgent playlist.' %
                     track_id)
 
     if not track_id:
-        for playlist in Playlist.get_active():
-            if debug:
-                logging.debug(
-                    'Looking for tracks in playlist "%s"' %
-                    playlist.get(
-                        'name', 'unnamed'))
-            labels = playlist.get('labels', [playlist.get('name', 'music')])
-            track_id = get_random_track_id_from_playlist(
-                playlist, skip_artists)
-            if track_id is not None:
-                update_program_name(playlist.get("program"))
-                s = Sticky()
-
-                msg = 'Picked track %u from playlist "%s" using strategy "%s"' % (track_id, playlist.get(
-                    'name', 'unnamed'), playlist.get("strategy", "default"))
-                if s["label"]:
-                    msg += " and sticky label \"%s\"" % s["label"]
-                logging.debug("%s." % msg)
-                break
+        track_id, playlist = pick_from_playlists(
+            Playlist.get_active(timestamp), skip_artists, timestamp,
+            report=pick.candidates)
+        if track_id is not None:
+            pick.sticky = (track_id, playlist)
+            if playlist.get('preroll'):
+                preroll_id = find_preroll(track_id, playlist.get('preroll'))
+                if preroll_id is not None:
+                    pick.queued.append(track_id)
+                    track_id = preroll_id
+
+            pick.program = playlist.get("program")
+            s = Sticky()
+
+            msg = 'Picked track %u from playlist "%s" using strategy "%s"' % (track_id, playlist.get(
+                'name', 'unnamed'), playlist.get("strategy", "default"))
+            if s["label"]:
+                msg += " and sticky label \"%s\"" % s["label"]
+            logging.debug("%s." % msg)
 
     if not track_id:
         logging.debug(
@@ -1180,10 +1402,37 @@ def get_next_track_id(update_stats=True):
             "SELECT id, weight, artist, count, last_played FROM tracks WHERE weight > 0")
         track_id = get_random_row(rows)
 
-    if track_id:
-        if want_preroll:
-            track_id = add_preroll(track_id)
+    if track_id and want_preroll:
+        preroll_id = find_preroll(track_id)
+        if preroll_id is not None:
+            pick.queued.append(track_id)
+            track_id = preroll_id
+
+    pick.track_id = track_id
+    return pick
+
+
+def apply_pick(pick, update_stats=True):
+    """Writes everything related to starting the picked track.
 
+    Returns the track id.
+
+    Arguments:
+    update_stats -- set to False to not update last_played.
+    """
+    if pick.queue_id is not None:
+        ardj.database.execute('DELETE FROM queue WHERE id = ?', (pick.queue_id, ))
+
+    if pick.sticky is not None:
+        update_sticky_label(*pick.sticky)
+
+    for track_id in pick.queued:
+        queue(track_id)
+
+    update_program_name(pick.program)
+
+    track_id = pick.track_id
+    if track_id:
         if update_stats:
             count = ardj.database.fetch(
                 'SELECT count FROM tracks WHERE id = ?', (track_id, ))[0][0] or 0
@@ -1204,6 +1453,19 @@ def get_next_track_id(update_stats=True):
     return track_id
 
 
+def get_next_track_id(update_stats=True):
+    """
+    Picks a track to play.
+
+    Chooses a track with select_next_track(), then updates its and the
+    playlist's statistics with apply_pick().  Returns the track id or None.
+
+    Arguments:
+    update_stats -- set to False to not update last_played.
+    """
+    return apply_pick(select_next_track(), update_stats)
+
+
 def update_program_name(name):
     """Updates the current program name.
 
@@ -1367,30 +1629,23 @@ def update_track_lengths(only_ids=None):
             print('%u, %s: %s => %s' % (id, filename, length, tags['length']))
             updates.append((tags['length'], id))
 
-    for length, id in updates:
-        ardj.database.execute(
-            'UPDATE tracks SET length = ? WHERE id = ?', (length, id, ))
+    ardj.database.execute_many(
+        'UPDATE tracks SET length = ? WHERE id = ?', updates)
 
 
 def bookmark(track_ids, owner, remove=False):
     """Adds a bookmark label to the specified tracks."""
     label = 'bm:' + owner.lower()
-    for track_id in track_ids:
-        ardj.database.execute(
-            'DELETE FROM labels WHERE track_id = ? AND label = ?', (track_id, label, ))
-        if not remove:
-            ardj.database.execute(
-                'INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)',
-                (track_id,
-                 label,
-                 owner,
-                 ))
+    ardj.database.execute_many(
+        'DELETE FROM labels WHERE track_id = ? AND label = ?',
+        [(track_id, label) for track_id in track_ids])
+    if not remove:
+        ardj.database.bulk_insert('labels', ('track_id', 'label', 'email'),
+                                  [(track_id, label, owner) for track_id in track_ids])
 
 
 def find_by_artist(artist_name):
-    rows = ardj.database.fetch(
-        'SELECT id FROM tracks WHERE artist = ? COLLATE unicode', (artist_name, ))
-    return [row[0] for row in rows]
+    return _find_exact('artist', artist_name)
 
 
 def find_by_filename(pattern):
@@ -1401,16 +1656,10 @@ def find_by_filename(pattern):
 
 def find_by_title(title, artist_name=None):
     """Returns track ids by title."""
-    if artist_name is None:
-        rows = ardj.database.fetch(
-            'SELECT id FROM tracks WHERE title = ? COLLATE unicode', (title, ))
-    else:
-        rows = ardj.database.fetch(
-            'SELECT id FROM tracks WHERE title = ? COLLATE unicode AND artist = ? COLLATE unicode',
-            (title,
-             artist_name,
-             ))
-    return [row[0] for row in rows]
+    ids = _find_exact('title', title)
+    if artist_name is not None and ids:
+        ids = sorted(set(ids) & set(find_by_artist(artist_name)))
+    return ids
 
 
 def get_missing_tracks(tracklist, limit=100):
@@ -1456,18 +1705,13 @@ def get_new_tracks(artist_names=None, label='music', weight=1.5):
 
 
 def mark_long():
-    """Marks long tracks with the @long tag."""
+    """Marks long tracks with the @long tag, see ardj.computed.  Returns the
+    average length and the number of long tracks."""
     tag = "long"
+    ardj.computed.update([tag])
     length = Track2.get_average_length()
-    ardj.database.execute("DELETE FROM `labels` WHERE `label` = ?", (tag, ))
-    ardj.database.execute(
-        "INSERT INTO `labels` (`track_id`, `email`, `label`) SELECT id, \'ardj\', ? FROM tracks WHERE length > ?",
-        (tag,
-         length,
-         ))
     count = ardj.database.fetch(
         'SELECT COUNT(*) FROM labels WHERE label = ?', (tag, ))[0][0]
-    ardj.database.commit()
     return length, count
 
 
@@ -1496,8 +1740,11 @@ def find_new_tracks(args, label='music', weight=1.5):
             filename = ardj.util.fetch(
                 str(track['url']), suffix=track.get('suffix'))
             if not is_dry_run():
-                add_file(str(filename), add_labels=track.get('tags', ['tagme', 'music']),
-                         artist=track["artist"], title=track["title"], dlink=track['url'])
+                # Commit every track, so that the write lock is not held
+                # while the next one is downloading.
+                with ardj.database.transaction("add file"):
+                    add_file(str(filename), add_labels=track.get('tags', ['tagme', 'music']),
+                             artist=track["artist"], title=track["title"], dlink=track['url'])
             added += 1
         except KeyboardInterrupt:
             raise
@@ -1550,13 +1797,8 @@ def add_label_to_tracks_liked_by(label, jids, sender):
     _ids = list(_sets[0])
 
     ardj.database.execute("DELETE FROM labels WHERE label = ?", (label, ))
-    for _id in _ids:
-        ardj.database.execute(
-            "INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)",
-            (_id,
-             label,
-             sender,
-             ))
+    ardj.database.bulk_insert("labels", ("track_id", "label", "email"),
+                              [(_id, label, sender) for _id in _ids])
 
     return len(_ids)
 
@@ -1653,9 +1895,9 @@ def do_idle_tasks(set_busy=None):
         msg = "Could not find anything by %s on Last.fm and Jamendo." % artist_name
     ardj.jabber.chat_say(msg, recipient=sender)
 
-    ardj.database.execute(
-        "DELETE FROM download_queue WHERE artist = ?", (artist_name, ))
-    ardj.database.commit()
+    with ardj.database.transaction("download queue"):
+        ardj.database.execute(
+            "DELETE FROM download_queue WHERE artist = ?", (artist_name, ))
 
 
 class MediaFolderScanner(object):
@@ -1705,7 +1947,7 @@ class MediaFolderScanner(object):
 
     def find_tracks(self):
         result = {}
-        for track in ardj.database.Track.find_all(deleted=True):
+        for track in ardj.database.Track.iter_all(deleted=True):
             if track["filename"]:
                 result[track["filename"]] = track["id"]
         return result
@@ -1717,7 +1959,8 @@ def dedup_by_filename(verbose=False):
 
     merge_count = 0
 
-    for track in ardj.database.Track.find_all(deleted=False):
+    # Read everything first, merge() changes the table.
+    for track in list(ardj.database.Track.iter_all(deleted=False)):
         if not track["weight"]:
             continue
 
@@ -1738,11 +1981,13 @@ def count_available():
     return count[0][0]
 
 
-def get_track_to_play_next():
+def get_track_to_play_next(pick=None):
     """
     Describes track to play next
 
-    Queries the database, on failure returns a predefined track.
+    Queries the database, on failure returns a predefined track.  If a pick
+    was prepared in advance (see ardj.lookahead), it is used instead of
+    choosing a track now.
     """
 
     from . import database
@@ -1751,10 +1996,13 @@ def get_track_to_play_next():
     music_dir = settings.get_music_dir()
 
     try:
-        track = get_next_track()
+        track = get_next_track(pick)
         if track is not None:
             filepath = os.path.join(music_dir, track["filepath"])
-            track.refresh_tags(filepath)
+            tags = None
+            if pick is not None and pick.track_id == track["id"]:
+                tags = pick.tags
+            track.refresh_tags(filepath, tags)
             database.commit()
             track["filepath"] = filepath
             return track
@@ -1819,7 +2067,7 @@ def cmd_export_csv():
     from .database import Track
 
     print("id,filename,artist,title,weight,count")
-    for track in Track.find_all():
+    for track in Track.iter_all():
         cells = [track["id"], track["filename"],
                  track["artist"] or "Unknown Artist",
                  track["title"] or "Untitled",
@@ -322,7 +322,8 @@ def lower(s):
 
 
 def ucmp(a, b):
-    return cmp(lower(a), lower(b))
+    a, b = lower(a), lower(b)
+    return (a > b) - (a < b)
 
 
 def in_list(a, lst):
@@ -0,0 +1,172 @@
+import unittest
+
+from ardj import candidates
+from ardj import database
+from ardj import tracks
+
+
+class CandidateIndexTests(unittest.TestCase):
+    def setUp(self):
+        database.init_database()
+        candidates.reset()
+
+    def tearDown(self):
+        database.execute("DELETE FROM tracks")
+        database.execute("DELETE FROM labels")
+        database.commit()
+
+    def _add_track(self, labels, artist="somebody", weight=1.0, count=0):
+        track_id = database.execute("INSERT INTO tracks (weight, artist, filename, count) VALUES (?, ?, 'dummy.mp3', ?)", (weight, artist, count, ))
+        for label in labels:
+            database.execute("INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)", (track_id, label, "-", ))
+        return track_id
+
+    def _sql_ids(self, labels):
+        sql, params = tracks.add_labels_filter("SELECT id FROM tracks WHERE weight > 0 AND artist IS NOT NULL AND filename IS NOT NULL", [], labels)
+        return sorted(database.fetchcol(sql + " ORDER BY id", params) or [])
+
+    def _index_ids(self, labels, **kwargs):
+        return [row[0] for row in candidates.get_index().find(labels, **kwargs)]
+
+    def test_matches_sql(self):
+        self._add_track(["music", "rock"])
+        self._add_track(["music", "jazz"])
+        self._add_track(["music", "rock", "calm"])
+        self._add_track(["jingle"])
+
+        for labels in (["music"], ["music", "-rock"], ["rock", "jazz"], ["music", "+calm"], ["-music"], ["music", "+rock", "-calm"]):
+            self.assertEqual(self._sql_ids(labels), self._index_ids(labels), "labels: %s" % labels)
+
+    def test_follows_changes(self):
+        t1 = self._add_track(["music"])
+        self.assertEqual([t1], self._index_ids(["music"]))
+
+        t2 = self._add_track(["music"])
+        self.assertEqual([t1, t2], self._index_ids(["music"]))
+
+        database.execute("DELETE FROM labels WHERE track_id = ?", (t1, ))
+        self.assertEqual([t2], self._index_ids(["music"]))
+
+        database.execute("UPDATE tracks SET weight = 0 WHERE id = ?", (t2, ))
+        self.assertEqual([], self._index_ids(["music"]))
+
+    def test_purged_log(self):
+        self._add_track(["music"])
+        self.assertEqual(self._sql_ids(["music"]), self._index_ids(["music"]))
+
+        # Changes made since the last sync were purged along with the rest
+        # of the log, so the index must be rebuilt.
+        self._add_track(["music"])
+        database.execute("DELETE FROM track_changes")
+        self.assertEqual(self._sql_ids(["music"]), self._index_ids(["music"]))
+
+        self.assertTrue(candidates.has_changes_since(5, None, 5))
+        self.assertFalse(candidates.has_changes_since(5, None, 6))
+        self.assertFalse(candidates.has_changes_since(5, 7, 8))
+        self.assertFalse(candidates.has_changes_since(5, 1, 4))
+
+    def test_label_versions(self):
+        t1 = self._add_track(["music", "rock"])
+        index = candidates.get_index()
+        version = index.labels.get_version("music"), index.labels.all_version
+
+        # A play doesn't change label membership, cached results stay.
+        database.execute("UPDATE tracks SET last_played = 100, count = 1 WHERE id = ?", (t1, ))
+        index = candidates.get_index()
+        self.assertEqual(version, (index.labels.get_version("music"), index.labels.all_version))
+
+        database.execute("DELETE FROM labels WHERE track_id = ? AND label = 'rock'", (t1, ))
+        index = candidates.get_index()
+        self.assertEqual(version, (index.labels.get_version("music"), index.labels.all_version))
+        self.assertEqual([], self._index_ids(["rock"]))
+
+    def test_filters(self):
+        t1 = self._add_track(["music"], artist="a", weight=1.0, count=5)
+        t2 = self._add_track(["music"], artist="b", weight=2.0, count=0)
+
+        self.assertEqual([t2], self._index_ids(["music"], repeat=3))
+        self.assertEqual([t2], self._index_ids(["music"], skip_artists=["a"]))
+        self.assertEqual([t1], self._index_ids(["music"], weight_range=(0.5, 1.5)))
+
+    def test_rollback(self):
+        t1 = self._add_track(["music"])
+        database.commit()
+        self.assertEqual([t1], self._index_ids(["music"]))
+
+        self._add_track(["music"])
+        self.assertEqual(2, len(self._index_ids(["music"])))
+
+        database.rollback()
+        self.assertEqual([t1], self._index_ids(["music"]))
+
+    def test_pick(self):
+        t1 = self._add_track(["music"], artist="a")
+        t2 = self._add_track(["music"], artist="b")
+        index = candidates.get_index()
+
+        for idx in range(20):
+            self.assertEqual(t2, index.pick(["music"], skip_artists=["a"]))
+
+        database.execute("UPDATE tracks SET last_played = 1000 WHERE id = ?", (t2, ))
+        index = candidates.get_index()
+        for idx in range(20):
+            self.assertEqual(t1, index.pick(["music"], played_before=999))
+
+        database.execute("UPDATE tracks SET weight = 0 WHERE id = ?", (t1, ))
+        index = candidates.get_index()
+        self.assertEqual(None, index.pick(["music"], played_before=999))
+        self.assertEqual(t2, index.pick(["music"]))
+
+    def test_count_all(self):
+        self._add_track(["music"], artist="a")
+        t2 = self._add_track(["music", "rock"], artist="b")
+        database.execute("UPDATE tracks SET last_played = 1000 WHERE id = ?", (t2, ))
+
+        queries = [{"labels": ["jazz"]},
+                   {"labels": ["rock"], "played_before": 999},
+                   {"labels": ["music"], "skip_artists": ["a"]},
+                   {"labels": ["music"]}]
+        self.assertEqual([0, 0, 1, 2], candidates.get_index().count_all(queries))
+
+    def test_pick_from_playlists(self):
+        self._add_track(["music"], artist="a")
+        t2 = self._add_track(["music", "rock"], artist="b")
+
+        playlists = [tracks.Playlist(name="jazz"), tracks.Playlist(name="rock"), tracks.Playlist(name="music")]
+        report = []
+        track_id, playlist = tracks.pick_from_playlists(playlists, [], report=report)
+        self.assertEqual(t2, track_id)
+        self.assertEqual("rock", playlist["name"])
+        self.assertEqual([("jazz", 0), ("rock", 1), ("music", 2)], report)
+
+    def test_recent_artists(self):
+        t1 = self._add_track(["music"], artist="a")
+        t2 = self._add_track(["music"], artist="b")
+        t3 = self._add_track(["music"], artist="c")
+        for ts, track_id in ((100, t1), (200, t2), (300, t1)):
+            database.execute("UPDATE tracks SET last_played = ? WHERE id = ?", (ts, track_id, ))
+
+        index = candidates.get_index()
+        self.assertEqual(["a", "b"], index.get_recent_artists(3))
+
+        database.execute("UPDATE tracks SET last_played = 400, weight = 0 WHERE id = ?", (t3, ))
+        index = candidates.get_index()
+        self.assertEqual(["c", "a", "b"], index.get_recent_artists(3))
+        self.assertEqual(["c", "a"], index.get_recent_artists(2))
+
+    def test_recent_artists_by_plays(self):
+        # The skip list covers the last N plays, not N distinct artists.
+        t1 = self._add_track(["music"], artist="a")
+        t2 = self._add_track(["music"], artist="a")
+        t3 = self._add_track(["music"], artist="b")
+        for ts, track_id in ((100, t3), (200, t1), (300, t2)):
+            database.execute("UPDATE tracks SET last_played = ? WHERE id = ?", (ts, track_id, ))
+
+        index = candidates.get_index()
+        self.assertEqual(["a"], index.get_recent_artists(2))
+        self.assertEqual(["a", "b"], index.get_recent_artists(3))
+
+        # Played again: the old play of the same track is replaced.
+        database.execute("UPDATE tracks SET last_played = 400 WHERE id = ?", (t3, ))
+        index = candidates.get_index()
+        self.assertEqual(["b", "a"], index.get_recent_artists(2))
@@ -0,0 +1,87 @@
+import unittest
+
+import ardj.computed
+import ardj.database as db
+
+
+class ComputedLabelTests(unittest.TestCase):
+    def setUp(self):
+        db.init_database()
+        self._delete_tracks()
+        self.addCleanup(self._delete_tracks)
+
+    def _delete_tracks(self):
+        with db.transaction('cleanup'):
+            db.execute('DELETE FROM tracks')
+            db.execute('DELETE FROM labels')
+            db.execute('DELETE FROM computed_labels')
+
+    def _add_track(self, count, weight=1):
+        track_id = db.execute('INSERT INTO tracks (title, weight, count) VALUES (?, ?, ?)', ('x', weight, count, ))
+        db.execute("INSERT INTO labels (track_id, label, email) VALUES (?, 'music', 'test')", (track_id, ))
+        return track_id
+
+    def _get_fresh(self):
+        return db.fetchcol("SELECT track_id FROM labels WHERE label = 'fresh' ORDER BY track_id") or []
+
+    def test_incremental(self):
+        t1 = self._add_track(1)
+        t2 = self._add_track(20)
+        t3 = self._add_track(5, weight=0)
+
+        self.assertEqual({'fresh': (1, 0)}, ardj.computed.update(['fresh']))
+        self.assertEqual([t1], self._get_fresh())
+
+        # Nothing changed, nothing written.
+        self.assertEqual({'fresh': (0, 0)}, ardj.computed.update(['fresh']))
+
+        # Only the difference is written.
+        with db.transaction('fixture'):
+            db.execute('UPDATE tracks SET count = 30 WHERE id = ?', (t1, ))
+            db.execute('UPDATE tracks SET weight = 1 WHERE id = ?', (t3, ))
+        self.assertEqual({'fresh': (1, 1)}, ardj.computed.update(['fresh']))
+        self.assertEqual([t3], self._get_fresh())
+
+        # Label changes are in the change log too.
+        with db.transaction('fixture'):
+            db.execute("INSERT INTO labels (track_id, label, email) VALUES (?, 'fresh', 'test')", (t2, ))
+        self.assertEqual({'fresh': (0, 1)}, ardj.computed.update(['fresh']))
+        self.assertEqual([t3], self._get_fresh())
+
+    def test_purged_log(self):
+        t1 = self._add_track(1)
+        ardj.computed.update(['fresh'])
+
+        # The change is lost with the log, so all tracks are checked.
+        with db.transaction('fixture'):
+            db.execute('UPDATE tracks SET count = 30 WHERE id = ?', (t1, ))
+            db.execute('DELETE FROM track_changes')
+        self.assertEqual({'fresh': (0, 1)}, ardj.computed.update(['fresh']))
+        self.assertEqual([], self._get_fresh())
+
+    def test_hitlist_threshold(self):
+        # Tracks without a real weight don't count.
+        for idx in range(25):
+            self._add_track(0)
+        with db.transaction('fixture'):
+            db.execute('UPDATE tracks SET real_weight = 1 WHERE id IN (SELECT id FROM tracks LIMIT 5)')
+        self.assertEqual([None], ardj.computed.get_hitlist_threshold())
+        self.assertEqual({'hitlist': (0, 0)}, ardj.computed.update(['hitlist']))
+
+    def test_params(self):
+        tracks = [self._add_track(0) for idx in range(5)]
+        with db.transaction('fixture'):
+            for idx, track_id in enumerate(tracks):
+                db.execute('UPDATE tracks SET length = ? WHERE id = ?', (idx * 100, track_id, ))
+
+        ardj.computed.update(['long'])
+        length = db.Track.get_average_length()
+        expected = [t for idx, t in enumerate(tracks) if idx * 100 > length]
+        self.assertEqual(expected, db.fetchcol("SELECT track_id FROM labels WHERE label = 'long' ORDER BY track_id"))
+
+        # When parameters change, all tracks are checked again.
+        state = db.fetchone("SELECT params FROM computed_labels WHERE label = 'long'")[0]
+        self.assertEqual('[%u]' % length, state)
+
+    def test_unknown_rule(self):
+        self.assertRaises(KeyError, ardj.computed.get_rule, 'nonexistent')
@@ -1,7 +1,9 @@
 import os
+import threading
 import unittest
 
 import ardj.database as db
+import ardj.scrobbler
 import ardj.tracks
 
 
@@ -17,6 +19,183 @@ class DatabaseTests(unittest.TestCase):
     def test_filename(self):
         self.assertEqual('unittests/data/database.sqlite', db.Open().filename)
 
+    def test_pragmas(self):
+        self.assertEqual('wal', db.fetchone('PRAGMA journal_mode')[0])
+        self.assertEqual(2, db.fetchone('PRAGMA temp_store')[0])
+
+    def test_thread_connections(self):
+        db.execute('DELETE FROM queue')
+        db.commit()
+        db.execute('INSERT INTO queue (track_id, owner) VALUES (?, ?)', (1, 'test', ))
+
+        # Other threads have their own transactions and don't see ours.
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(db.fetchone('SELECT COUNT(*) FROM queue')[0]))
+        thread.start()
+        thread.join()
+        self.assertEqual([0], seen)
+        self.assertEqual(1, db.fetchone('SELECT COUNT(*) FROM queue')[0])
+
+    def test_migrations(self):
+        versions = db.fetchcol('SELECT version FROM schema_migrations ORDER BY version')
+        self.assertEqual([m[0] for m in db.MIGRATIONS], versions)
+
+        # Running again changes nothing.
+        db.init_database()
+        self.assertEqual(versions, db.fetchcol('SELECT version FROM schema_migrations ORDER BY version'))
+
+    def test_failed_migration(self):
+        db.MIGRATIONS.append((999, 'broken', [
+            'CREATE TABLE migration_test (id INTEGER);',
+            'INSERT INTO no_such_table VALUES (1);',
+        ]))
+        try:
+            self.assertRaises(db.OperationalError, db.migrate)
+        finally:
+            db.MIGRATIONS.pop()
+
+        # Nothing was left behind, so the migration can be retried.
+        self.assertEqual(None, db.fetchone("SELECT name FROM sqlite_master WHERE name = 'migration_test'"))
+        self.assertEqual(None, db.fetchone('SELECT version FROM schema_migrations WHERE version = 999'))
+
+    def test_plan_changes(self):
+        # A database with the original schema, before migrations.
+        filename = db.Open().filename + '.old'
+        conn = db.sqlite.connect(filename)
+        try:
+            for statement in db.SQL_INIT:
+                conn.execute(statement)
+            before = db.explain_queries(conn)
+        finally:
+            conn.close()
+            os.unlink(filename)
+
+        changed = dict((name, (old, new)) for name, old, new in db.compare_plans(before, db.explain_queries()))
+        old, new = changed['picker: tracks by label']
+        self.assertFalse(any('idx_track_labels_label' in line for line in old))
+        self.assertTrue(any('idx_track_labels_label' in line for line in new))
+
+    def test_unique_labels(self):
+        db.execute('DELETE FROM labels WHERE track_id = 999')
+        db.execute('INSERT INTO labels (track_id, label, email) VALUES (999, ?, ?)', ('music', 'a@example.com', ))
+        db.execute('INSERT INTO labels (track_id, label, email) VALUES (999, ?, ?)', ('music', 'b@example.com', ))
+        self.assertEqual(['a@example.com'], db.fetchcol('SELECT email FROM labels WHERE track_id = 999'))
+
+    def test_label_stats(self):
+        db.execute('DELETE FROM tracks')
+        db.execute('DELETE FROM labels')
+        t1 = db.execute('INSERT INTO tracks (title, weight) VALUES (?, ?)', ('a', 1, ))
+        t2 = db.execute('INSERT INTO tracks (title, weight) VALUES (?, ?)', ('b', 1, ))
+        for track_id, label in ((t1, 'music'), (t1, 'rock'), (t2, 'music'), (t2, 'artist:b')):
+            db.execute('INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)', (track_id, label, 'test', ))
+        self.assertEqual([('artist:b', 1), ('music', 2), ('rock', 1)], db.Label.get_counts())
+        self.assertEqual([('music', 2)], db.Track.find_tags(min_count=2))
+
+        # Deleted tracks don't count, but their labels are still known.
+        db.execute('UPDATE tracks SET weight = 0 WHERE id = ?', (t1, ))
+        self.assertEqual([('artist:b', 1), ('music', 1)], db.Label.get_counts())
+        self.assertEqual(['artist:b', 'music', 'rock'], db.Label.query_names('all'))
+
+        db.execute('UPDATE tracks SET weight = 1 WHERE id = ?', (t1, ))
+        db.execute("DELETE FROM labels WHERE track_id = ? AND label = 'rock'", (t1, ))
+        db.execute('DELETE FROM tracks WHERE id = ?', (t2, ))
+        self.assertEqual([('music', 1)], db.Label.get_counts())
+
+        # Triggers agree with a full recount.
+        counts = db.fetch('SELECT label_id, live, total FROM label_stats WHERE total > 0 ORDER BY label_id')
+        db.execute('DELETE FROM label_stats')
+        db.execute(db.LABEL_STATS_REBUILD)
+        self.assertEqual(counts, db.fetch('SELECT label_id, live, total FROM label_stats ORDER BY label_id'))
+
+    def test_query_plans(self):
+        plans = dict(db.explain_queries())
+        self.assertTrue(any('idx_track_labels_label' in line for line in plans['picker: tracks by label']))
+        self.assertTrue(any('idx_playlog_lastfm_ts' in line for line in plans['scrobbler: last.fm backlog']))
+        self.assertTrue(any('idx_votes_track_email_ts' in line for line in plans['votes: last vote per user']))
+        self.assertTrue(any('idx_track_labels_label' in line for line in plans['labels: orphans']))
+
+    def test_replica(self):
+        db.execute('DELETE FROM queue')
+        db.commit()
+        filename = db.Open().filename + '.snapshot'
+        replica = db.replica(db.Open().filename, 'snapshot', filename)
+        try:
+            db.execute('INSERT INTO queue (track_id, owner) VALUES (?, ?)', (1, 'test', ))
+            db.commit()
+            self.assertEqual(0, replica.fetch('SELECT COUNT(*) FROM queue')[0][0])
+
+            replica.refresh()
+            self.assertEqual(1, replica.fetch('SELECT COUNT(*) FROM queue')[0][0])
+            self.assertRaises(db.OperationalError, replica.execute, 'DELETE FROM queue')
+
+            db.replica.instance = replica
+            with db.reading():
+                self.assertEqual(replica, db.Open())
+                with db.writing():
+                    self.assertNotEqual(replica, db.Open())
+            self.assertNotEqual(replica, db.Open())
+        finally:
+            db.replica.instance = None
+            replica.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(filename + suffix):
+                    os.unlink(filename + suffix)
+
+    def test_transaction(self):
+        db.execute('DELETE FROM queue')
+        db.commit()
+
+        with db.transaction('test'):
+            db.execute('INSERT INTO queue (track_id, owner) VALUES (?, ?)', (1, 'test', ))
+            # Commits are deferred, nested transactions join the outer one.
+            db.commit()
+            with db.transaction('nested'):
+                db.execute('INSERT INTO queue (track_id, owner) VALUES (?, ?)', (2, 'test', ))
+            self.assertTrue(db.Open().db.in_transaction)
+        self.assertFalse(db.Open().db.in_transaction)
+
+        try:
+            with db.transaction('test'):
+                db.execute('DELETE FROM queue')
+                raise ValueError('oops')
+        except ValueError:
+            pass
+        self.assertEqual(2, db.fetchone('SELECT COUNT(*) FROM queue')[0])
+
+        stats = db.transaction_stats['test']
+        self.assertEqual(2, stats['count'])
+        self.assertEqual(1, stats['failed'])
+
+    def test_bulk_insert(self):
+        db.execute('DELETE FROM queue')
+        db.bulk_insert('queue', ('track_id', 'owner'), [(idx, 'test') for idx in range(100)])
+        self.assertEqual(100, db.fetchone('SELECT COUNT(*) FROM queue')[0])
+
+        self.assertEqual(50, db.execute_many('DELETE FROM queue WHERE track_id = ?', [(idx, ) for idx in range(50)]))
+        self.assertEqual(50, db.fetchone('SELECT COUNT(*) FROM queue')[0])
+
+        # A failed batch is not applied at all, earlier changes are kept.
+        self.assertRaises(Exception, db.bulk_insert, 'labels', ('track_id', 'label', 'email'), [(1, 'a', 'b'), (2, None, 'c')])
+        self.assertEqual(0, db.fetchone("SELECT COUNT(*) FROM labels WHERE label = 'a'")[0])
+        self.assertEqual(50, db.fetchone('SELECT COUNT(*) FROM queue')[0])
+
+        # Still in the transaction.
+        db.rollback()
+        self.assertEqual(0, db.fetchone('SELECT COUNT(*) FROM queue')[0])
+
+    def test_records(self):
+        db.execute('DELETE FROM tracks')
+        track_id = db.execute("INSERT INTO tracks (artist, title, weight, length) VALUES ('a', 'b', 1, 60)")
+        db.execute("INSERT INTO tracks (artist, title, weight, length) VALUES ('c', 'd', 0, 60)")
+
+        records = list(db.Track.iter_all())
+        self.assertEqual(1, len(records))
+        self.assertEqual(track_id, records[0]["id"])
+        self.assertEqual("a", records[0].get("artist"))
+        self.assertEqual(None, records[0].get("missing"))
+        self.assertEqual(db.Track.get_by_id(track_id), records[0].as_dict())
+        self.assertEqual(2, len(list(db.Track.iter_all(deleted=True))))
+
     def test_queue(self):
         db.execute('INSERT INTO queue (track_id, owner) VALUES (?, ?)', (0, 'test', ))
         self.assertEqual(1, db.fetchone('SELECT COUNT(*) FROM queue')[0], 'Failed to insert a record into queue.')
@@ -31,6 +210,7 @@ class DatabaseTests(unittest.TestCase):
         self.assertEqual(tmp, (1, 1, 'test'))
 
     def test_mark_recent(self):
+        self.addCleanup(self._delete_tracks)
         for idx in range(200):
             row = db.execute('INSERT INTO tracks (title) VALUES (?)', (str(idx), ))
             db.execute("INSERT INTO labels (track_id, label, email) VALUES (?, 'music', 'test')", (row, ))
@@ -54,17 +234,91 @@ class DatabaseTests(unittest.TestCase):
         """
 
     def test_mark_orphans(self):
+        self.addCleanup(self._delete_tracks)
         t1 = db.execute('INSERT INTO tracks (title, weight) VALUES (NULL, 1)')
         db.execute('INSERT INTO labels (track_id, label, email) VALUES (?, \'music\', \'nobody\')', (t1, ))
         t2 = db.execute('INSERT INTO tracks (title, weight) VALUES (NULL, 1)')
         db.execute('INSERT INTO labels (track_id, label, email) VALUES (?, \'foobar\', \'nobody\')', (t2, ))
 
-        if not db.Open().mark_orphans(quiet=True):
+        if not db.Open().mark_orphans():
             self.fail('database.mark_orphans() failed to find tracks.')
 
         rows = db.fetch('SELECT track_id FROM labels WHERE label = \'orphan\'')
         self.assertEqual(1, len(rows), 'one track must have been labelled orphan, not %u' % len(rows))
         self.assertEqual(t2, rows[0][0], 'wrong track labelled orphan')
+        self.assertEqual([t2], [track['id'] for track in db.Track.iter_by_tag('orphan')])
+
+    def test_mark_hitlist(self):
+        self.addCleanup(self._delete_tracks)
+        self._delete_tracks()
+        ids = []
+        for idx in range(30):
+            ids.append(db.execute('INSERT INTO tracks (title, real_weight) VALUES (?, ?)', (str(idx), idx, )))
+            db.execute("INSERT INTO labels (track_id, label, email) VALUES (?, 'music', 'test')", (ids[-1], ))
+
+        # Last.fm is not configured, only labels change.
+        db.Open().mark_hitlist()
+        self.assertEqual(ids[10:], db.fetchcol("SELECT track_id FROM labels WHERE label = 'hitlist' ORDER BY track_id"))
+
+        db.execute('UPDATE tracks SET real_weight = 100 WHERE id = ?', (ids[0], ))
+        db.Open().mark_hitlist()
+        self.assertEqual([ids[0]] + ids[11:], db.fetchcol("SELECT track_id FROM labels WHERE label = 'hitlist' ORDER BY track_id"))
+
+    def _delete_tracks(self):
+        # Computed labels are committed, leave nothing behind for other tests.
+        with db.transaction('cleanup'):
+            db.execute('DELETE FROM tracks')
+            db.execute('DELETE FROM labels')
+            db.execute('DELETE FROM lastfm_loves')
+
+    def test_pending_loves(self):
+        db.execute('DELETE FROM lastfm_loves')
+        old = 0
+        db.bulk_insert('lastfm_loves', ('track_id', 'loved', 'ts', 'error'), [
+            (1, 1, old, None),  # loved, stays
+            (2, 1, old, None),  # loved, dropped out
+            (3, 0, old, None),  # unloved, back in
+            (4, 1, old, 'Track not found'),  # retry
+            (5, 1, old + 2 ** 31, 'Track not found'),  # failed recently
+            (6, 1, old, 'Track not found'),  # failed, dropped out
+        ])
+        pending = db.Open().get_pending_loves([1, 3, 4, 5, 7])
+        self.assertEqual([(2, False), (3, True), (4, True), (7, True)], pending)
+
+    def test_sync_loves(self):
+        self._delete_tracks()
+        self.addCleanup(self._delete_tracks)
+        sent = []
+
+        class FakeLastFM(object):
+            sk = 'session'
+
+            def authorize(self):
+                return True
+
+            def love(self, artist, title):
+                if artist == 'bad':
+                    raise ardj.scrobbler.TrackNotFound('Track not found')
+                if artist == 'broken':
+                    raise ValueError('oops')
+                sent.append(title)
+                return True
+
+        real = ardj.scrobbler.LastFM
+        ardj.scrobbler.LastFM = FakeLastFM
+        self.addCleanup(setattr, ardj.scrobbler, 'LastFM', real)
+
+        with db.transaction('fixture'):
+            ids = [db.execute('INSERT INTO tracks (artist, title) VALUES (?, ?)', row)
+                   for row in ((None, 'a'), ('bad', 'b'), ('broken', 'c'), ('x', 'd'))]
+
+        # Failed tracks don't hold up the rest, and are retried later.
+        db.Open().sync_lastfm_loves(ids)
+        self.assertEqual(['d'], sent)
+        errors = db.fetch('SELECT track_id, error FROM lastfm_loves ORDER BY track_id')
+        self.assertEqual([(ids[0], 'No artist or title'), (ids[1], 'Track not found'), (ids[2], 'oops'), (ids[3], None)],
+                         [tuple(row) for row in errors])
+        self.assertEqual([], db.Open().get_pending_loves(ids))
 
     def test_debug(self):
         sql = db.Open().debug('SELECT ?, ?', (1, 2, ), quiet=True)
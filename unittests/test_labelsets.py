@@ -0,0 +1,125 @@
+import unittest
+
+from ardj import candidates
+from ardj import database
+from ardj import labelsets
+from ardj import tracks
+
+
+class LabelSetTests(unittest.TestCase):
+    def test_bitsets(self):
+        ids = [0, 3, 7, 8, 100, 1025]
+        self.assertEqual(ids, labelsets.to_ids(labelsets.from_ids(ids)))
+        self.assertEqual([], labelsets.to_ids(labelsets.from_ids([])))
+        self.assertEqual(6, labelsets.count(labelsets.from_ids(ids)))
+
+    def test_evaluate(self):
+        index = labelsets.LabelIndex()
+        index.load([1, 2, 3, 4], {"music": [1, 2, 3], "rock": [1, 3], "calm": [3]})
+
+        def ids(labels):
+            return labelsets.to_ids(labelsets.compile(labels).evaluate(index))
+
+        self.assertEqual([1, 2, 3], ids(["music"]))
+        self.assertEqual([2], ids(["music", "-rock"]))
+        self.assertEqual([3], ids(["music", "+calm"]))
+        self.assertEqual([4], ids(["-music"]))
+        self.assertEqual([], ids(["missing"]))
+
+        # Cached results must follow changes.
+        index.add("calm", 2)
+        self.assertEqual([2, 3], ids(["music", "+calm"]))
+        index.remove("music", 1)
+        self.assertEqual([2, 3], ids(["music"]))
+        index.add_track(5)
+        self.assertEqual([1, 4, 5], ids(["-music", "-calm"]))
+
+        index.load([1], {"rock": [1]})
+        self.assertEqual([], ids(["music"]))
+
+
+class FindIdsTests(unittest.TestCase):
+    def setUp(self):
+        database.init_database()
+        candidates.reset()
+
+    def tearDown(self):
+        database.execute("DELETE FROM tracks")
+        database.execute("DELETE FROM labels")
+        database.commit()
+
+    def _add_track(self, labels, title, weight=1.0):
+        track_id = database.execute("INSERT INTO tracks (weight, artist, title, filename) VALUES (?, 'somebody', ?, 'dummy.mp3')", (weight, title, ))
+        for label in labels:
+            database.execute("INSERT INTO labels (track_id, label, email) VALUES (?, ?, ?)", (track_id, label, "-", ))
+        return track_id
+
+    def test_find_ids(self):
+        t1 = self._add_track(["music", "rock"], "foo", 1.0)
+        t2 = self._add_track(["music"], "bar", 2.0)
+        t3 = self._add_track(["music", "rock"], "foo bar", 1.5)
+        self._add_track(["music"], "dead", 0)
+
+        self.assertEqual([t2, t3, t1], tracks.find_ids("#music"))
+        self.assertEqual([t3, t2, t1], tracks.find_ids("#music -l"))
+        self.assertEqual([t2], tracks.find_ids("#music #-rock -f"))
+        self.assertEqual([t3, t1], tracks.find_ids("#rock"))
+        self.assertEqual([t3], tracks.find_ids("#rock", limit=1))
+        # Text matches are ranked, the shorter title is the better match.
+        self.assertEqual([t1, t3], tracks.find_ids("#rock foo"))
+        self.assertEqual([t3, t1], tracks.find_ids("#rock foo -l"))
+
+    def test_find_ids_sql(self):
+        # Without the candidate index, as the web server searches.
+        t1 = self._add_track(["music", "rock"], "foo", 1.0)
+        t2 = self._add_track(["music"], "bar", 2.0)
+        t3 = self._add_track(["music", "rock"], "foo bar", 1.5)
+        self._add_track(["music"], "dead", 0)
+
+        self.assertEqual([t2, t3, t1], tracks.find_ids("#music", use_index=False))
+        self.assertEqual([t2], tracks.find_ids("#music #-rock -f", use_index=False))
+        self.assertEqual([t3], tracks.find_ids("#rock", limit=1, use_index=False))
+        self.assertEqual([t1, t3], tracks.find_ids("#rock foo", use_index=False))
+        self.assertEqual([t3], tracks.find_ids("#rock foo bar", use_index=False))
+        self.assertTrue(candidates._index is None)
+
+    def test_text_search(self):
+        t1 = self._add_track(["music"], "Ёлка")
+        t2 = self._add_track(["music"], "Foo Bar")
+        t3 = self._add_track(["music", "jazz"], "Baz")
+
+        self.assertEqual([t1], tracks.find_ids("елк"))
+        self.assertEqual([t2], tracks.find_ids("fo ba"))
+        self.assertEqual([t3], tracks.find_ids("jazz"))
+        self.assertEqual([], tracks.find_ids("oo"))
+        self.assertEqual([], tracks.find_ids('"'))
+
+        # The index follows track and label changes.
+        database.execute("UPDATE tracks SET title = 'Qux' WHERE id = ?", (t2, ))
+        database.execute("DELETE FROM labels WHERE track_id = ? AND label = 'jazz'", (t3, ))
+        self.assertEqual([t2], tracks.find_ids("qux"))
+        self.assertEqual([], tracks.find_ids("jazz"))
+
+        self.assertEqual([t1], tracks.find_by_title("елка"))
+        self.assertEqual([t1], tracks.find_by_title("ёлка", "SOMEBODY"))
+        self.assertEqual([], tracks.find_by_title("Baz", "nobody"))
+        self.assertEqual([t1, t2, t3], tracks.find_by_artist("Somebody"))
+
+    def test_diacritics(self):
+        # Only ё is folded, other letters with marks stay different.
+        t1 = self._add_track(["music"], "Йога")
+        t2 = self._add_track(["music"], "Иней")
+        t3 = self._add_track(["music"], "Ёж")
+        t5 = self._add_track(["music"], "Café")
+
+        self.assertEqual([t5], tracks.find_ids("café"))
+        self.assertEqual([], tracks.find_ids("cafe"))
+        self.assertEqual([t1], tracks.find_ids("йог"))
+        self.assertEqual([], tracks.find_ids("иог"))
+        self.assertEqual([t2], tracks.find_ids("ине"))
+        self.assertEqual([t3], tracks.find_ids("еж"))
+
+        # No words to search for: compared with the unicode collation.
+        t4 = self._add_track(["music"], "...")
+        self.assertEqual([t4], tracks.find_by_title("..."))
+        self.assertEqual([1], database.fetchcol("SELECT 'Ёлка' = 'елка' COLLATE unicode"))
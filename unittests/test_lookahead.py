@@ -0,0 +1,78 @@
+import unittest
+
+from ardj import candidates
+from ardj import database
+from ardj import lookahead
+from ardj import tracks
+
+
+class LookaheadTests(unittest.TestCase):
+    def setUp(self):
+        database.init_database()
+        candidates.reset()
+        for idx in range(5):
+            track_id = database.execute("INSERT INTO tracks (weight, real_weight, artist, title, filename, count, length) VALUES (1, 1, ?, ?, 'dummy.mp3', 0, 180)", ("artist %u" % idx, "title %u" % idx, ))
+            database.execute("INSERT INTO labels (track_id, label, email) VALUES (?, 'music', '-')", (track_id, ))
+
+    def tearDown(self):
+        for table in ("tracks", "labels", "queue", "urgent_playlists", "playlog"):
+            database.execute("DELETE FROM %s" % table)
+        database.commit()
+
+    def test_select_has_no_side_effects(self):
+        queued = database.fetchone("SELECT MIN(id) FROM tracks")[0]
+        tracks.queue(queued)
+
+        pick = tracks.select_next_track()
+        self.assertEqual(queued, pick.track_id)
+        self.assertEqual(1, database.fetchone("SELECT COUNT(*) FROM queue")[0])
+        self.assertEqual(0, database.fetchone("SELECT COUNT(*) FROM playlog")[0])
+
+        self.assertEqual(queued, tracks.apply_pick(pick))
+        self.assertEqual(0, database.fetchone("SELECT COUNT(*) FROM queue")[0])
+        self.assertEqual(1, database.fetchone("SELECT count FROM tracks WHERE id = ?", (queued, ))[0])
+
+    def test_invalidated_by_queue(self):
+        la = lookahead.Lookahead()
+        self.addCleanup(la.close)
+        self.assertTrue(la.prepare().wait(10))
+        self.assertTrue(la.pending is not None)
+
+        queued = database.fetchone("SELECT MAX(id) FROM tracks")[0]
+        tracks.queue(queued)
+
+        with la.lock:
+            self.assertEqual(None, la.pop())
+
+    def test_valid(self):
+        la = lookahead.Lookahead()
+        self.addCleanup(la.close)
+        self.assertTrue(la.prepare().wait(10))
+        track_id = la.pending.track_id
+
+        with la.lock:
+            pick = la.pop()
+        self.assertEqual(track_id, pick.track_id)
+
+    def test_one_worker(self):
+        la = lookahead.Lookahead()
+        self.addCleanup(la.close)
+        self.assertTrue(la.prepare().wait(10))
+        worker = la.worker
+        self.assertTrue(la.prepare().wait(10))
+        self.assertTrue(la.worker is worker)
+
+        la.close()
+        self.assertFalse(worker.is_alive())
+
+    def test_invalidated_by_schedule(self):
+        la = lookahead.Lookahead()
+        self.addCleanup(la.close)
+        self.assertTrue(la.prepare().wait(10))
+
+        # Pretend the track is used after the next schedule boundary.
+        self.addCleanup(setattr, tracks.Playlist, "get_next_change", tracks.Playlist.__dict__["get_next_change"])
+        tracks.Playlist.get_next_change = classmethod(lambda cls, timestamp=None: (la.boundary or 0) + 60)
+
+        with la.lock:
+            self.assertEqual(None, la.pop())
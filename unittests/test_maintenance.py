@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+import ardj.database
+import ardj.maintenance as maintenance
+
+
+class MaintenanceTests(unittest.TestCase):
+    def setUp(self):
+        ardj.database.init_database()
+
+    def test_plan(self):
+        jobs = [
+            maintenance.Job("a", None),
+            maintenance.Job("b", None, after=("a", )),
+            maintenance.Job("net", None, network=True, writes=False),
+            maintenance.Job("c", None),
+        ]
+        steps, total = maintenance.plan(jobs, {"a": 1.0, "b": 2.0, "net": 10.0, "c": 1.0})
+        steps = dict((name, (start, end)) for name, start, end in steps)
+
+        # Writers one by one, the network job alongside.
+        self.assertEqual((0.0, 1.0), steps["a"])
+        self.assertEqual((0.0, 10.0), steps["net"])
+        self.assertEqual((1.0, 2.0), steps["c"])
+        self.assertEqual((2.0, 4.0), steps["b"])
+        self.assertEqual(10.0, total)
+
+    def test_run(self):
+        done = []
+        started = threading.Event()
+
+        def fail():
+            raise RuntimeError("oops")
+
+        def network():
+            done.append("net")
+            started.set()
+
+        def local():
+            # Network jobs don't wait for local ones and vice versa.
+            self.assertTrue(started.wait(5))
+            done.append("a")
+
+        jobs = [
+            maintenance.Job("a", local),
+            maintenance.Job("net", network, network=True, writes=False),
+            maintenance.Job("bad", fail),
+            maintenance.Job("after-bad", lambda: done.append("after-bad"), after=("bad", )),
+            maintenance.Job("after-a", lambda: done.append("after-a"), after=("a", )),
+        ]
+        status = maintenance.Runner(jobs).run()
+
+        self.assertEqual({"a": "ok", "net": "ok", "bad": "failed", "after-bad": "skipped", "after-a": "ok"}, status)
+        self.assertEqual(["net", "a", "after-a"], [name for name in done if name != "after-bad"])
+        self.assertNotIn("after-bad", done)
+
+        last = maintenance.get_last_results()
+        self.assertEqual("oops", last["bad"][3])
+        self.assertEqual("skipped", last["after-bad"][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
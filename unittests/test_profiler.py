@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from ardj import database
+from ardj import profiler
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        database.init_database()
+        self.db = database.Open()
+        self.profiler = profiler.Profiler(threshold=0)
+        profiler.install(self.db, self.profiler)
+
+    def tearDown(self):
+        profiler.uninstall(self.db)
+        database.rollback()
+
+    def test_normalize(self):
+        self.assertEqual("SELECT id FROM tracks WHERE id IN (?, ...) AND title = ?",
+                         profiler.normalize("SELECT id  FROM tracks\n WHERE id IN (?, ?, ?) AND title = 'it''s'"))
+        self.assertEqual("SELECT * FROM t WHERE a = ? LIMIT ?",
+                         profiler.normalize("SELECT * FROM t WHERE a = 1.5 LIMIT 10"))
+
+    def test_record(self):
+        database.execute("DELETE FROM queue")
+        database.bulk_insert("queue", ("track_id", "owner"), [(1, "a"), (2, "b")])
+        database.fetch("SELECT * FROM queue WHERE track_id = 1")
+        database.fetch("SELECT * FROM queue WHERE track_id = 2")
+
+        stats = self.profiler.snapshot()
+        item = stats["SELECT * FROM queue WHERE track_id = ?"]
+        self.assertEqual(2, item["count"])
+        self.assertEqual(2, item["rows"])
+        self.assertIn("INSERT INTO queue (track_id, owner) VALUES (?, ?)", stats)
+
+        # Every slow statement is explained once.
+        self.assertIn("SELECT * FROM queue WHERE track_id = ?", self.profiler.explained)
+
+        profiler.uninstall(self.db)
+        database.fetch("SELECT * FROM queue")
+        self.assertNotIn("SELECT * FROM queue", self.profiler.snapshot())
+
+    def test_iter_rows(self):
+        database.execute("DELETE FROM queue")
+        database.bulk_insert("queue", ("track_id", "owner"), [(1, "a"), (2, "b")])
+        self.assertEqual(2, len(list(database.Queue.iter_all())))
+
+        stats = self.profiler.snapshot()
+        item = [v for k, v in stats.items() if k.startswith("SELECT") and "FROM queue" in k]
+        self.assertEqual(1, len(item))
+        self.assertEqual(2, item[0]["rows"])
+
+    def test_dump(self):
+        database.fetch("SELECT COUNT(*) FROM tracks")
+        folder = tempfile.mkdtemp()
+        try:
+            self.profiler.dump(folder)
+            self.profiler.dump(folder)
+            processes, stats = profiler.load(folder)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(1, len(processes))
+        self.assertEqual(1, stats["SELECT COUNT(*) FROM tracks"]["count"])
+        self.assertIn("SELECT COUNT(*) FROM tracks", profiler.format_report(stats))
+
+    def test_stale(self):
+        # A pid that is not running any more.
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        database.fetch("SELECT COUNT(*) FROM tracks")
+        self.profiler.dump(folder)
+        for pid, dumped in ((proc.pid, time.time()), (proc.pid + 1000000, 0)):
+            with open(os.path.join(folder, "%u.json" % pid), "w") as f:
+                json.dump({"pid": pid, "command": "dead", "started": 0, "dumped": int(dumped),
+                           "stats": {"SELECT COUNT(*) FROM tracks": {"count": 5, "total": 0.0, "max": 0.0, "rows": 5}}}, f)
+
+        processes, stats = profiler.load(folder)
+        self.assertEqual([False, True], [p["stale"] for p in sorted(processes, key=lambda p: p["stale"])])
+        self.assertEqual(1, stats["SELECT COUNT(*) FROM tracks"]["count"])
+
+        processes, stats = profiler.load(folder, stale=True)
+        self.assertEqual(6, stats["SELECT COUNT(*) FROM tracks"]["count"])
+
+        # The old dump is gone.
+        self.assertEqual(2, len(os.listdir(folder)))
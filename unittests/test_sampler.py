@@ -0,0 +1,86 @@
+import random
+import unittest
+
+from ardj import sampler
+
+
+class FenwickTests(unittest.TestCase):
+    def test_find(self):
+        tree = sampler.FenwickTree([1.0, 0.0, 2.0, 3.0])
+        self.assertEqual(6.0, tree.total())
+        self.assertEqual(0, tree.find(0.5))
+        self.assertEqual(2, tree.find(1.0))
+        self.assertEqual(2, tree.find(2.9))
+        self.assertEqual(3, tree.find(3.0))
+        self.assertEqual(3, tree.find(5.9))
+
+    def test_set(self):
+        tree = sampler.FenwickTree([1.0, 1.0, 1.0])
+        tree.set(1, 5.0)
+        self.assertEqual(7.0, tree.total())
+        self.assertEqual(1, tree.find(1.0))
+        self.assertEqual(2, tree.find(6.5))
+
+    def test_find_zero_slot(self):
+        tree = sampler.FenwickTree([0.0, 0.0, 2.0, 0.0])
+        self.assertEqual(2, tree.find(-0.1))
+        self.assertEqual(2, tree.find(2.5))
+
+    def test_removed_first_key(self):
+        s = sampler.WeightedSampler()
+        s.set("a", 1.0)
+        s.set("b", 1.0)
+        s.remove("a")
+        # Rounding errors left some weight on the freed slot.
+        s.tree.tree[1] += 1e-9
+        self.assertEqual("b", s.pick(0.0))
+
+
+class ArtistSamplerTests(unittest.TestCase):
+    def _expected(self, tracks, exclude=()):
+        counts = {}
+        for track_id, artist, weight in tracks:
+            if track_id not in exclude:
+                counts[artist] = counts.get(artist, 0) + 1
+        probs = dict((track_id, weight / counts[artist])
+                     for track_id, artist, weight in tracks if track_id not in exclude)
+        total = sum(probs.values())
+        return dict((k, v / total) for k, v in probs.items())
+
+    def _measure(self, s, exclude=None, count=20000):
+        hits = {}
+        for idx in range(count):
+            track_id = s.pick(exclude)
+            hits[track_id] = hits.get(track_id, 0) + 1
+        return dict((k, float(v) / count) for k, v in hits.items())
+
+    def test_distribution(self):
+        random.seed(1)
+        tracks = [(1, "a", 1.0), (2, "a", 1.0), (3, "b", 1.0), (4, "c", 2.0), (5, "c", 0.5)]
+
+        s = sampler.ArtistSampler()
+        for track_id, artist, weight in tracks:
+            s.set(track_id, artist, weight)
+
+        expected = self._expected(tracks)
+        for track_id, share in self._measure(s).items():
+            self.assertAlmostEqual(expected[track_id], share, delta=0.02)
+
+        expected = self._expected(tracks, exclude=(2, 3))
+        measured = self._measure(s, exclude=(2, 3))
+        self.assertEqual(set([1, 4, 5]), set(measured.keys()))
+        for track_id, share in measured.items():
+            self.assertAlmostEqual(expected[track_id], share, delta=0.02)
+
+        # Exclusions must not stick.
+        self.assertEqual(5, len(s))
+        self.assertEqual(set([1, 2, 3, 4, 5]), set(self._measure(s, count=2000).keys()))
+
+    def test_update(self):
+        s = sampler.ArtistSampler()
+        s.set(1, "a", 1.0)
+        s.set(2, "b", 1.0)
+        s.set(2, "b", 0.0)
+        self.assertEqual(1, s.pick())
+        s.remove(1)
+        self.assertEqual(None, s.pick())
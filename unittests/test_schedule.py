@@ -0,0 +1,54 @@
+import time
+import unittest
+
+from ardj import schedule
+from ardj import tracks
+from ardj import util
+
+
+def is_scheduled(playlist, timestamp):
+    """The straightforward version of the schedule check."""
+    now = time.localtime(timestamp)
+    day = int(time.strftime('%w', now))
+    if 'hours' in playlist and now.tm_hour not in util.expand(playlist['hours']):
+        return False
+    if 'days' in playlist and day not in util.expand(playlist['days']):
+        return False
+    if 'minutes' in playlist and now.tm_min not in util.expand(playlist['minutes']):
+        return False
+    return True
+
+
+class ScheduleTests(unittest.TestCase):
+    playlists = [
+        {"name": "always"},
+        {"name": "night", "hours": ["0-6", 23]},
+        {"name": "weekend", "days": [0, 6]},
+        {"name": "top", "minutes": ["0-5"], "days": ["1-6"]},
+    ]
+
+    def test_matches_plain_check(self):
+        sched = schedule.WeeklySchedule(self.playlists)
+        start = int(time.mktime((2020, 3, 2, 0, 0, 0, 0, 0, -1)))
+        for ts in range(start, start + 8 * 86400, 7 * 60 + 13):
+            mask = sched.get_mask(ts)
+            for pos, playlist in enumerate(self.playlists):
+                self.assertEqual(is_scheduled(playlist, ts), bool(mask >> pos & 1),
+                                 "%s at %s" % (playlist["name"], time.ctime(ts)))
+
+    def test_next_change(self):
+        sched = schedule.WeeklySchedule([{"name": "night", "hours": ["0-6"]}])
+        ts = int(time.mktime((2020, 3, 2, 3, 30, 15, 0, 0, -1)))
+        expected = int(time.mktime((2020, 3, 2, 6, 0, 0, 0, 0, -1)))
+        self.assertEqual(expected, sched.get_next_change(ts))
+
+        self.assertEqual(None, schedule.WeeklySchedule([{"name": "always"}]).get_next_change(ts))
+
+    def test_playlist(self):
+        playlist = tracks.Playlist(name="night", hours=["0-6"], delay=10, last_played=0)
+        ts = int(time.mktime((2020, 3, 2, 3, 30, 0, 0, 0, -1)))
+        self.assertTrue(playlist.is_active(ts))
+        self.assertFalse(playlist.is_active(ts + 3 * 3600))
+
+        playlist["last_played"] = ts - 60
+        self.assertFalse(playlist.is_active(ts))
@@ -0,0 +1,44 @@
+import random
+import time
+import unittest
+
+from ardj import database
+from ardj import simulator
+
+
+class SimulatorTests(unittest.TestCase):
+    def test_run(self):
+        real_db = database.Open()
+        real_time = time.time
+
+        with simulator.Simulation(tracks=50, seed=1) as sim:
+            report = sim.run(2)
+
+        self.assertTrue(len(report.picks) >= 2 * 3600 / 420)
+        self.assertEqual(len(report.picks), len(report.latencies))
+        self.assertTrue(min(report.statements) > 0)
+        self.assertTrue("Picks per second" in report.format())
+
+        self.assertTrue(database.Open() is real_db)
+        self.assertTrue(time.time is real_time)
+
+    def test_seed(self):
+        # The picker uses the random module, which is seeded too.
+        with simulator.Simulation(tracks=10, seed=1):
+            self.assertEqual(random.Random(1).random(), random.random())
+
+        picks = []
+        for idx in range(2):
+            with simulator.Simulation(tracks=200, seed=1, start=1700000000) as sim:
+                picks.append(sim.run(2).picks)
+        self.assertEqual(picks[0], picks[1])
+
+    def test_background_statements(self):
+        with simulator.Simulation(tracks=50, seed=1) as sim:
+            writer = simulator.BackgroundWriter(batch=10, hold=0, pause=0)
+            writer.start()
+            try:
+                sim.run(1)
+            finally:
+                writer.stop()
+        self.assertTrue(sim.other_statements > 0)
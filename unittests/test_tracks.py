@@ -53,3 +53,46 @@ class TrackSelectionTests(unittest.TestCase):
         sticky_label = list(sticky_label)[0]
 
         return sticky_label, track
+
+
+class PlaylistTests(unittest.TestCase):
+    def setUp(self):
+        database.init_database()
+
+    def tearDown(self):
+        database.execute("DELETE FROM tracks")
+        database.execute("DELETE FROM labels")
+        database.execute("DELETE FROM playlists")
+        database.commit()
+
+    def test_match_conditions(self):
+        playlists = [
+            tracks.Playlist(name="music"),
+            tracks.Playlist(name="rock", labels=["music", "+rock", "-calm"]),
+            tracks.Playlist(name="new", labels=["music"], repeat=3),
+            tracks.Playlist(name="top", labels=["music"], weight="1.5-5"),
+            tracks.Playlist(name="jingles", labels=["jingle"]),
+        ]
+
+        samples = [
+            {"labels": ["music", "rock"], "count": 0, "weight": 1.0},
+            {"labels": ["music", "rock", "calm"], "count": 5, "weight": 2.0},
+            {"labels": ["jingle"], "count": 1, "weight": 1.0},
+            {"labels": [], "count": 0, "weight": 1.0},
+        ]
+
+        for track in samples:
+            for playlist in playlists:
+                self.assertEqual(playlist.match_track(track),
+                                 playlist.match_conditions(set(track["labels"]), track["count"], track["weight"]),
+                                 "%s: %s" % (playlist["name"], track))
+
+    def test_touch_by_track(self):
+        track_id = database.execute("INSERT INTO tracks (weight, artist, filename, count) VALUES (1, 'somebody', 'dummy.mp3', 1)")
+        database.execute("INSERT INTO labels (track_id, label, email) VALUES (?, 'music', '-')", (track_id, ))
+        database.execute("INSERT INTO playlists (name, last_played) VALUES ('music', 1)")
+
+        tracks.Playlist.touch_by_track(track_id)
+        rows = database.fetch("SELECT name, last_played FROM playlists ORDER BY name")
+        self.assertEqual(["music"], [row[0] for row in rows])
+        self.assertTrue(rows[0][1] > 1)